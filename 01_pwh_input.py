@@ -1,184 +1,238 @@
 import os
 import io
 import re
-from datetime import date
+import json
+import hashlib
+import tempfile
+import bisect
+import threading
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime
+from typing import NamedTuple
+from zoneinfo import ZoneInfo
+import numpy as np
 import pandas as pd
 import streamlit as st
 from pandas import ExcelWriter
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Engine
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import DataError, IntegrityError
+from pwh_profiler import section, profiled
+from pwh_export import EXPORT_FORMATS, ExportFile, ExportSheet, cached_export
+from pwh_jobs import JOB_DONE, Job, JobContext, runner as jobs_runner
+from pwh_import import (IMPORT_SHEETS, ImportReport, build_annotated_workbook, column_limits, concat_errors,
+                        iter_parsed_sheets, load_import)
 
 st.set_page_config(page_title="PWH Input", page_icon="🩸", layout="wide")
 
 
-# Builder file Excel (multi-sheet) untuk semua tab
+# Export Excel (multi-sheet) untuk semua tab
 # ------------------------------------------------------------------------------
-def build_excel_bytes() -> bytes:
-    # --- PERUBAHAN DI SINI: Query df_patients dimodifikasi untuk mengambil Keterangan Meninggal ---
-    df_patients = run_df_branch("""
-        SELECT
-    p.id,
-    p.full_name,
-    p.birth_place,
-    p.birth_date,
-    p.nik,
-    EXTRACT(YEAR FROM age(CURRENT_DATE, p.birth_date)) AS age_years,
-    p.blood_group,
-    p.rhesus,
-    p.gender,
-    p.occupation,
-    p.education,
-    p.address,
-    p.village,
-    p.district,
-    p.phone,
-    p.province,
-    p.city,
-    p.cabang, 
-    p.kota_cakupan,
-    p.note,
-    p.created_at,
-    CASE WHEN d.id IS NOT NULL THEN COALESCE(d.cause_of_death, 'Meninggal') ELSE NULL END AS keterangan_meninggal
-FROM pwh.patients p
-LEFT JOIN pwh.death d ON p.id = d.patient_id
-ORDER BY p.id
-    """)
-    # --- END PERUBAHAN ---
-    
-    # 1. Reset index agar urut dari 0
-    df_patients.reset_index(drop=True, inplace=True)
-    
-    # 2. Tambahkan kolom "No" di posisi paling kiri (indeks 0)
-    # Isinya adalah angka 1 sampai jumlah total data
-    df_patients.insert(0, 'No', range(1, 1 + len(df_patients)))
-
-    # ============================================================
-    df_diag = run_df_branch("""
-        SELECT d.id, d.patient_id, p.full_name, d.hemo_type, d.severity, d.diagnosed_on, d.source
-        FROM pwh.hemo_diagnoses d JOIN pwh.patients p ON p.id = d.patient_id
-        ORDER BY d.patient_id, d.id
-    """)
-    df_inh = run_df_branch("""
-        SELECT i.id, i.patient_id, p.full_name, i.factor, i.titer_bu, i.measured_on, i.lab
-        FROM pwh.hemo_inhibitors i JOIN pwh.patients p ON p.id = i.patient_id
-        ORDER BY i.patient_id, i.measured_on NULLS LAST, i.id
-    """)
-    df_virus = run_df_branch("""
-        SELECT v.id, v.patient_id, p.full_name, v.test_type, v.result, v.tested_on, v.lab
-        FROM pwh.virus_tests v JOIN pwh.patients p ON p.id = v.patient_id
-        ORDER BY v.patient_id, v.tested_on NULLS LAST, v.id
-    """)
-    df_hospital = run_df_branch("""
-        SELECT th.id, th.patient_id, p.full_name, th.name_hospital, th.city_hospital, th.province_hospital,
-               th.date_of_visit, th.doctor_in_charge, th.treatment_type, th.care_services, th.frequency, th.dose, th.product, th.merk
-        FROM pwh.treatment_hospital th JOIN pwh.patients p ON p.id = th.patient_id
-        ORDER BY th.patient_id, th.id
-    """)
-    df_death = run_df_branch("""
-        SELECT d.id, d.patient_id, p.full_name, d.cause_of_death, d.year_of_death
-        FROM pwh.death d JOIN pwh.patients p ON p.id = d.patient_id
-        ORDER BY d.patient_id, d.id
-    """)
-    df_contacts = run_df_branch("""
-        SELECT c.id, c.patient_id, p.full_name, c.relation, c.name, c.phone, c.is_primary
-        FROM pwh.contacts c JOIN pwh.patients p ON p.id = c.patient_id
-        ORDER BY c.patient_id, c.id
-    """)
-    
-    df_summary = run_df_branch("""
-        SELECT s.*, p.cabang, d.cause_of_death 
-        FROM pwh.patient_summary s
-        JOIN pwh.patients p ON s.id = p.id
-        LEFT JOIN pwh.death d ON s.id = d.patient_id
-        ORDER BY s.id
-    """)
-    
-    # --- FIX: Hapus Timezone dari Datetime Columns ---
-    if 'created_at' in df_patients.columns and pd.api.types.is_datetime64_any_dtype(df_patients['created_at']):
-        try:
-            if df_patients['created_at'].dt.tz is not None:
-                df_patients['created_at'] = df_patients['created_at'].dt.tz_localize(None)
-        except AttributeError:
-            pass 
+# Query per sheet untuk pwh_export: {where} diisi kondisi cabang (alias pasien p).
+# Header memakai ALIAS_* (didefinisikan di bawah; dibaca saat export dipanggil).
+# changed_since dipakai export inkremental (sql/005_row_timestamps.sql); ringkasan
+# pasien ikut berubah bila salah satu data terkait pasien itu berubah.
+EXPORT_CHANGE_TABLES = ["patients", "hemo_diagnoses", "hemo_inhibitors", "virus_tests",
+                        "treatment_hospital", "death", "contacts"]
+SUMMARY_CHANGED_SINCE = "p.id IN (" + " UNION ".join(
+    f"SELECT {'id' if t == 'patients' else 'patient_id'} FROM pwh.{t} WHERE updated_at >= :since"
+    for t in EXPORT_CHANGE_TABLES) + ")"
+
+# Rentang tanggal per sheet = tanggal kejadiannya; pasien & ringkasan memakai tanggal terdaftar
+PATIENT_DATE_RANGE = "p.created_at >= CAST(:date_from AS date) AND p.created_at < CAST(:date_to AS date) + 1"
+EXPORT_DATE_COLUMNS = {
+    "Pasien": "tanggal terdaftar", "Diagnosa": "Tgl Diagnosis", "Inhibitor": "Tgl Ukur",
+    "Virus Tes": "Tgl Tes", "RS Penangan": "Tanggal Kunjungan", "Kematian": "Tahun Kematian",
+    "Ringkasan Pasien": "tanggal terdaftar",
+}
 
-    for col in df_summary.columns:
-        if pd.api.types.is_datetime64_any_dtype(df_summary[col]):
-            try:
-                if df_summary[col].dt.tz is not None:
-                    df_summary[col] = df_summary[col].dt.tz_localize(None)
-            except AttributeError:
-                pass 
-    # --- END FIX ---
-
-    # --- LOGIKA SUMMARY ---
-    df_summary.reset_index(drop=True, inplace=True)
-    df_summary.insert(0, 'No', range(1, 1 + len(df_summary)))
-
-    cols = df_summary.columns.tolist()
-    if 'id' in cols and 'cabang' in cols:
-        cols.remove('cabang')
-        idx_id = cols.index('id')
-        cols.insert(idx_id + 1, 'cabang')
-        df_summary = df_summary[cols]
-    
-    alias_summary_updated = ALIAS_SUMMARY.copy()
-    alias_summary_updated.update({
-        "cabang": "HMHI Cabang",
-        "cause_of_death": "Penyebab Kematian"
-    })
-    
-    # --- PERUBAHAN DI SINI: Update Map Kolom Export Pasien ---
-    alias_patients_updated = ALIAS_PATIENTS.copy()
-    alias_patients_updated.update({"keterangan_meninggal": "Keterangan Meninggal"})
-    
-    a_patients  = _alias_df(df_patients, alias_patients_updated)
-    # --- END PERUBAHAN ---
-    
-    a_diag      = _alias_df(df_diag, ALIAS_DIAG)
-    a_inh       = _alias_df(df_inh, ALIAS_INH)
-    a_virus     = _alias_df(df_virus, ALIAS_VIRUS)
-    a_hospital  = _alias_df(df_hospital, ALIAS_HOSPITAL)
-    a_death     = _alias_df(df_death, ALIAS_DEATH)
-    a_contacts  = _alias_df(df_contacts, ALIAS_CONTACTS)
-    a_summary   = _alias_df(df_summary, alias_summary_updated)
-
-    output = io.BytesIO()
-    with ExcelWriter(output, engine="xlsxwriter", datetime_format="yyyy-mm-dd", date_format="yyyy-mm-dd") as writer:
-        a_patients.to_excel(writer, sheet_name="Pasien", index=False)
-        a_diag.to_excel(writer, sheet_name="Diagnosa", index=False)
-        a_inh.to_excel(writer, sheet_name="Inhibitor", index=False)
-        a_virus.to_excel(writer, sheet_name="Virus Tes", index=False)
-        a_hospital.to_excel(writer, sheet_name="RS Penangan", index=False)
-        a_death.to_excel(writer, sheet_name="Kematian", index=False)
-        a_contacts.to_excel(writer, sheet_name="Kontak", index=False)
-        a_summary.to_excel(writer, sheet_name="Ringkasan Pasien", index=False)
-
-        sheet_map = {
-            "Pasien": a_patients,
-            "Diagnosa": a_diag,
-            "Inhibitor": a_inh,
-            "Virus Tes": a_virus,
-            "RS Penangan": a_hospital,
-            "Kematian": a_death,
-            "Kontak": a_contacts,
-            "Ringkasan Pasien": a_summary,
-        }
-        for sheet, df_sheet in sheet_map.items():
-            ws = writer.sheets[sheet]
-            for col_idx, col_name in enumerate(df_sheet.columns):
-                # PERBAIKAN: Menggunakan lambda str(x) yang lebih aman untuk menghindari error float
-                max_len_data = df_sheet[col_name].map(lambda x: len(str(x))).max() if not df_sheet.empty else 0
-                max_len = max(max_len_data, len(str(col_name)))
-                
-                ws.set_column(col_idx, col_idx, min(max_len + 2, 50))
-    return output.getvalue()
+def export_sheets() -> list[ExportSheet]:
+    return [
+        ExportSheet("Pasien", """
+            SELECT p.id, p.full_name, p.birth_place, p.birth_date, p.nik,
+                   EXTRACT(YEAR FROM age(CURRENT_DATE, p.birth_date)) AS age_years,
+                   p.blood_group, p.rhesus, p.gender, p.occupation, p.education, p.address,
+                   p.village, p.district, p.phone, p.province, p.city, p.cabang, p.kota_cakupan,
+                   p.note, p.created_at,
+                   CASE WHEN d.id IS NOT NULL THEN COALESCE(d.cause_of_death, 'Meninggal') ELSE NULL END AS keterangan_meninggal
+            FROM pwh.patients p
+            LEFT JOIN pwh.death d ON p.id = d.patient_id
+            WHERE {where}
+            ORDER BY p.id
+        """, {**ALIAS_PATIENTS, "keterangan_meninggal": "Keterangan Meninggal"}, numbered=True,
+            changed_since="p.updated_at >= :since OR d.updated_at >= :since", date_range=PATIENT_DATE_RANGE),
+        ExportSheet("Diagnosa", """
+            SELECT d.id, d.patient_id, p.full_name, d.hemo_type, d.severity, d.diagnosed_on, d.source
+            FROM pwh.hemo_diagnoses d JOIN pwh.patients p ON p.id = d.patient_id
+            WHERE {where}
+            ORDER BY d.patient_id, d.id
+        """, ALIAS_DIAG, changed_since="d.updated_at >= :since",
+            date_range="d.diagnosed_on BETWEEN :date_from AND :date_to"),
+        ExportSheet("Inhibitor", """
+            SELECT i.id, i.patient_id, p.full_name, i.factor, i.titer_bu, i.measured_on, i.lab
+            FROM pwh.hemo_inhibitors i JOIN pwh.patients p ON p.id = i.patient_id
+            WHERE {where}
+            ORDER BY i.patient_id, i.measured_on NULLS LAST, i.id
+        """, ALIAS_INH, changed_since="i.updated_at >= :since",
+            date_range="i.measured_on BETWEEN :date_from AND :date_to"),
+        ExportSheet("Virus Tes", """
+            SELECT v.id, v.patient_id, p.full_name, v.test_type, v.result, v.tested_on, v.lab
+            FROM pwh.virus_tests v JOIN pwh.patients p ON p.id = v.patient_id
+            WHERE {where}
+            ORDER BY v.patient_id, v.tested_on NULLS LAST, v.id
+        """, ALIAS_VIRUS, changed_since="v.updated_at >= :since",
+            date_range="v.tested_on BETWEEN :date_from AND :date_to"),
+        ExportSheet("RS Penangan", """
+            SELECT th.id, th.patient_id, p.full_name, th.name_hospital, th.city_hospital, th.province_hospital,
+                   th.date_of_visit, th.doctor_in_charge, th.treatment_type, th.care_services, th.frequency,
+                   th.dose, th.product, th.merk
+            FROM pwh.treatment_hospital th JOIN pwh.patients p ON p.id = th.patient_id
+            WHERE {where}
+            ORDER BY th.patient_id, th.id
+        """, ALIAS_HOSPITAL, changed_since="th.updated_at >= :since",
+            date_range="th.date_of_visit BETWEEN :date_from AND :date_to"),
+        ExportSheet("Kematian", """
+            SELECT d.id, d.patient_id, p.full_name, d.cause_of_death, d.year_of_death
+            FROM pwh.death d JOIN pwh.patients p ON p.id = d.patient_id
+            WHERE {where}
+            ORDER BY d.patient_id, d.id
+        """, ALIAS_DEATH, changed_since="d.updated_at >= :since",
+            date_range="d.year_of_death BETWEEN EXTRACT(YEAR FROM CAST(:date_from AS date)) "
+                       "AND EXTRACT(YEAR FROM CAST(:date_to AS date))"),
+        ExportSheet("Kontak", """
+            SELECT c.id, c.patient_id, p.full_name, c.relation, c.name, c.phone, c.is_primary
+            FROM pwh.contacts c JOIN pwh.patients p ON p.id = c.patient_id
+            WHERE {where}
+            ORDER BY c.patient_id, c.id
+        """, ALIAS_CONTACTS, changed_since="c.updated_at >= :since"),
+        ExportSheet("Ringkasan Pasien", """
+            SELECT s.*, p.cabang, d.cause_of_death
+            FROM pwh.patient_summary s
+            JOIN pwh.patients p ON s.id = p.id
+            LEFT JOIN pwh.death d ON s.id = d.patient_id
+            WHERE {where}
+            ORDER BY s.id
+        """, {**ALIAS_SUMMARY, "cabang": "HMHI Cabang", "cause_of_death": "Penyebab Kematian"},
+            numbered=True, after_id=("cabang",), changed_since=SUMMARY_CHANGED_SINCE,
+            date_range=PATIENT_DATE_RANGE),
+    ]
+
+# Zona waktu input 'sejak' export inkremental. updated_at/created_at bertipe
+# timestamptz: waktu tanpa zona akan ditafsirkan dengan TimeZone sesi database
+# (biasanya UTC), bukan jam lokal cabang. Cabang WITA/WIT: set PWH_TIMEZONE.
+EXPORT_TZ = ZoneInfo(os.environ.get("PWH_TIMEZONE") or "Asia/Jakarta")
+
+# Pilihan format di tab Export -> (kunci EXPORT_FORMATS, nama file unduhan)
+EXPORT_FORMAT_CHOICES = {
+    "Excel (.xlsx)": ("xlsx", "data_pwh.xlsx"),
+    "CSV per sheet (.zip)": ("csv", "data_pwh_csv.zip"),
+    "Parquet per sheet (.zip)": ("parquet", "data_pwh_parquet.zip"),
+}
+
+EXPORT_STATUS_ALL, EXPORT_STATUS_ALIVE, EXPORT_STATUS_DECEASED = "Semua", "Hidup", "Meninggal"
+EXPORT_STATUS_SQL = {
+    EXPORT_STATUS_ALIVE: "NOT EXISTS (SELECT 1 FROM pwh.death x WHERE x.patient_id = p.id)",
+    EXPORT_STATUS_DECEASED: "EXISTS (SELECT 1 FROM pwh.death x WHERE x.patient_id = p.id)",
+}
+
+class ExportFilters(NamedTuple):
+    """Pilihan di tab Export; semuanya diterapkan di SQL setiap sheet (lihat export_conditions)."""
+    sheets: tuple = ()              # kosong = semua sheet
+    date_from: date | None = None
+    date_to: date | None = None
+    hemo_types: tuple = ()
+    provinces: tuple = ()
+    status: str = EXPORT_STATUS_ALL
+
+    @property
+    def active(self) -> bool:
+        return self != ExportFilters()
+
+def export_conditions(filters: ExportFilters) -> tuple[list[str], dict]:
+    """Kondisi tingkat pasien (alias p) + parameter; rentang tanggal diterapkan per sheet."""
+    conditions, params = [], {}
+    if filters.hemo_types:
+        conditions.append("EXISTS (SELECT 1 FROM pwh.hemo_diagnoses x "
+                          "WHERE x.patient_id = p.id AND x.hemo_type::text = ANY(:hemo_types))")
+        params["hemo_types"] = list(filters.hemo_types)
+    if filters.provinces:
+        conditions.append("p.province = ANY(:provinces)")
+        params["provinces"] = list(filters.provinces)
+    if filters.status in EXPORT_STATUS_SQL:
+        conditions.append(EXPORT_STATUS_SQL[filters.status])
+    if filters.date_from and filters.date_to:
+        params.update(date_from=filters.date_from, date_to=filters.date_to)
+    return conditions, params
+
+@st.cache_data(show_spinner=False, ttl=600)
+def fetch_patient_provinces(branch: str | None) -> list[str]:
+    q = """
+        SELECT DISTINCT province FROM pwh.patients
+        WHERE NULLIF(TRIM(province), '') IS NOT NULL AND (CAST(:branch AS text) IS NULL OR cabang = :branch)
+        ORDER BY province
+    """
+    with engine.begin() as conn:
+        return [r[0] for r in conn.execute(text(q), {"branch": branch})]
+
+def incremental_export_available() -> bool:
+    """Export inkremental butuh kolom updated_at di semua tabel (sql/005_row_timestamps.sql)."""
+    try:
+        return all("updated_at" in fetch_relation_columns("pwh", t) for t in EXPORT_CHANGE_TABLES)
+    except Exception:
+        return False
+
+@profiled("export: build_export")
+def build_export(branch: str | None, fmt: str = "xlsx", since: datetime | None = None,
+                 filters: ExportFilters | None = None, progress=None, keep=None) -> ExportFile:
+    """
+    Export sheet terpilih untuk cabang (None = semua; lihat pwh_export): ditulis
+    streaming ke disk dan dipakai ulang selama tabel PWH belum berubah. Tidak
+    memakai st.* sehingga bisa berjalan sebagai pekerjaan latar belakang.
+    since: hanya baris yang dibuat/berubah sejak waktu ini (export inkremental).
+    filters: sheet & filter yang dipilih user, diterapkan di SQL tiap sheet.
+    keep: diteruskan ke cached_export (mengambil file sebelum cache dibersihkan).
+    """
+    filters = filters or ExportFilters()
+    conditions, params = export_conditions(filters)
+    if branch:
+        conditions.insert(0, "p.cabang = :branch")
+        params["branch"] = branch
+    if since is not None:
+        params["since"] = since
+    sheets = [sh for sh in export_sheets() if not filters.sheets or sh.name in filters.sheets]
+    # Cakupan (filter, since) ikut di nama file cache: export berbeda tidak saling menggusur
+    prefix = "pwh_export_" + hashlib.sha1((branch or "ALL").encode("utf-8")).hexdigest()[:10]
+    return cached_export(engine, _cache_dir(), prefix, sheets, conditions, params,
+                         progress=progress, fmt=fmt, keep=keep)
+
+def submit_export(fmt: str, file_name: str, since: datetime | None, filters: ExportFilters) -> Job:
+    """Menjadwalkan build_export sebagai pekerjaan latar belakang untuk cabang sesi ini."""
+    branch = _session_branch()
+    n_sheets = len(filters.sheets) or len(export_sheets())
+
+    def run(ctx: JobContext) -> str:
+        done = 0
+        def step(sheet: str):
+            nonlocal done
+            ctx.progress(done / n_sheets, f"Menulis sheet {sheet}...")
+            done += 1
+        export = build_export(branch, fmt, since=since, filters=filters, progress=step, keep=ctx.keep_file)
+        if export.cached:
+            return "Data belum berubah sejak export terakhir; file diambil dari cache."
+        return f"{sum(export.rows.values())} baris dari {len(export.rows)} sheet."
+
+    return jobs_runner().submit(_job_owner(), "export", f"Export {file_name}", run,
+                                file_name=file_name, mime=EXPORT_FORMATS[fmt][2])
 
 
 # ------------------------------------------------------------------------------
 # Builder Template Excel (bulk) untuk insert data ke semua tabel
 # ------------------------------------------------------------------------------
-def build_bulk_template_bytes() -> bytes:
+def bulk_template_lookups() -> dict[str, list]:
+    """Data referensi untuk dropdown template (urutan = urutan kolom sheet lookups)."""
     blood_groups = BLOOD_GROUPS or ["A","B","AB","O"]
     rhesus = RHESUS or ["+","-"]
     genders = GENDERS or ["Laki-laki", "Perempuan"]
@@ -199,6 +253,26 @@ def build_bulk_template_bytes() -> bytes:
     products = ["", "Plasma (FFP)","Cryoprecipitate","Konsentrat (plasma derived)","Konsentrat (rekombinan)","Konsentrat (prolonged half life)","Prothrombin Complex","DDAVP","Emicizumab (Hemlibra)","Konsentrat Bypassing Agent"] 
     primary_bools = ["TRUE", "FALSE"] 
 
+    return {
+        "blood_groups": blood_groups, "rhesus": rhesus, "genders": genders,
+        "hemo_types": hemo_types, "severities": severities, "education_levels": education_levels,
+        "inhibitor_factors": inhibitor_factors, "virus_tests": virus_tests, "test_results": test_results,
+        "relations": relations, "occupations": occupations,
+        "treatment_types_vals": treatment_types,
+        "care_services_vals": care_services,
+        "products_vals": products,
+        "primary_vals": primary_bools,
+        "hmhi_cabang_vals": hmhi_branches,
+    }
+
+# Naikkan jika struktur template (sheet/kolom/validasi) di bawah diubah,
+# agar file template yang tersimpan di disk tidak dipakai lagi.
+BULK_TEMPLATE_LAYOUT_VERSION = 1
+
+@profiled("xlsxwriter: build_bulk_template_bytes")
+def build_bulk_template_bytes(lookups: dict[str, list] | None = None) -> bytes:
+    lookups = lookups or bulk_template_lookups()
+
     template_sheets = {
         "Pasien": [
             ("Nama Lengkap", "text"), ("Tempat Lahir", "text"), ("Tanggal Lahir", "date"),
@@ -275,17 +349,7 @@ def build_bulk_template_bytes() -> bytes:
         for r, (txt2, sty) in enumerate(readme): ws_readme.write(r, 0, txt2, sty)
 
         ws_lk = wb.add_worksheet("lookups")
-        look_cols = [
-            ("blood_groups", blood_groups), ("rhesus", rhesus), ("genders", genders),
-            ("hemo_types", hemo_types), ("severities", severities), ("education_levels", education_levels),
-            ("inhibitor_factors", inhibitor_factors), ("virus_tests", virus_tests), ("test_results", test_results),
-            ("relations", relations), ("occupations", occupations),
-            ("treatment_types_vals", treatment_types), 
-            ("care_services_vals", care_services),     
-            ("products_vals", products),               
-            ("primary_vals", primary_bools),           
-            ("hmhi_cabang_vals", hmhi_branches)        
-        ]
+        look_cols = list(lookups.items())
         for j, (name, items) in enumerate(look_cols):
             ws_lk.write(0, j, name, fmt_header)
             if isinstance(items, list):
@@ -339,11 +403,45 @@ def build_bulk_template_bytes() -> bytes:
             ws.write(max_rows + 2, 0, "Catatan: baris kosong akan diabaikan saat import.", fmt_note)
     return bio.getvalue()
 
+def _cache_dir() -> str:
+    """Direktori cache file hasil generate (PWH_CACHE_DIR atau folder temp sistem)."""
+    path = os.environ.get("PWH_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "pwh_cache")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+@st.cache_data(show_spinner="Menyiapkan template bulk...", max_entries=4)
+def _bulk_template_for_version(version: str, _lookups: dict[str, list]) -> bytes:
+    """Satu kali per versi data referensi: dibaca dari disk jika ada, selain itu dibangun."""
+    path = os.path.join(_cache_dir(), f"pwh_bulk_template_{version}.xlsx")
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        pass
+    data = build_bulk_template_bytes(_lookups)
+    try:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Gagal menyimpan cache template ke disk: {e}")
+    return data
+
+def get_bulk_template_bytes() -> bytes:
+    """Template bulk untuk data referensi saat ini, dari cache memori/disk."""
+    lookups = bulk_template_lookups()
+    payload = json.dumps([BULK_TEMPLATE_LAYOUT_VERSION, lookups], sort_keys=True, default=str)
+    version = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+    return _bulk_template_for_version(version, lookups)
+
 st.title("🩸 Form Input Penyandang Hemofilia")
 
 # --- TAMBAHAN: Tombol Refresh Cache ---
 if st.button("🔄 Refresh Data"):
     st.cache_data.clear() # Membersihkan semua st.cache_data
+    st.session_state.pop("_fragment_data", None)
+    st.session_state["_patient_index_stale"] = True # index pasien dibangun ulang (lihat invalidate_patient_index)
     st.rerun() # Memuat ulang aplikasi
 # --------------------------------------
 
@@ -401,7 +499,7 @@ def run_df_branch(query: str, params: dict | None = None) -> pd.DataFrame:
                 alias_prefix = "" 
         
         if alias_prefix is None:
-            with engine.begin() as conn:
+            with section("SQL: run_df_branch"), engine.begin() as conn:
                 return pd.read_sql(text(query_filtered), conn, params=params or {})
 
         filter_string = f"{alias_prefix}cabang = :branch"
@@ -426,7 +524,7 @@ def run_df_branch(query: str, params: dict | None = None) -> pd.DataFrame:
             if not injected:
                 query_filtered += f" WHERE {filter_string}"
 
-    with engine.begin() as conn:
+    with section("SQL: run_df_branch"), engine.begin() as conn:
         return pd.read_sql(text(query_filtered), conn, params=params or {})
 
 
@@ -435,7 +533,7 @@ def run_df_branch(query: str, params: dict | None = None) -> pd.DataFrame:
 # ------------------------------------------------------------------------------
 def run_exec(sql: str, params: dict | None = None):
     try:
-        with engine.connect() as conn:
+        with section("SQL: run_exec"), engine.connect() as conn:
             conn.execute(text(sql), params or {})
             conn.commit()
     except IntegrityError as e:
@@ -469,14 +567,33 @@ def fetch_occupations_list() -> list[str]:
     except Exception: pass
     return ["","Tidak bekerja","Nelayan","Petani","PNS/TNI/Polri","Karyawan Swasta","Wiraswasta","Pensiunan"]
 
+WILAYAH_DIM_QUERY = """
+    SELECT village_kode, village_name, district_kode, district_name,
+           city_kode, city_name, province_kode, province_name, full_display
+    FROM pwh.wilayah_dim
+    ORDER BY full_display;
+"""
+
 @st.cache_data(show_spinner="Memuat data wilayah...")
 def fetch_all_wilayah_details() -> pd.DataFrame:
+    # Dimensi terindeks (sql/001_wilayah_dim.sql); jika belum dibuat, pakai self-join lama
+    try:
+        with engine.begin() as conn:
+            df = pd.read_sql(text(WILAYAH_DIM_QUERY), conn)
+        if not df.empty:
+            return df
+    except Exception:
+        pass
     try:
         q = """
         SELECT
+            kel.kode AS village_kode,
             kel.nama AS village_name,
+            kec.kode AS district_kode,
             kec.nama AS district_name,
+            kota.kode AS city_kode,
             kota.nama AS city_name,
+            prov.kode AS province_kode,
             prov.nama AS province_name,
             CONCAT_WS(' - ', kel.nama, kec.nama, kota.nama, prov.nama) AS full_display
         FROM
@@ -500,13 +617,100 @@ def fetch_all_wilayah_details() -> pd.DataFrame:
         st.warning(f"Gagal memuat data wilayah: {e}")
         pass
     return pd.DataFrame({
+        'village_kode': ['32.75.12.1001'],
         'village_name': ['MUSTIKA JAYA'],
+        'district_kode': ['32.75.12'],
         'district_name': ['MUSTIKA JAYA'],
+        'city_kode': ['32.75'],
         'city_name': ['KOTA BEKASI'],
+        'province_kode': ['32'],
         'province_name': ['JAWA BARAT'],
         'full_display': ['MUSTIKA JAYA - MUSTIKA JAYA - KOTA BEKASI - JAWA BARAT']
     })
 
+# ------------------------------------------------------------------------------
+# Index pencarian wilayah (typeahead Kelurahan/Desa)
+# ------------------------------------------------------------------------------
+def _normalize_text(s: str) -> str:
+    return " ".join(re.sub(r"[^0-9a-z]+", " ", str(s).lower()).split())
+
+def _trigrams(s: str) -> set[str]:
+    """Trigram gaya pg_trgm: tiap kata diberi padding '  kata ' sehingga awalan kata ikut terindeks."""
+    grams = set()
+    for word in s.split():
+        w = f"  {word} "
+        grams.update(w[i:i + 3] for i in range(len(w) - 2))
+    return grams
+
+class WilayahIndex:
+    """
+    Index trigram di memori atas full_display wilayah. search() mengembalikan
+    kandidat teratas tanpa mengirim seluruh daftar desa ke browser; lookup()
+    memetakan full_display ke (desa, kecamatan, kota, propinsi) dalam O(1).
+    children() melayani pemilih bertingkat propinsi -> kota -> kecamatan -> desa.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.displays = df["full_display"].astype(str).tolist()
+        self.hierarchy = dict(zip(
+            self.displays,
+            zip(df["village_name"], df["district_name"], df["city_name"], df["province_name"]),
+        ))
+        self.kodes = dict(zip(self.displays, zip(df["province_kode"], df["city_kode"], df["district_kode"])))
+        self.names = {}
+        self._children: dict[str | None, list[str]] = {}
+        levels = [("province_kode", "province_name", None), ("city_kode", "city_name", "province_kode"),
+                  ("district_kode", "district_name", "city_kode")]
+        for kode_col, name_col, parent_col in levels:
+            cols = [kode_col, name_col] + ([parent_col] if parent_col else [])
+            uniq = df[cols].drop_duplicates(kode_col).sort_values(name_col)
+            self.names.update(zip(uniq[kode_col], uniq[name_col]))
+            parents = uniq[parent_col] if parent_col else [None] * len(uniq)
+            for kode, parent in zip(uniq[kode_col], parents):
+                self._children.setdefault(parent, []).append(kode)
+        # Anak dari kecamatan adalah full_display desa (kunci lookup())
+        for display, district_kode in zip(self.displays, df["district_kode"]):
+            self._children.setdefault(district_kode, []).append(display)
+        self._norm_village = [_normalize_text(v) for v in df["village_name"]]
+        postings: dict[str, list[int]] = {}
+        for row, disp in enumerate(self.displays):
+            for g in _trigrams(_normalize_text(disp)):
+                postings.setdefault(g, []).append(row)
+        self._postings = {g: np.asarray(rows, dtype=np.int32) for g, rows in postings.items()}
+
+    def search(self, query: str, limit: int = 20) -> list[str]:
+        q = _normalize_text(query)
+        grams = _trigrams(q)
+        if len(q) < 3 or not grams:
+            return []
+        hits = [self._postings[g] for g in grams if g in self._postings]
+        if not hits:
+            return []
+        scores = np.bincount(np.concatenate(hits), minlength=len(self.displays))
+        # Minimal separuh trigram query harus cocok agar hasil tetap relevan
+        candidates = np.flatnonzero(scores >= max(1, (len(grams) + 1) // 2))
+        if candidates.size == 0:
+            return []
+        if candidates.size > limit * 5:
+            top = np.argpartition(-scores[candidates], limit * 5)[:limit * 5]
+            candidates = candidates[top]
+        ranked = sorted(
+            candidates.tolist(),
+            key=lambda r: (-int(scores[r]), not self._norm_village[r].startswith(q), self.displays[r]),
+        )
+        return [self.displays[r] for r in ranked[:limit]]
+
+    def lookup(self, display: str) -> tuple[str, str, str, str] | None:
+        return self.hierarchy.get(display)
+
+    def children(self, parent_kode: str | None) -> list[str]:
+        """Kode anak (propinsi bila parent None); untuk kecamatan: full_display desa."""
+        return self._children.get(parent_kode, [])
+
+@st.cache_resource(show_spinner="Menyiapkan index wilayah...")
+def get_wilayah_index() -> WilayahIndex:
+    return WilayahIndex(fetch_all_wilayah_details())
+
 @st.cache_data(show_spinner="Memuat data cabang HMHI...")
 def fetch_hmhi_branches() -> pd.DataFrame:
     try:
@@ -536,9 +740,176 @@ def fetch_hospitals() -> list[str]:
         pass
     return ["", "RSUPN Dr. Cipto Mangunkusumo - Jakarta Pusat - DKI Jakarta", "RS Kanker Dharmais - Jakarta Barat - DKI Jakarta"]
 
-@st.cache_data(show_spinner="Memuat daftar pasien...")
-def get_all_patients_for_selection(user_branch: str | None): 
-    return run_df_branch("SELECT id, full_name FROM pwh.patients ORDER BY full_name;")
+# ------------------------------------------------------------------------------
+# Index pencarian pasien per cabang
+# ------------------------------------------------------------------------------
+PATIENT_INDEX_QUERY = "SELECT id, full_name, nik, birth_date, cabang FROM pwh.patients ORDER BY full_name;"
+PATIENT_PAGE_SIZE = 50
+
+def _to_birth_date(x) -> date | None:
+    if x is None or pd.isna(x):
+        return None
+    return pd.to_datetime(x).date()
+
+def _parse_date_query(q: str) -> date | None:
+    for fmt in ("%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(q, fmt).date()
+        except ValueError:
+            pass
+    return None
+
+class PatientIndex:
+    """
+    Index pasien satu cabang di memori: nama ternormalisasi (trigram + daftar
+    terurut untuk awalan pendek), NIK (terurut, untuk awalan) dan tanggal lahir.
+    Dibangun sekali per cabang; upsert()/remove() dipanggil setelah penulisan
+    ke pwh.patients sehingga tidak perlu memuat ulang seluruh daftar.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self._lock = threading.Lock()
+        self.records: dict[int, tuple[str, str, date | None]] = {}
+        self._norm: dict[int, str] = {}
+        self._postings: dict[str, set[int]] = {}
+        self._by_birth: dict[date, set[int]] = {}
+        self._sorted: list[tuple[str, int]] = []
+        self._niks: list[tuple[str, int]] = []
+        for row in df.itertuples(index=False):
+            self._add(int(row.id), row.full_name, row.nik, row.birth_date, keep_sorted=False)
+        self._sorted.sort()
+        self._niks.sort()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, pid) -> bool:
+        return pid in self.records
+
+    def _add(self, pid: int, full_name, nik, birth_date, keep_sorted: bool = True):
+        name = "" if full_name is None or pd.isna(full_name) else str(full_name)
+        nik = "" if nik is None or pd.isna(nik) else str(nik).strip()
+        birth = _to_birth_date(birth_date)
+        norm = _normalize_text(name)
+        self.records[pid] = (name, nik, birth)
+        self._norm[pid] = norm
+        for g in _trigrams(norm):
+            self._postings.setdefault(g, set()).add(pid)
+        if birth:
+            self._by_birth.setdefault(birth, set()).add(pid)
+        insert = bisect.insort if keep_sorted else list.append
+        insert(self._sorted, (norm, pid))
+        if nik:
+            insert(self._niks, (nik, pid))
+
+    def _remove(self, pid: int):
+        name, nik, birth = self.records.pop(pid)
+        norm = self._norm.pop(pid)
+        for g in _trigrams(norm):
+            self._postings.get(g, set()).discard(pid)
+        if birth:
+            self._by_birth.get(birth, set()).discard(pid)
+        self._sorted.pop(bisect.bisect_left(self._sorted, (norm, pid)))
+        if nik:
+            self._niks.pop(bisect.bisect_left(self._niks, (nik, pid)))
+
+    def upsert(self, pid: int, full_name, nik, birth_date):
+        with self._lock:
+            if pid in self.records:
+                self._remove(pid)
+            self._add(pid, full_name, nik, birth_date)
+
+    def remove(self, pid: int):
+        with self._lock:
+            if pid in self.records:
+                self._remove(pid)
+
+    def name(self, pid) -> str | None:
+        rec = self.records.get(pid)
+        return rec[0] if rec else None
+
+    def page(self, offset: int, limit: int = PATIENT_PAGE_SIZE) -> list[int]:
+        """Id pasien urut nama untuk satu halaman."""
+        with self._lock:
+            return [pid for _, pid in self._sorted[offset:offset + limit]]
+
+    def search(self, query: str, limit: int = PATIENT_PAGE_SIZE) -> list[int]:
+        """Cari berdasarkan awalan NIK (angka), tanggal lahir, atau nama (awalan/trigram)."""
+        q = (query or "").strip()
+        if not q:
+            return []
+        with self._lock:
+            if q.isdigit() and len(q) >= 4:
+                start = bisect.bisect_left(self._niks, (q,))
+                hits = []
+                for nik, pid in self._niks[start:start + limit]:
+                    if not nik.startswith(q):
+                        break
+                    hits.append(pid)
+                return hits
+            birth = _parse_date_query(q)
+            if birth:
+                return sorted(self._by_birth.get(birth, ()), key=self._norm.get)[:limit]
+
+            norm = _normalize_text(q)
+            if len(norm) < 3:
+                start = bisect.bisect_left(self._sorted, (norm,))
+                hits = []
+                for name, pid in self._sorted[start:start + limit]:
+                    if not name.startswith(norm):
+                        break
+                    hits.append(pid)
+                return hits
+            grams = _trigrams(norm)
+            scores = Counter()
+            for g in grams:
+                scores.update(self._postings.get(g, ()))
+            min_score = max(1, (len(grams) + 1) // 2)
+            ranked = sorted(
+                (pid for pid, s in scores.items() if s >= min_score),
+                key=lambda pid: (not self._norm[pid].startswith(norm), norm not in self._norm[pid],
+                                 -scores[pid], self._norm[pid]),
+            )
+            return ranked[:limit]
+
+    def frame(self, ids: list[int]) -> pd.DataFrame:
+        rows = [(pid, *self.records[pid][::2]) for pid in ids if pid in self.records]
+        return pd.DataFrame(rows, columns=["id", "full_name", "birth_date"])
+
+@st.cache_resource(show_spinner=False)
+def _patient_index_registry() -> dict[str, PatientIndex]:
+    """Satu PatientIndex per cabang ("ALL" untuk admin), dibagi antar sesi."""
+    return {}
+
+def _patient_index_key(branch: str | None) -> str:
+    return branch if branch and branch != "ALL" else "ALL"
+
+def get_patient_index() -> PatientIndex:
+    """Index untuk cabang sesi ini; dibangun dari database saat pertama dipakai."""
+    key = _patient_index_key(st.session_state.get("user_branch", None))
+    registry = _patient_index_registry()
+    index = registry.get(key)
+    if index is None:
+        with st.spinner("Menyiapkan index pasien..."), section("Index pasien: build"):
+            index = PatientIndex(run_df_branch(PATIENT_INDEX_QUERY))
+        index = registry.setdefault(key, index)
+    return index
+
+def patient_index_upsert(pid: int, payload: dict):
+    """Terapkan penulisan satu pasien ke semua index cabang yang sudah dibangun."""
+    key = _patient_index_key(payload.get("cabang"))
+    for branch, index in list(_patient_index_registry().items()):
+        if branch in ("ALL", key):
+            index.upsert(int(pid), payload.get("full_name"), payload.get("nik"), payload.get("birth_date"))
+        else:
+            index.remove(int(pid))
+
+def invalidate_patient_index():
+    """Buang semua index pasien (mis. setelah import massal); dibangun ulang saat dipakai."""
+    _patient_index_registry().clear()
+
+if st.session_state.pop("_patient_index_stale", False):
+    invalidate_patient_index()
 
 # ------------------------------------------------------------------------------
 # Definisi Pilihan Statis & Dinamis
@@ -579,96 +950,249 @@ def _alias_df(df: pd.DataFrame, alias_map: dict) -> pd.DataFrame:
     if df is None or df.empty: return df
     return df.rename(columns={c: alias_map.get(c, c) for c in df.columns})
 
+# ------------------------------------------------------------------------------
+# Proyeksi bermasker untuk tabel tampilan
+# ------------------------------------------------------------------------------
+# Data pribadi pada tabel tampilan dimasker di SELECT: database hanya mengirim
+# '*****' (atau NULL bila kosong), nilai aslinya tidak ikut ke aplikasi.
+MASK_LITERAL = "'*****'"
+SUMMARY_MASKED_COLUMNS = {"Lahir: Tempat", "Lahir: Tanggal", "Alamat", "No. Telp", "Org Tua: Ayah", "Org Tua: Ibu"}
+
+def masked_col(expr: str, alias: str) -> str:
+    return f"CASE WHEN NULLIF(TRIM({expr}::text), '') IS NULL THEN NULL ELSE {MASK_LITERAL} END AS {alias}"
+
+@st.cache_data(show_spinner=False)
+def fetch_relation_columns(schema: str, name: str) -> list[str]:
+    q = """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = :schema AND table_name = :name
+        ORDER BY ordinal_position;
+    """
+    with engine.begin() as conn:
+        return [r[0] for r in conn.execute(text(q), {"schema": schema, "name": name})]
+
+def summary_masked_select(alias: str = "s") -> str:
+    """Daftar kolom pwh.patient_summary: kolom pribadi jadi '*****', umur dibulatkan ke int."""
+    parts = []
+    for col in fetch_relation_columns("pwh", "patient_summary"):
+        if col in SUMMARY_MASKED_COLUMNS:
+            parts.append(f'{MASK_LITERAL} AS "{col}"')
+        elif col == "Umur (tahun)":
+            parts.append(f'{alias}."{col}"::int AS "{col}"')
+        else:
+            parts.append(f'{alias}."{col}"')
+    return ", ".join(parts) or f"{alias}.*"
+
 # ------------------------------------------------------------------------------
 # Helper Functions (INSERT, UPDATE)
 # ------------------------------------------------------------------------------
-def insert_patient(payload: dict) -> int:
+# Setiap writer adalah satu pernyataan (INSERT ... ON CONFLICT / UPDATE dengan
+# CTE pengecekan duplikat) yang mengembalikan baris (id, created, conflict),
+# sehingga simpan selesai dalam satu round trip tanpa SELECT pengecekan terpisah.
+class WriteResult(NamedTuple):
+    """Hasil satu penulisan. conflict berisi kolom yang bentrok (mis. 'nik') bila gagal."""
+    id: int | None
+    created: bool = False
+    conflict: str | None = None
+    conflict_id: int | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.conflict is None
+
+# Nama constraint unik -> kolom yang dilaporkan sebagai conflict
+UNIQUE_CONSTRAINT_FIELDS = {"unique_nik": "nik"}
+
+def run_write(sql: str, params: dict, on_empty: str | None = "not_found", conn=None) -> WriteResult:
+    """conn: koneksi transaksi milik pemanggil (save_patient_bundle); tanpa conn commit sendiri."""
+    try:
+        with section("SQL: run_write"):
+            if conn is None:
+                with engine.begin() as own_conn:
+                    row = own_conn.execute(text(sql), params).mappings().first()
+            else:
+                row = conn.execute(text(sql), params).mappings().first()
+    except IntegrityError as e:
+        if getattr(e.orig, "pgcode", None) == "23505":
+            # Kalah balapan dengan sesi lain: constraint unik menolak setelah pengecekan di CTE
+            constraint = getattr(getattr(e.orig, "diag", None), "constraint_name", None) or "unique"
+            return WriteResult(None, conflict=UNIQUE_CONSTRAINT_FIELDS.get(constraint, constraint))
+        st.error(f"Gagal menyimpan data ke database: {e}")
+        st.stop()
+    if row is None:
+        return WriteResult(None, conflict=on_empty)
+    if row["conflict"]:
+        conflict_id = int(row["id"]) if row["id"] is not None else None
+        return WriteResult(None, conflict=row["conflict"], conflict_id=conflict_id)
+    return WriteResult(int(row["id"]), created=bool(row["created"]))
+
+def _session_branch() -> str | None:
+    branch = st.session_state.get("user_branch", None)
+    return branch if branch and branch != "ALL" else None
+
+def _job_owner() -> str:
+    """Pemilik pekerjaan latar belakang (panel 'Pekerjaan Saya' di main.py)."""
+    return st.session_state.get("username", "")
+
+PATIENT_COLUMNS = [
+    "full_name", "birth_place", "birth_date", "nik", "blood_group", "rhesus", "gender",
+    "occupation", "education", "address", "phone", "province", "city", "note",
+    "village", "district", "cabang", "kota_cakupan",
+]
+
+# Duplikat pasien: NIK unik global; nama unik (case-insensitive) di cabang sesi
+# (atau global untuk admin), sama seperti pengecekan lama lewat run_df_branch.
+PATIENT_DUP_CTE = """
+    dup AS (
+        SELECT id, CASE WHEN nik = :nik THEN 'nik' ELSE 'full_name' END AS conflict
+        FROM pwh.patients
+        WHERE id IS DISTINCT FROM :id
+          AND (nik = :nik
+               OR (:check_name AND lower(full_name) = lower(:full_name)
+                   AND (:name_branch IS NULL OR cabang = :name_branch)))
+        ORDER BY (nik = :nik) IS TRUE DESC
+        LIMIT 1
+    )
+"""
+
+def _patient_params(payload: dict, id: int | None, check_name: bool) -> dict:
     if payload.get('phone') and len(str(payload['phone'])) > 20:
         raw_phone = str(payload['phone'])
         if '/' in raw_phone:
             raw_phone = raw_phone.split('/')[0].strip()
         payload['phone'] = raw_phone[:20]
-
-    sql = """
-        INSERT INTO pwh.patients (
-            full_name, birth_place, birth_date, nik, blood_group, rhesus, gender, 
-            occupation, education, address, phone, province, city, note, 
-            village, district, cabang, kota_cakupan
-        ) VALUES (
-            :full_name, :birth_place, :birth_date, :nik, :blood_group, :rhesus, :gender, 
-            :occupation, :education, :address, :phone, :province, :city, :note, 
-            :village, :district, :cabang, :kota_cakupan
-        ) RETURNING id;
+    params = {c: payload.get(c) for c in PATIENT_COLUMNS}
+    params.update({"id": id, "check_name": check_name, "name_branch": _session_branch()})
+    return params
+
+def insert_patient(payload: dict, check_name: bool = True, conn=None) -> WriteResult:
+    cols = ", ".join(PATIENT_COLUMNS)
+    vals = ", ".join(f":{c}" for c in PATIENT_COLUMNS)
+    sql = f"""
+        WITH {PATIENT_DUP_CTE},
+        ins AS (
+            INSERT INTO pwh.patients ({cols})
+            SELECT {vals} WHERE NOT EXISTS (SELECT 1 FROM dup)
+            ON CONFLICT (nik) DO NOTHING
+            RETURNING id
+        )
+        SELECT id, TRUE AS created, NULL AS conflict FROM ins
+        UNION ALL
+        SELECT id, FALSE, conflict FROM dup;
     """
-    
-    try:
-        with engine.begin() as conn:
-            return int(conn.execute(text(sql), payload).scalar())
-            
-    except IntegrityError as e:
-        err_msg = str(e).lower()
-        if "unique_nik" in err_msg or "duplicate key" in err_msg:
-            print(f"NIK {payload['nik']} sudah ada, mengambil ID existing...")
-            
-            find_sql = "SELECT id FROM pwh.patients WHERE nik = :nik"
-            with engine.begin() as conn:
-                existing_id = conn.execute(text(find_sql), {"nik": payload["nik"]}).scalar()
-                
-                if existing_id:
-                    return int(existing_id)
-        
-        raise e
-
-def update_patient(id: int, payload: dict):
-    payload['id'] = id
-    sql = "UPDATE pwh.patients SET full_name=:full_name, birth_place=:birth_place, birth_date=:birth_date, nik=:nik, blood_group=:blood_group, rhesus=:rhesus, gender=:gender, occupation=:occupation, education=:education, address=:address, phone=:phone, province=:province, city=:city, note=:note, village=:village, district=:district, cabang=:cabang, kota_cakupan=:kota_cakupan WHERE id=:id;"
-    run_exec(sql, payload)
+    return run_write(sql, _patient_params(payload, None, check_name), on_empty="nik", conn=conn)
+
+def update_patient(id: int, payload: dict, check_name: bool = True, conn=None) -> WriteResult:
+    sets = ", ".join(f"{c}=:{c}" for c in PATIENT_COLUMNS)
+    sql = f"""
+        WITH {PATIENT_DUP_CTE},
+        upd AS (
+            UPDATE pwh.patients SET {sets}
+            WHERE id = :id AND NOT EXISTS (SELECT 1 FROM dup)
+            RETURNING id
+        )
+        SELECT id, FALSE AS created, NULL AS conflict FROM upd
+        UNION ALL
+        SELECT id, FALSE, conflict FROM dup;
+    """
+    return run_write(sql, _patient_params(payload, id, check_name), conn=conn)
 
-def insert_diagnosis(patient_id: int, hemo_type: str, severity: str, diagnosed_on: date | None, source: str | None):
-    sql = "INSERT INTO pwh.hemo_diagnoses (patient_id, hemo_type, severity, diagnosed_on, source) VALUES (:pid, :hemo_type, :severity, :diagnosed_on, :source) ON CONFLICT (patient_id, hemo_type) DO UPDATE SET severity = EXCLUDED.severity, diagnosed_on= COALESCE(EXCLUDED.diagnosed_on, pwh.hemo_diagnoses.diagnosed_on), source = COALESCE(EXCLUDED.source, pwh.hemo_diagnoses.source);"
-    run_exec(sql, {"pid": patient_id, "hemo_type": hemo_type, "severity": severity, "diagnosed_on": diagnosed_on, "source": (source or "").strip() or None})
+def insert_diagnosis(patient_id: int, hemo_type: str, severity: str, diagnosed_on: date | None, source: str | None,
+                     upsert: bool = True, conn=None) -> WriteResult:
+    """upsert=True (import) memperbarui diagnosis tipe yang sama; False melaporkan conflict 'hemo_type'."""
+    params = {"pid": patient_id, "hemo_type": hemo_type, "severity": severity, "diagnosed_on": diagnosed_on, "source": (source or "").strip() or None}
+    if upsert:
+        sql = """
+            INSERT INTO pwh.hemo_diagnoses (patient_id, hemo_type, severity, diagnosed_on, source)
+            VALUES (:pid, :hemo_type, :severity, :diagnosed_on, :source)
+            ON CONFLICT (patient_id, hemo_type) DO UPDATE SET severity = EXCLUDED.severity,
+                diagnosed_on = COALESCE(EXCLUDED.diagnosed_on, pwh.hemo_diagnoses.diagnosed_on),
+                source = COALESCE(EXCLUDED.source, pwh.hemo_diagnoses.source)
+            RETURNING id, (xmax = 0) AS created, NULL AS conflict;
+        """
+    else:
+        sql = """
+            WITH ins AS (
+                INSERT INTO pwh.hemo_diagnoses (patient_id, hemo_type, severity, diagnosed_on, source)
+                VALUES (:pid, :hemo_type, :severity, :diagnosed_on, :source)
+                ON CONFLICT (patient_id, hemo_type) DO NOTHING
+                RETURNING id
+            )
+            SELECT id, TRUE AS created, NULL AS conflict FROM ins
+            UNION ALL
+            SELECT id, FALSE, 'hemo_type' FROM pwh.hemo_diagnoses WHERE patient_id = :pid AND hemo_type = :hemo_type
+            LIMIT 1;
+        """
+    return run_write(sql, params, conn=conn)
 
-def update_diagnosis(id: int, payload: dict):
+def update_diagnosis(id: int, payload: dict, conn=None) -> WriteResult:
     payload['id'] = id
-    sql = "UPDATE pwh.hemo_diagnoses SET hemo_type=:hemo_type, severity=:severity, diagnosed_on=:diagnosed_on, source=:source WHERE id=:id;"
-    run_exec(sql, payload)
+    sql = """
+        WITH dup AS (
+            SELECT d.id FROM pwh.hemo_diagnoses d
+            JOIN pwh.hemo_diagnoses cur ON cur.id = :id AND d.patient_id = cur.patient_id
+            WHERE d.hemo_type = :hemo_type AND d.id <> :id
+        ), upd AS (
+            UPDATE pwh.hemo_diagnoses SET hemo_type=:hemo_type, severity=:severity, diagnosed_on=:diagnosed_on, source=:source
+            WHERE id = :id AND NOT EXISTS (SELECT 1 FROM dup)
+            RETURNING id
+        )
+        SELECT id, FALSE AS created, NULL AS conflict FROM upd
+        UNION ALL
+        SELECT id, FALSE, 'hemo_type' FROM dup;
+    """
+    return run_write(sql, payload, conn=conn)
 
-def insert_inhibitor(patient_id: int, factor: str, titer_bu: float | None, measured_on: date | None, lab: str | None):
-    sql = "INSERT INTO pwh.hemo_inhibitors (patient_id, factor, titer_bu, measured_on, lab) VALUES (:pid, :factor, :titer_bu, :measured_on, :lab);"
-    run_exec(sql, {"pid": patient_id, "factor": factor, "titer_bu": titer_bu, "measured_on": measured_on, "lab": (lab or "").strip() or None})
+def insert_inhibitor(patient_id: int, factor: str, titer_bu: float | None, measured_on: date | None, lab: str | None, conn=None) -> WriteResult:
+    sql = "INSERT INTO pwh.hemo_inhibitors (patient_id, factor, titer_bu, measured_on, lab) VALUES (:pid, :factor, :titer_bu, :measured_on, :lab) RETURNING id, TRUE AS created, NULL AS conflict;"
+    return run_write(sql, {"pid": patient_id, "factor": factor, "titer_bu": titer_bu, "measured_on": measured_on, "lab": (lab or "").strip() or None}, conn=conn)
 
-def update_inhibitor(id: int, payload: dict):
+def update_inhibitor(id: int, payload: dict, conn=None) -> WriteResult:
     payload['id'] = id
-    sql = "UPDATE pwh.hemo_inhibitors SET factor=:factor, titer_bu=:titer_bu, measured_on=:measured_on, lab=:lab WHERE id=:id;"
-    run_exec(sql, payload)
+    sql = "UPDATE pwh.hemo_inhibitors SET factor=:factor, titer_bu=:titer_bu, measured_on=:measured_on, lab=:lab WHERE id=:id RETURNING id, FALSE AS created, NULL AS conflict;"
+    return run_write(sql, payload, conn=conn)
 
-def insert_virus_test(patient_id: int, test_type: str, result: str, tested_on: date | None, lab: str | None):
-    sql = "INSERT INTO pwh.virus_tests (patient_id, test_type, result, tested_on, lab) VALUES (:pid, :test_type, :result, :tested_on, :lab) ON CONFLICT (patient_id, test_type, tested_on) DO NOTHING;"
-    run_exec(sql, {"pid": patient_id, "test_type": test_type, "result": result, "tested_on": tested_on, "lab": (lab or "").strip() or None})
+def insert_virus_test(patient_id: int, test_type: str, result: str, tested_on: date | None, lab: str | None, conn=None) -> WriteResult:
+    sql = """
+        WITH ins AS (
+            INSERT INTO pwh.virus_tests (patient_id, test_type, result, tested_on, lab)
+            VALUES (:pid, :test_type, :result, :tested_on, :lab)
+            ON CONFLICT (patient_id, test_type, tested_on) DO NOTHING
+            RETURNING id
+        )
+        SELECT id, TRUE AS created, NULL AS conflict FROM ins
+        UNION ALL
+        SELECT id, FALSE, 'tested_on' FROM pwh.virus_tests
+        WHERE patient_id = :pid AND test_type = :test_type AND tested_on IS NOT DISTINCT FROM :tested_on
+        LIMIT 1;
+    """
+    return run_write(sql, {"pid": patient_id, "test_type": test_type, "result": result, "tested_on": tested_on, "lab": (lab or "").strip() or None}, conn=conn)
 
-def update_virus_test(id: int, payload: dict):
+def update_virus_test(id: int, payload: dict, conn=None) -> WriteResult:
     payload['id'] = id
-    sql = "UPDATE pwh.virus_tests SET test_type=:test_type, result=:result, tested_on=:tested_on, lab=:lab WHERE id=:id;"
-    run_exec(sql, payload)
+    sql = "UPDATE pwh.virus_tests SET test_type=:test_type, result=:result, tested_on=:tested_on, lab=:lab WHERE id=:id RETURNING id, FALSE AS created, NULL AS conflict;"
+    return run_write(sql, payload, conn=conn)
 
-def insert_treatment_hospital(payload: dict):
+def insert_treatment_hospital(payload: dict, conn=None) -> WriteResult:
     sql = """
         INSERT INTO pwh.treatment_hospital 
         (patient_id, name_hospital, city_hospital, province_hospital, date_of_visit, doctor_in_charge, treatment_type, care_services, frequency, dose, product, merk) 
-        VALUES (:patient_id, :name_hospital, :city_hospital, :province_hospital, :date_of_visit, :doctor_in_charge, :treatment_type, :care_services, :frequency, :dose, :product, :merk);
+        VALUES (:patient_id, :name_hospital, :city_hospital, :province_hospital, :date_of_visit, :doctor_in_charge, :treatment_type, :care_services, :frequency, :dose, :product, :merk)
+        RETURNING id, TRUE AS created, NULL AS conflict;
     """
-    run_exec(sql, payload)
+    return run_write(sql, payload, conn=conn)
 
-def update_treatment_hospital(id: int, payload: dict):
+def update_treatment_hospital(id: int, payload: dict, conn=None) -> WriteResult:
     payload['id'] = id
     sql = """
         UPDATE pwh.treatment_hospital SET 
         name_hospital=:name_hospital, city_hospital=:city_hospital, province_hospital=:province_hospital, 
         date_of_visit=:date_of_visit, doctor_in_charge=:doctor_in_charge,
         treatment_type=:treatment_type, care_services=:care_services, frequency=:frequency, dose=:dose, product=:product, merk=:merk 
-        WHERE id=:id;
+        WHERE id=:id
+        RETURNING id, FALSE AS created, NULL AS conflict;
     """
-    run_exec(sql, payload)
+    return run_write(sql, payload, conn=conn)
 
 def delete_treatment_hospital(id: int):
     current_user_branch = st.session_state.get("user_branch", None)
@@ -814,31 +1338,104 @@ def delete_contact(id: int):
         sql = "DELETE FROM pwh.contacts WHERE id = :id"
         run_exec(sql, params)
 
-def insert_death_record(payload: dict):
-    sql = "INSERT INTO pwh.death (patient_id, cause_of_death, year_of_death) VALUES (:patient_id, :cause_of_death, :year_of_death) ON CONFLICT (patient_id) DO UPDATE SET cause_of_death = EXCLUDED.cause_of_death, year_of_death = EXCLUDED.year_of_death;"
-    run_exec(sql, payload)
+def insert_death_record(payload: dict, conn=None) -> WriteResult:
+    sql = "INSERT INTO pwh.death (patient_id, cause_of_death, year_of_death) VALUES (:patient_id, :cause_of_death, :year_of_death) ON CONFLICT (patient_id) DO UPDATE SET cause_of_death = EXCLUDED.cause_of_death, year_of_death = EXCLUDED.year_of_death RETURNING id, (xmax = 0) AS created, NULL AS conflict;"
+    return run_write(sql, payload, conn=conn)
 
-def update_death_record(id: int, payload: dict):
+def update_death_record(id: int, payload: dict, conn=None) -> WriteResult:
     payload['id'] = id
-    sql = "UPDATE pwh.death SET cause_of_death=:cause_of_death, year_of_death=:year_of_death WHERE id=:id;"
-    run_exec(sql, payload)
+    sql = "UPDATE pwh.death SET cause_of_death=:cause_of_death, year_of_death=:year_of_death WHERE id=:id RETURNING id, FALSE AS created, NULL AS conflict;"
+    return run_write(sql, payload, conn=conn)
 
-def insert_contact(patient_id: int, relation: str, name: str, phone: str | None, is_primary: bool):
-    sql = "INSERT INTO pwh.contacts (patient_id, relation, name, phone, is_primary) VALUES (:pid, :relation, :name, :phone, :is_primary);"
-    run_exec(sql, {"pid": patient_id, "relation": relation, "name": name.strip(), "phone": (phone or "").strip() or None, "is_primary": bool(is_primary)})
+def insert_contact(patient_id: int, relation: str, name: str, phone: str | None, is_primary: bool, conn=None) -> WriteResult:
+    sql = "INSERT INTO pwh.contacts (patient_id, relation, name, phone, is_primary) VALUES (:pid, :relation, :name, :phone, :is_primary) RETURNING id, TRUE AS created, NULL AS conflict;"
+    return run_write(sql, {"pid": patient_id, "relation": relation, "name": name.strip(), "phone": (phone or "").strip() or None, "is_primary": bool(is_primary)}, conn=conn)
 
-def update_contact(id: int, payload: dict):
+def update_contact(id: int, payload: dict, conn=None) -> WriteResult:
     payload['id'] = id
-    sql = "UPDATE pwh.contacts SET relation=:relation, name=:name, phone=:phone, is_primary=:is_primary WHERE id=:id;"
-    run_exec(sql, payload)
+    sql = "UPDATE pwh.contacts SET relation=:relation, name=:name, phone=:phone, is_primary=:is_primary WHERE id=:id RETURNING id, FALSE AS created, NULL AS conflict;"
+    return run_write(sql, payload, conn=conn)
 
 # ------------------------------------------------------------------------------
-# Import Bulk Excel (DIPERBAIKI)
+# Simpan pasien + data terkait dalam satu transaksi
 # ------------------------------------------------------------------------------
-def _to_bool(x):
-    s = str(x).strip().lower()
-    return s in ("true", "1", "yes", "ya", "y")
+HOSPITAL_COLUMNS = ["name_hospital", "city_hospital", "province_hospital", "date_of_visit", "doctor_in_charge",
+                    "treatment_type", "care_services", "frequency", "dose", "product", "merk"]
+
+# Nama bagian sama dengan nama sheet template bulk; writer(pid, row, conn, upsert)
+BUNDLE_WRITERS = {
+    "Diagnosa": lambda pid, r, conn, upsert: insert_diagnosis(
+        pid, r.get("hemo_type"), r.get("severity"), r.get("diagnosed_on"), r.get("source"), upsert=upsert, conn=conn),
+    "Inhibitor": lambda pid, r, conn, upsert: insert_inhibitor(
+        pid, r.get("factor"), r.get("titer_bu"), r.get("measured_on"), r.get("lab"), conn=conn),
+    "Virus Tes": lambda pid, r, conn, upsert: insert_virus_test(
+        pid, r.get("test_type"), r.get("result"), r.get("tested_on"), r.get("lab"), conn=conn),
+    "RS Penangan": lambda pid, r, conn, upsert: insert_treatment_hospital(
+        {**{c: r.get(c) for c in HOSPITAL_COLUMNS}, "patient_id": pid}, conn=conn),
+    "Kematian": lambda pid, r, conn, upsert: insert_death_record(
+        {"patient_id": pid, "cause_of_death": r.get("cause_of_death"), "year_of_death": r.get("year_of_death")}, conn=conn),
+    "Kontak": lambda pid, r, conn, upsert: insert_contact(
+        pid, r.get("relation"), r.get("name") or "", r.get("phone"), r.get("is_primary"), conn=conn),
+}
+
+class BundleResult(NamedTuple):
+    """patient_id & jumlah baris per bagian bila sukses; failed/result menunjuk bagian yang bentrok."""
+    patient_id: int | None
+    counts: dict
+    failed: str | None = None
+    result: WriteResult | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.failed is None
+
+class _BundleAbort(Exception):
+    def __init__(self, part: str, result: WriteResult):
+        super().__init__(f"{part}: {result.conflict}")
+        self.part, self.result = part, result
 
+def save_patient_bundle(patient: dict | None = None, patient_id: int | None = None,
+                        children: dict[str, list[dict]] | None = None) -> BundleResult:
+    """
+    Menyimpan pasien (baru bila patient_id kosong, diperbarui bila diisi) beserta
+    data terkait (children: nama bagian BUNDLE_WRITERS -> daftar baris) dalam satu
+    transaksi dan satu commit. Conflict apa pun membatalkan seluruh bundel.
+    Import bulk sengaja tidak memakai fungsi ini: bundel menulis per pasien
+    (beberapa round trip per pasien), sedangkan pwh_import.load_import menulis
+    seluruh chunk berbasis set (COPY ke staging + INSERT ... SELECT) dengan
+    semantik yang sama -- pasien per NIK, upsert diagnosis/kematian, dan baris
+    tidak valid dilaporkan tanpa membatalkan baris lain. Bundel tetap menjadi
+    jalur tulis untuk form & grid, yang menyimpan satu pasien per aksi.
+    """
+    counts = {}
+    try:
+        with section("SQL: save_patient_bundle"), engine.begin() as conn:
+            if patient is not None:
+                if patient_id is None:
+                    res = insert_patient(patient, conn=conn)
+                else:
+                    res = update_patient(patient_id, patient, conn=conn)
+                if not res.ok:
+                    raise _BundleAbort("Pasien", res)
+                patient_id = res.id
+                counts["Pasien"] = 1
+            if patient_id is None:
+                raise ValueError("save_patient_bundle membutuhkan patient atau patient_id.")
+
+            for part, rows in (children or {}).items():
+                writer = BUNDLE_WRITERS[part]
+                for i, row in enumerate(rows, start=1):
+                    res = writer(patient_id, row, conn, False)
+                    if not res.ok:
+                        raise _BundleAbort(f"{part} #{i}", res)
+                    counts[part] = counts.get(part, 0) + 1
+    except _BundleAbort as e:
+        return BundleResult(None, {}, e.part, e.result)
+    return BundleResult(patient_id, counts)
+
+# ------------------------------------------------------------------------------
+# Import Bulk Excel (DIPERBAIKI)
+# ------------------------------------------------------------------------------
 def _to_date(x):
     if x is None: return None
     try:
@@ -846,193 +1443,141 @@ def _to_date(x):
         return None if pd.isna(dt) else dt.date()
     except Exception: return None
 
-def _safe_str(x):
-    if pd.isna(x): return None
-    s = str(x).strip()
-    return s if s else None
-
-def import_bulk_excel(file) -> dict:
-    xl = pd.ExcelFile(file)
-    sheets = {name.lower(): name for name in xl.sheet_names}
-
-    def df_or_empty(key, cols, rename_map=None):
-        if key in sheets:
-            df = xl.parse(sheets[key])
-            df.columns = [c.strip() for c in df.columns]
-            if rename_map:
-                df = df.rename(columns=rename_map) 
-            for c in cols:
-                if c not in df.columns: df[c] = None
-            
-            df = df.dropna(how="all")
-            return df.where(pd.notnull(df), None)
-            
-        return pd.DataFrame(columns=cols)
-
-    MAP_PAT = {
-        "Nama Lengkap": "full_name", "Tempat Lahir": "birth_place", "Tanggal Lahir": "birth_date", "NIK": "nik",
-        "Gol. Darah": "blood_group", "Rhesus": "rhesus", "Jenis Kelamin": "gender", "Pekerjaan": "occupation",
-        "Pendidikan Terakhir": "education", "Alamat": "address", "No. Ponsel": "phone", "Propinsi": "province",
-        "Kabupaten/Kota": "city", "Kecamatan": "district", "Kelurahan/Desa": "village",
-        "HMHI Cabang": "cabang", "Kota Cakupan Cabang": "kota_cakupan",
-        "Catatan": "note"
-    }
-    MAP_DIAG = {
-        "Nama Lengkap": "full_name", "Jenis Hemofilia": "hemo_type", "Kategori": "severity",
-        "Tgl Diagnosis": "diagnosed_on", "Sumber": "source", "patient_id": "patient_id"
-    }
-    MAP_INH = {
-        "Nama Lengkap": "full_name", "Faktor": "factor", "Titer (BU)": "titer_bu",
-        "Tgl Ukur": "measured_on", "Lab": "lab", "patient_id": "patient_id"
-    }
-    MAP_VIRUS = {
-        "Nama Lengkap": "full_name", "Jenis Tes": "test_type", "Hasil": "result",
-        "Tgl Tes": "tested_on", "Lab": "lab", "patient_id": "patient_id"
-    }
-    MAP_HOSP = {
-        "Nama Lengkap": "full_name", "Nama RS": "name_hospital", "Kota RS": "city_hospital", "Provinsi RS": "province_hospital",
-        "Tanggal Kunjungan": "date_of_visit", "DPJP": "doctor_in_charge", "Jenis Penanganan": "treatment_type",
-        "Layanan Rawat": "care_services", "Frekuensi": "frequency", "Dosis": "dose", "Produk": "product",
-        "Merk": "merk", "patient_id": "patient_id"
-    }
-    MAP_DEATH = {
-        "Nama Lengkap": "full_name", "Penyebab Kematian": "cause_of_death", "Tahun Kematian": "year_of_death",
-        "patient_id": "patient_id"
-    }
-    MAP_CONTACT = {
-        "Nama Lengkap": "full_name", "Relasi": "relation", "Nama Kontak": "name", "No. Telp": "phone",
-        "Primary": "is_primary", "patient_id": "patient_id"
-    }
-
-    pat_cols_internal = ["full_name","birth_place","birth_date","nik","blood_group","rhesus","gender","occupation", "education", "address","phone","province","city","note", "village", "district", "cabang", "kota_cakupan"]
-    df_pat = df_or_empty("pasien", pat_cols_internal, MAP_PAT)
-    inserted_patients = []
-    
-    user_branch_bulk = st.session_state.get("user_branch", None)
-    is_admin_bulk = (user_branch_bulk == "ALL" or not user_branch_bulk)
-    df_hmhi_lookup = fetch_hmhi_branches() 
-    
-    for _, r in df_pat[df_pat["full_name"].notna()].iterrows():
-        raw_name = _safe_str(r.get("full_name"))
-        if not raw_name or raw_name.lower().startswith("catatan:"):
-            continue
+# Kolom enum yang divalidasi sebelum staging (nilai di luar daftar -> baris ditolak)
+IMPORT_ENUMS = {
+    ("Pasien", "blood_group"): BLOOD_GROUPS, ("Pasien", "rhesus"): RHESUS,
+    ("Pasien", "education"): EDUCATION_LEVELS,
+    ("Diagnosa", "hemo_type"): HEMO_TYPES, ("Diagnosa", "severity"): SEVERITIES,
+    ("Inhibitor", "factor"): INHIB_FACTORS,
+    ("Virus Tes", "test_type"): VIRUS_TESTS, ("Virus Tes", "result"): TEST_RESULTS,
+    ("Kontak", "relation"): RELATIONS,
+}
 
-        raw_nik = r.get("nik")
-        clean_nik = None
-        if pd.notna(raw_nik):
-            s_nik = str(raw_nik).strip()
-            if s_nik.endswith(".0"):
-                s_nik = s_nik[:-2] 
-            clean_nik = s_nik
-
-        payload = {
-            "full_name": raw_name, "birth_place": _safe_str(r.get("birth_place")),
-            "birth_date": _to_date(r.get("birth_date")), "nik": clean_nik,
-            "blood_group": _safe_str(r.get("blood_group")),
-            "rhesus": _safe_str(r.get("rhesus")), "gender": _safe_str(r.get("gender")),
-            "occupation": _safe_str(r.get("occupation")), "education": _safe_str(r.get("education")),
-            "address": _safe_str(r.get("address")), 
-            "phone": _safe_str(r.get("phone")), "province": _safe_str(r.get("province")), 
-            "city": _safe_str(r.get("city")), "note": _safe_str(r.get("note")),
-            "village": _safe_str(r.get("village")), "district": _safe_str(r.get("district")),
-            "cabang": _safe_str(r.get("cabang")), "kota_cakupan": _safe_str(r.get("kota_cakupan")) 
-        }
-        
-        if not is_admin_bulk and user_branch_bulk:
-            payload["cabang"] = user_branch_bulk
-            match_cabang = df_hmhi_lookup[df_hmhi_lookup['cabang'] == user_branch_bulk]
-            if not match_cabang.empty:
-                payload["kota_cakupan"] = match_cabang.iloc[0]['kota_cakupan'] or None
-            else:
-                payload["kota_cakupan"] = None 
-        
-        if not payload["full_name"]:
-            continue 
-            
-        nik_bulk = payload.get("nik")
-        if not nik_bulk:
-            st.error(f"Gagal impor '{payload['full_name']}': NIK wajib diisi.")
-            continue 
-
-        if len(nik_bulk) != 16:
-            st.error(f"Gagal impor '{payload['full_name']}': NIK '{nik_bulk}' harus 16 digit (memiliki {len(nik_bulk)} digit).")
-            continue 
-
-        pid = insert_patient(payload)
-        inserted_patients.append((pid, payload["full_name"]))
-
-    map_new = {name.lower(): pid for pid, name in inserted_patients}
-    df_all_pat = run_df_branch("SELECT id, full_name FROM pwh.patients")
-    map_db = {str(n).lower(): int(i) for i, n in zip(df_all_pat["id"], df_all_pat["full_name"])}
-
-    def _resolve_pid(row):
-        pid = row.get("patient_id")
-        if pd.notna(pid) and str(pid).strip():
-            try: return int(pid)
-            except Exception: pass
-        
-        nm_val = row.get("full_name")
-        safe_nm = _safe_str(nm_val)
-        if not safe_nm: 
-            return None
-            
-        nm = safe_nm.lower() 
-        if nm: return map_new.get(nm) or map_db.get(nm)
-        return None
+# File di bawah ukuran ini diparse di proses Streamlit; di atasnya tiap sheet
+# diparse paralel di process pool (biaya start worker tidak sebanding untuk file kecil).
+IMPORT_POOL_MIN_BYTES = 1_000_000
 
-    results = {"Pasien": len(inserted_patients)}
-    sheet_configs = {
-        "Diagnosa": ("diagnosa", 
-                       ["patient_id","full_name","hemo_type","severity","diagnosed_on","source"], 
-                       MAP_DIAG, 
-                       lambda r, pid: insert_diagnosis(pid, _safe_str(r.get("hemo_type")), _safe_str(r.get("severity")), _to_date(r.get("diagnosed_on")), _safe_str(r.get("source")))),
-        "Inhibitor": ("inhibitor",
-                       ["patient_id","full_name","factor","titer_bu","measured_on","lab"],
-                       MAP_INH,
-                       lambda r, pid: insert_inhibitor(pid, _safe_str(r.get("factor")), pd.to_numeric(r.get("titer_bu"), errors='coerce'), _to_date(r.get("measured_on")), _safe_str(r.get("lab")))),
-        "Virus Tes": ("virus tes",
-                       ["patient_id","full_name","test_type","result","tested_on","lab"],
-                       MAP_VIRUS,
-                       lambda r, pid: insert_virus_test(pid, _safe_str(r.get("test_type")), _safe_str(r.get("result")), _to_date(r.get("tested_on")), _safe_str(r.get("lab")))),
-        "RS Penangan": ("rs penangan",
-                         ["patient_id", "full_name", "name_hospital", "city_hospital", "province_hospital", "date_of_visit", "doctor_in_charge", "treatment_type", "care_services", "frequency", "dose", "product", "merk"],
-                         MAP_HOSP,
-                         lambda r, pid: insert_treatment_hospital({
-                             "patient_id": pid, "name_hospital": _safe_str(r.get("name_hospital")), "city_hospital": _safe_str(r.get("city_hospital")), "province_hospital": _safe_str(r.get("province_hospital")),
-                             "date_of_visit": _to_date(r.get("date_of_visit")), "doctor_in_charge": _safe_str(r.get("doctor_in_charge")),
-                             "treatment_type": _safe_str(r.get("treatment_type")), "care_services": _safe_str(r.get("care_services")), "frequency": _safe_str(r.get("frequency")), "dose": _safe_str(r.get("dose")),
-                             "product": _safe_str(r.get("product")), "merk": _safe_str(r.get("merk"))
-                         })
-                        ),
-        "Kematian": ("kematian",
-                       ["patient_id", "full_name", "cause_of_death", "year_of_death"],
-                       MAP_DEATH,
-                       lambda r, pid: insert_death_record({
-                           "patient_id": pid,
-                           "cause_of_death": _safe_str(r.get("cause_of_death")),
-                           "year_of_death": pd.to_numeric(r.get("year_of_death"), errors='coerce')
-                       })
-                     ),
-        "Kontak": ("kontak",
-                       ["patient_id","full_name","relation","name","phone","is_primary"],
-                       MAP_CONTACT,
-                       lambda r, pid: insert_contact(pid, _safe_str(r.get("relation")), _safe_str(r.get("name")), _safe_str(r.get("phone")), _to_bool(r.get("is_primary")))),
-    }
+@st.cache_resource(show_spinner=False)
+def get_import_executor() -> ProcessPoolExecutor | None:
+    """Process pool bersama untuk parsing sheet import (spawn: aman dari thread Streamlit)."""
+    cpus = os.cpu_count() or 1
+    if cpus < 2:
+        return None  # satu core: paralel hanya menambah biaya start worker
+    workers = min(len(IMPORT_SHEETS), cpus)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+def _tracked(parsed, step):
+    """Meneruskan hasil iter_parsed_sheets sambil memajukan progress bar."""
+    for item in parsed:
+        step(f"Sheet {item[0]} selesai dibaca")
+        yield item
+
+def run_bulk_import(ctx: JobContext, path: str, file_hash: str, file_name: str | None, branch: str | None,
+                    kota_cakupan: str | None, executor: ProcessPoolExecutor | None, dry_run: bool = False) -> str:
+    """
+    Pekerjaan import (thread pool pwh_jobs, tanpa st.*). Import berbasis set
+    (lihat pwh_import): sheet dibaca streaming (openpyxl read-only, atau
+    CSV/Parquet dari ZIP) dan divalidasi per chunk, paralel per sheet untuk file
+    besar, lalu di-COPY ke staging dan ditulis dengan INSERT ... SELECT. Dengan
+    ledger import (sql/003_import_ledger.sql) tiap chunk di-commit sendiri,
+    sehingga unggah ulang file yang sama setelah timeout melanjutkan dari baris
+    yang belum tersimpan. Baris yang tidak valid tidak ditulis dan dikembalikan
+    di ImportReport.errors (ctx.job.result); file hasil di ctx.path adalah
+    laporan error (.csv) atau, untuk dry run, workbook beranotasi.
+
+    dry_run: validasi penuh (termasuk rujukan pasien ke database) tanpa menulis.
+    """
+    n_steps = 2 * len(IMPORT_SHEETS)
+    done = 0
 
-    for key, (sheet_name_lowercase, internal_cols, reverse_map, insert_func) in sheet_configs.items():
-        df_sheet = df_or_empty(sheet_name_lowercase, internal_cols, reverse_map)
-        count = 0
-        for _, r in df_sheet.iterrows():
-            pid = _resolve_pid(r)
-            if pid:
-                try:
-                    insert_func(r, pid)
-                    count += 1
-                except Exception as e:
-                    pass
-        results[key] = count 
+    def step(label: str):
+        nonlocal done
+        done += 1
+        ctx.progress(done / n_steps, label)
 
-    return results
+    parsed = []
+    try:
+        ctx.progress(0.0, "Membaca workbook...")
+        frames, errors = {}, []
+        with engine.connect() as conn:
+            limits = column_limits(conn)
+        # Chunk hasil parse ada di file sementara (SpooledChunks), dibaca satu per satu saat load
+        try:
+            parsed.extend(_tracked(iter_parsed_sheets(path, IMPORT_ENUMS, executor, limits), step))
+        except BrokenProcessPool:
+            get_import_executor.clear()
+            for _, chunks, _ in parsed:
+                chunks.remove()
+            parsed.clear()
+            parsed.extend(_tracked(iter_parsed_sheets(path, IMPORT_ENUMS, limits=limits), step))
+        for part, chunks, err in parsed:
+            frames[part] = chunks
+            # User cabang: pasien baru selalu masuk cabang user, kolom 'HMHI Cabang' diabaikan
+            if branch and part == "Pasien":
+                frames[part] = (c.assign(cabang=branch, kota_cakupan=kota_cakupan) for c in chunks)
+            errors.append(err)
+
+        verb = "Memeriksa" if dry_run else "Menyimpan"
+        report = load_import(engine, frames, branch, progress=lambda part: step(f"{verb} {part}..."),
+                             dry_run=dry_run, file_hash=file_hash, file_name=file_name)
+        errors = concat_errors(errors + [report.errors])
+        if dry_run:
+            ctx.progress(1.0, "Menyusun workbook beranotasi...")
+            build_annotated_workbook(path, ctx.path, errors, report.counts)
+        elif not errors.empty:
+            errors.to_csv(ctx.path, index=False)
+    finally:
+        os.unlink(path)
+        for _, chunks, _ in parsed:
+            chunks.remove()
+    ctx.job.result = report._replace(errors=errors)
+    summary = ", ".join(f"{k}: {v}" for k, v in report.counts.items()) or "tidak ada baris"
+    return f"{'Siap di-import' if dry_run else 'Tersimpan'} — {summary}; {len(errors)} masalah."
+
+def submit_bulk_import(file, dry_run: bool = False) -> Job:
+    """Menyimpan file unggahan ke disk lalu menjadwalkan run_bulk_import sebagai pekerjaan latar belakang."""
+    suffix = os.path.splitext(getattr(file, "name", ""))[1].lower() or ".xlsx"
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+        tmp.write(file.getbuffer())
+        path = tmp.name
+    file_hash = hashlib.sha256(file.getbuffer()).hexdigest()
+
+    # Nilai sesi & cache Streamlit diambil di thread script, bukan di thread pekerjaan
+    branch = _session_branch()
+    kota_cakupan = None
+    if branch:
+        df_hmhi_lookup = fetch_hmhi_branches()
+        match_cabang = df_hmhi_lookup[df_hmhi_lookup['cabang'] == branch]
+        kota_cakupan = (match_cabang.iloc[0]['kota_cakupan'] or None) if not match_cabang.empty else None
+    executor = get_import_executor() if os.path.getsize(path) >= IMPORT_POOL_MIN_BYTES else None
+
+    name = getattr(file, "name", None)
+    if dry_run:
+        label, out_name, mime = f"Validasi import {name}", "pwh_import_validasi.xlsx", EXPORT_FORMATS["xlsx"][2]
+    else:
+        label, out_name, mime = f"Import {name}", "pwh_import_error.csv", "text/csv"
+    return jobs_runner().submit(
+        _job_owner(), "import", label,
+        lambda ctx: run_bulk_import(ctx, path, file_hash, name, branch, kota_cakupan, executor, dry_run),
+        file_name=out_name, mime=mime)
+
+def apply_finished_import_jobs():
+    """Setelah import latar belakang selesai: cache referensi & data tab dimuat ulang (sekali per sesi)."""
+    applied = st.session_state.setdefault("_import_jobs_applied", set())
+    for job in jobs_runner().jobs_for(_job_owner()):
+        if job.kind != "import" or job.status != JOB_DONE or job.id in applied:
+            continue
+        applied.add(job.id)
+        report = job.result
+        if report is None or report.dry_run:
+            continue
+        fetch_all_wilayah_details.clear()
+        invalidate_patient_index()
+        fetch_occupations_list.clear()
+        fetch_hospitals.clear()
+        fetch_hmhi_branches.clear()
+        fetch_patient_provinces.clear()
+        invalidate_fragment()
 
 # ------------------------------------------------------------------------------
 # Fungsi Helper untuk UI
@@ -1080,6 +1625,492 @@ def set_editing_state(state_key, data_id, table_name):
         if state_key in st.session_state:
             del st.session_state[state_key]
 
+def pick_wilayah_bertingkat(index: WilayahIndex, default_display: str = "") -> str:
+    """Pemilih bertingkat propinsi -> kab/kota -> kecamatan -> kelurahan/desa. Mengembalikan full_display desa."""
+    default_kodes = index.kodes.get(default_display, (None, None, None))
+    cols = st.columns(4)
+    parent, enabled = None, True
+    for col, label, default in zip(cols[:3], ["Propinsi", "Kabupaten/Kota", "Kecamatan"], default_kodes):
+        opts = [None] + (index.children(parent) if enabled else [])
+        with col:
+            parent = st.selectbox(
+                label, opts, index=get_safe_index(opts, default),
+                format_func=lambda k: index.names.get(k, "") if k else "", disabled=not enabled,
+            )
+        enabled = parent is not None
+    opts = [""] + (index.children(parent) if enabled else [])
+    with cols[3]:
+        return st.selectbox(
+            "Kelurahan/Desa", opts, index=get_safe_index(opts, default_display),
+            format_func=lambda d: index.lookup(d)[0] if d else "", disabled=not enabled,
+        )
+
+def pick_patient(key: str, default_id=None, disabled: bool = False,
+                 label: str = "Pilih Pasien (untuk data baru)"):
+    """
+    Pemilih pasien berhalaman: tanpa kata kunci menampilkan satu halaman urut nama,
+    dengan kata kunci (nama / NIK / tgl lahir) menampilkan hasil teratas dari index.
+    """
+    index = get_patient_index()
+    c_query, c_page = st.columns([3, 1])
+    with c_query:
+        query = st.text_input("Cari pasien (nama / NIK / tgl lahir)", key=f"{key}_query", disabled=disabled)
+    with section("Opsi selectbox: pasien"):
+        if query.strip():
+            ids = index.search(query)
+            with c_page:
+                st.caption(f"{len(ids)} hasil teratas")
+        else:
+            n_pages = max(1, -(-len(index) // PATIENT_PAGE_SIZE))
+            with c_page:
+                page = st.number_input(f"Halaman (dari {n_pages})", min_value=1, max_value=n_pages,
+                                       value=1, key=f"{key}_page", disabled=disabled)
+            ids = index.page((int(page) - 1) * PATIENT_PAGE_SIZE)
+        options = [None] + ids
+        if default_id is not None and default_id not in ids:
+            options.insert(1, int(default_id))
+    return st.selectbox(label, options, index=get_safe_index(options, default_id),
+                        format_func=format_patient_name, key=key, disabled=disabled)
+
+def _split_hospital(selection: str) -> tuple[str, str | None, str | None]:
+    parts = selection.split(' - ')
+    return (parts[0].strip(), parts[1].strip(), parts[2].strip()) if len(parts) == 3 else (selection, None, None)
+
+def render_bundle_editors() -> tuple[dict[str, list[dict]], list[str]]:
+    """
+    Grid data terkait untuk pasien baru, disimpan bersama pasien lewat
+    save_patient_bundle. Mengembalikan (children, pesan baris yang belum lengkap).
+    """
+    cc = st.column_config
+    specs = {  # bagian -> (label tab, {kolom: (column_config, dtype)}, kolom wajib)
+        "Diagnosa": ("🧬 Diagnosis", {
+            "hemo_type": (cc.SelectboxColumn("Tipe Hemofilia*", options=[h for h in HEMO_TYPES if h]), "object"),
+            "severity": (cc.SelectboxColumn("Kategori*", options=[s for s in SEVERITY_CHOICES if s]), "object"),
+            "diagnosed_on": (cc.DateColumn("Tgl Diagnosis", format="YYYY-MM-DD"), "datetime64[ns]"),
+            "source": (cc.TextColumn("Sumber"), "object"),
+        }, ["hemo_type", "severity"]),
+        "Inhibitor": ("🧪 Inhibitor", {
+            "factor": (cc.SelectboxColumn("Faktor*", options=INHIB_FACTORS), "object"),
+            "titer_bu": (cc.NumberColumn("Titer (BU)*", min_value=0.0, step=0.1), "float64"),
+            "measured_on": (cc.DateColumn("Tgl Ukur", format="YYYY-MM-DD"), "datetime64[ns]"),
+            "lab": (cc.TextColumn("Lab"), "object"),
+        }, ["factor", "titer_bu"]),
+        "Virus Tes": ("🧫 Virus Tests", {
+            "test_type": (cc.SelectboxColumn("Jenis Tes*", options=VIRUS_TESTS), "object"),
+            "result": (cc.SelectboxColumn("Hasil*", options=TEST_RESULTS), "object"),
+            "tested_on": (cc.DateColumn("Tgl Tes", format="YYYY-MM-DD"), "datetime64[ns]"),
+            "lab": (cc.TextColumn("Lab"), "object"),
+        }, ["test_type", "result"]),
+        "RS Penangan": ("🏥 Rumah Sakit", {
+            "hospital": (cc.SelectboxColumn("Rumah Sakit*", options=[h for h in fetch_hospitals() if h]), "object"),
+            "date_of_visit": (cc.DateColumn("Tgl Kunjungan", format="YYYY-MM-DD"), "datetime64[ns]"),
+            "doctor_in_charge": (cc.TextColumn("DPJP"), "object"),
+            "treatment_type": (cc.SelectboxColumn("Jenis Penanganan", options=TREATMENT_TYPES[1:]), "object"),
+            "care_services": (cc.SelectboxColumn("Layanan Rawat", options=CARE_SERVICES[1:]), "object"),
+            "product": (cc.SelectboxColumn("Produk", options=PRODUCTS[1:]), "object"),
+        }, ["hospital"]),
+        "Kontak": ("👨‍👩‍👧 Kontak", {
+            "relation": (cc.SelectboxColumn("Relasi*", options=RELATIONS), "object"),
+            "name": (cc.TextColumn("Nama Kontak*"), "object"),
+            "phone": (cc.TextColumn("No. Telp"), "object"),
+            "is_primary": (cc.CheckboxColumn("Utama"), "bool"),
+        }, ["relation", "name"]),
+    }
+
+    children, problems = {}, []
+    tabs = st.tabs([label for label, _, _ in specs.values()])
+    for tab, (part, (label, columns, required)) in zip(tabs, specs.items()):
+        with tab:
+            empty = pd.DataFrame({c: pd.Series(dtype=dtype) for c, (_, dtype) in columns.items()})
+            edited = st.data_editor(
+                empty, num_rows="dynamic", hide_index=True, use_container_width=True, key=f"bundle_{part}",
+                column_config={c: cfg for c, (cfg, _) in columns.items()},
+            )
+        rows = []
+        for i, rec in enumerate(edited.to_dict("records"), start=1):
+            rec = {k: (None if v is None or v == "" or (not isinstance(v, bool) and pd.isna(v)) else v) for k, v in rec.items()}
+            if all(v in (None, False) for v in rec.values()):
+                continue
+            missing = [columns[c][0]["label"].rstrip("*") for c in required if rec.get(c) is None]
+            if missing:
+                problems.append(f"{label} baris {i}: {', '.join(missing)} wajib diisi.")
+                continue
+            for c, (_, dtype) in columns.items():
+                if dtype.startswith("datetime"):
+                    rec[c] = _to_date(rec[c])
+            if part == "RS Penangan":
+                rec["name_hospital"], rec["city_hospital"], rec["province_hospital"] = _split_hospital(rec.pop("hospital"))
+            if part == "Kontak":
+                rec["is_primary"] = bool(rec.get("is_primary"))
+            rows.append(rec)
+        if rows:
+            children[part] = rows
+    return children, problems
+
+# ------------------------------------------------------------------------------
+# Data per-fragment
+# ------------------------------------------------------------------------------
+# Setiap tab adalah st.fragment: interaksi di satu tab hanya menjalankan ulang
+# tab itu. Tabel daftar tiap tab disimpan di session state per scope, sehingga
+# rerun fragment tidak meng-query ulang; simpan/hapus membuang scope terkait.
+# Full rerun (top-level script dijalankan) selalu mengambil data baru.
+
+def fragment_df(scope: str, query: str, params: dict | None = None) -> pd.DataFrame:
+    """run_df_branch yang di-cache per scope fragment selama query & params sama."""
+    store = st.session_state.setdefault("_fragment_data", {})
+    key = (query, tuple(sorted((params or {}).items())))
+    cached = store.get(scope)
+    if cached is None or cached[0] != key:
+        cached = (key, run_df_branch(query, dict(params or {})))
+        store[scope] = cached
+    return cached[1]
+
+def invalidate_fragment(*scopes: str):
+    """Membuang cache data fragment; tanpa argumen membuang semuanya."""
+    store = st.session_state.get("_fragment_data", {})
+    if not scopes:
+        store.clear()
+    for scope in scopes:
+        store.pop(scope, None)
+        store.pop(f"{scope}__count", None)
+
+# ------------------------------------------------------------------------------
+# Tabel berhalaman (keyset pagination)
+# ------------------------------------------------------------------------------
+# Setiap daftar diambil per halaman dengan kunci (kolom urut, id) > kunci baris
+# terakhir halaman sebelumnya, bukan OFFSET, sehingga halaman ke-N sama murahnya
+# dengan halaman pertama (lihat sql/002_keyset_indexes.sql). Urutan & filter
+# dijalankan di SQL; total baris memakai perkiraan planner (EXPLAIN) alih-alih
+# count(*) atas seluruh tabel.
+PAGE_SIZES = [25, 50, 100, 200]
+PAGE_FILTER_ALL = "(Semua)"
+NAME_SORT = {"Nama pasien (A-Z)": ("p.full_name", False)}
+
+
+class TablePage(NamedTuple):
+    """Satu halaman daftar beserta posisi & perkiraan total barisnya."""
+    df: pd.DataFrame
+    offset: int
+    approx_total: int
+    has_next: bool
+
+    @property
+    def index(self) -> range:
+        """Nomor baris (No.) yang melanjutkan halaman sebelumnya."""
+        return range(self.offset + 1, self.offset + len(self.df) + 1)
+
+    @property
+    def total_label(self) -> str:
+        if self.offset == 0 and not self.has_next:
+            return str(len(self.df))  # semua baris muat di satu halaman: angka pasti
+        return f"±{max(self.approx_total, self.offset + len(self.df))}"
+
+
+def _py_value(v):
+    """Nilai numpy -> tipe Python agar bisa dipakai sebagai parameter query."""
+    return v.item() if isinstance(v, np.generic) else v
+
+
+def _where_sql(conditions: list[str]) -> str:
+    return " WHERE " + " AND ".join(f"({c})" for c in conditions) if conditions else ""
+
+
+def approx_count(scope: str, from_sql: str, where_sql: str, params: dict) -> int:
+    """Perkiraan jumlah baris dari rencana query (EXPLAIN), tanpa memindai tabel."""
+    try:
+        plan = fragment_df(f"{scope}__count", f"EXPLAIN (FORMAT JSON) SELECT 1 FROM {from_sql}{where_sql}", params)
+        doc = plan.iloc[0, 0]
+        if isinstance(doc, str):
+            doc = json.loads(doc)
+        return int(doc[0]["Plan"]["Plan Rows"])
+    except Exception:
+        return 0
+
+
+def paged_table(scope: str, select: str, from_sql: str, id_col: str,
+                conditions: list[str] | None = None, params: dict | None = None,
+                sort_options: dict | None = None, filters: dict | None = None,
+                name_filter: bool = False) -> TablePage:
+    """
+    Menampilkan kontrol urut/filter/navigasi lalu mengambil satu halaman daftar.
+
+    select      : daftar kolom (tanpa kata SELECT); harus memuat kolom `id`.
+    from_sql    : tabel & join (tanpa kata FROM), alias pasien wajib `p`.
+    id_col      : kolom id unik pemecah seri urutan, mis. "d.id".
+    conditions  : kondisi WHERE tambahan, digabung dengan AND.
+    sort_options: {label: (ekspresi SQL tidak-NULL, descending)}; urutan nama
+                  pasien selalu tersedia sebagai pilihan pertama.
+    filters     : {label: (ekspresi SQL, pilihan)} -> selectbox "= nilai".
+    name_filter : tampilkan kotak filter nama/NIK/tgl lahir (via index pasien).
+    """
+    conditions = list(conditions or [])
+    params = dict(params or {})
+    sort_options = {**NAME_SORT, **(sort_options or {})}
+    filters = filters or {}
+
+    cols = st.columns([2, 1] + [2] * (len(filters) + int(name_filter)))
+    sort_label = cols[0].selectbox("Urutkan", list(sort_options), key=f"pg_{scope}_sort")
+    page_size = cols[1].selectbox("Baris/halaman", PAGE_SIZES, index=1, key=f"pg_{scope}_size")
+    for i, (label, (expr, choices)) in enumerate(filters.items()):
+        value = cols[2 + i].selectbox(label, [PAGE_FILTER_ALL] + [c for c in choices if c], key=f"pg_{scope}_f{i}")
+        if value != PAGE_FILTER_ALL:
+            conditions.append(f"{expr} = :_pf{i}")
+            params[f"_pf{i}"] = value
+    if name_filter:
+        q = cols[-1].text_input("Filter nama / NIK / tgl lahir", key=f"pg_{scope}_q")
+        if q.strip():
+            conditions.append("p.id = ANY(:_pq_ids)")
+            params["_pq_ids"] = get_patient_index().search(q, limit=1000)
+
+    # Kursor direset setiap kali query, filter, urutan, atau ukuran halaman berubah
+    sort_expr, descending = sort_options[sort_label]
+    signature = (select, from_sql, tuple(conditions), repr(sorted(params.items())), sort_label, page_size)
+    state = st.session_state.setdefault(f"_pager_{scope}", {"sig": None, "cursors": [None]})
+    if state["sig"] != signature:
+        state["sig"] = signature
+        state["cursors"] = [None]
+
+    # Setiap kondisi diberi kurung: run_df_branch menyisipkan "p.cabang = :branch AND"
+    # tepat setelah WHERE pertama.
+    where_sql = _where_sql(conditions)
+    page_where, page_params = list(conditions), dict(params)
+    cursor = state["cursors"][-1]
+    if cursor is not None:
+        page_where.append(f"({sort_expr}, {id_col}) {'<' if descending else '>'} (:_k_sort, :_k_id)")
+        page_params.update(_k_sort=cursor[0], _k_id=cursor[1])
+    page_where_sql = _where_sql(page_where)
+    direction = "DESC" if descending else "ASC"
+
+    # Ambil satu baris ekstra untuk mengetahui apakah masih ada halaman berikutnya
+    df = fragment_df(scope, f"""
+        SELECT {select}, {sort_expr} AS _sort_key
+        FROM {from_sql}{page_where_sql}
+        ORDER BY {sort_expr} {direction}, {id_col} {direction}
+        LIMIT {page_size + 1};
+    """, page_params)
+    has_next = len(df) > page_size
+    next_cursor = None
+    if has_next:
+        last = df.iloc[page_size - 1]
+        next_cursor = (_py_value(last["_sort_key"]), _py_value(last["id"]))
+    df = df.iloc[:page_size].drop(columns="_sort_key")
+
+    page_no = len(state["cursors"])
+    page = TablePage(df, (page_no - 1) * page_size, approx_count(scope, from_sql, where_sql, params), has_next)
+
+    c_prev, c_info, c_next = st.columns([1, 3, 1])
+    c_prev.button("◀ Sebelumnya", key=f"pg_{scope}_prev", disabled=page_no == 1,
+                  on_click=state["cursors"].pop)
+    c_next.button("Berikutnya ▶", key=f"pg_{scope}_next", disabled=not has_next,
+                  on_click=state["cursors"].append, args=(next_cursor,))
+    if not df.empty:
+        c_info.caption(f"Halaman {page_no} · baris {page.offset + 1}–{page.offset + len(df)} dari {page.total_label}")
+    return page
+
+# ------------------------------------------------------------------------------
+# Edit grid (st.data_editor) dengan penulisan batch berbasis diff
+# ------------------------------------------------------------------------------
+# Perubahan grid diambil dari delta data_editor (edited/added/deleted rows) lalu
+# ditulis batch per jenis (UPDATE executemany, INSERT executemany, DELETE ... =
+# ANY(:ids)) dalam satu transaksi. Lingkup cabang sama dengan delete_*: tabel anak
+# di-join ke pwh.patients dan dibatasi p.cabang = :branch untuk user non-admin.
+# Sebelum menulis, baris yang diubah/dihapus dikunci dengan satu SELECT ... FOR
+# UPDATE; id yang tidak kembali (di luar cabang / sudah dihapus) membatalkan grid.
+
+def _grid_columns(scope: str) -> dict:
+    cc = st.column_config
+    date_col = lambda label: cc.DateColumn(label, format="YYYY-MM-DD")
+    return {
+        "pasien": {
+            "blood_group": cc.SelectboxColumn("Gol. Darah", options=[b for b in BLOOD_GROUPS if b]),
+            "rhesus": cc.SelectboxColumn("Rhesus", options=[r for r in RHESUS if r]),
+            "gender": cc.SelectboxColumn("Jenis Kelamin", options=[g for g in GENDERS if g]),
+            "occupation": cc.SelectboxColumn("Pekerjaan", options=[o for o in fetch_occupations_list() if o]),
+            "education": cc.SelectboxColumn("Pendidikan Terakhir", options=[e for e in EDUCATION_LEVELS if e]),
+            "address": cc.TextColumn("Alamat"),
+        },
+        "diag": {
+            "hemo_type": cc.SelectboxColumn("Jenis Hemofilia", options=[h for h in HEMO_TYPES if h], required=True),
+            "severity": cc.SelectboxColumn("Kategori", options=[s for s in SEVERITY_CHOICES if s], required=True),
+            "diagnosed_on": date_col("Tgl Diagnosis"),
+            "source": cc.TextColumn("Sumber"),
+        },
+        "inh": {
+            "factor": cc.SelectboxColumn("Faktor", options=INHIB_FACTORS, required=True),
+            "titer_bu": cc.NumberColumn("Titer (BU)", min_value=0.0, step=0.1, required=True),
+            "measured_on": date_col("Tgl Ukur"),
+            "lab": cc.TextColumn("Lab"),
+        },
+        "virus": {
+            "test_type": cc.SelectboxColumn("Jenis Tes", options=VIRUS_TESTS, required=True),
+            "result": cc.SelectboxColumn("Hasil", options=TEST_RESULTS, required=True),
+            "tested_on": date_col("Tgl Tes"),
+            "lab": cc.TextColumn("Lab"),
+        },
+        "hosp": {
+            "name_hospital": cc.TextColumn("Nama RS", required=True),
+            "city_hospital": cc.TextColumn("Kota RS"),
+            "province_hospital": cc.TextColumn("Provinsi RS"),
+            "date_of_visit": date_col("Tanggal Kunjungan"),
+            "doctor_in_charge": cc.TextColumn("DPJP"),
+            "treatment_type": cc.SelectboxColumn("Jenis Penanganan", options=TREATMENT_TYPES[1:]),
+            "care_services": cc.SelectboxColumn("Layanan Rawat", options=CARE_SERVICES[1:]),
+            "frequency": cc.TextColumn("Frekuensi"),
+            "dose": cc.TextColumn("Dosis"),
+            "product": cc.SelectboxColumn("Produk", options=PRODUCTS[1:]),
+            "merk": cc.TextColumn("Merk"),
+        },
+        "death": {
+            "cause_of_death": cc.TextColumn("Penyebab Kematian"),
+            "year_of_death": cc.NumberColumn("Tahun Kematian", min_value=1900, max_value=date.today().year, step=1, format="%d"),
+        },
+        "kontak": {
+            "relation": cc.SelectboxColumn("Relasi", options=RELATIONS, required=True),
+            "name": cc.TextColumn("Nama Kontak", required=True),
+            "phone": cc.TextColumn("No. Telp"),
+            "is_primary": cc.CheckboxColumn("Primary"),
+        },
+    }[scope]
+
+# scope -> (tabel, boleh tambah/hapus baris, scope fragment lain yang ikut basi)
+GRID_TABLES = {
+    "pasien": ("pwh.patients", False, ()),
+    "diag": ("pwh.hemo_diagnoses", True, ("ringkasan",)),
+    "inh": ("pwh.hemo_inhibitors", True, ("ringkasan",)),
+    "virus": ("pwh.virus_tests", True, ("ringkasan",)),
+    "hosp": ("pwh.treatment_hospital", True, ()),
+    "death": ("pwh.death", True, ()),
+    "kontak": ("pwh.contacts", True, ("ringkasan",)),
+}
+GRID_DATE_COLUMNS = {"diagnosed_on", "measured_on", "tested_on", "date_of_visit"}
+
+def _grid_value(col: str, v):
+    if v is None or (not isinstance(v, (bool, list)) and pd.isna(v)) or v == "":
+        return None
+    if col in GRID_DATE_COLUMNS:
+        return _to_date(v)
+    if col == "year_of_death":
+        return int(v)
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+def apply_grid_changes(scope: str, df: pd.DataFrame, delta: dict, new_patient_id: int | None = None) -> dict:
+    """
+    Menulis delta data_editor ke tabel scope dalam satu transaksi; mengembalikan
+    jumlah baris yang benar-benar ditulis per aksi. Baris di luar cabang user atau
+    yang sudah dihapus sesi lain membatalkan seluruh transaksi (ValueError).
+    """
+    table, _, _ = GRID_TABLES[scope]
+    cols = list(_grid_columns(scope))
+    branch = _session_branch()
+    is_patients = table == "pwh.patients"
+
+    sets = ", ".join(f"{c} = :{c}" for c in cols)
+    if is_patients:
+        sql_update = f"UPDATE pwh.patients t SET {sets} WHERE t.id = :id"
+        if branch:
+            sql_update += " AND t.cabang = :branch"
+    else:
+        sql_update = f"UPDATE {table} t SET {sets} FROM pwh.patients p WHERE t.patient_id = p.id AND t.id = :id"
+        sql_delete = f"DELETE FROM {table} t USING pwh.patients p WHERE t.patient_id = p.id AND t.id = :id"
+        sql_insert = (f"INSERT INTO {table} (patient_id, {', '.join(cols)}) "
+                      f"SELECT p.id, {', '.join(':' + c for c in cols)} FROM pwh.patients p WHERE p.id = :patient_id")
+        if branch:
+            sql_update += " AND p.cabang = :branch"
+            sql_delete += " AND p.cabang = :branch"
+            sql_insert += " AND p.cabang = :branch"
+
+    updates = []
+    for pos, changes in delta.get("edited_rows", {}).items():
+        row = df.iloc[int(pos)]
+        params = {c: _grid_value(c, changes.get(c, row[c])) for c in cols}
+        params.update({"id": int(row["id"]), "branch": branch})
+        updates.append(params)
+    deletes = [{"id": int(df.iloc[int(pos)]["id"]), "branch": branch} for pos in delta.get("deleted_rows", [])]
+    inserts = []
+    for added in delta.get("added_rows", []):
+        if not any(_grid_value(c, added.get(c)) not in (None, False) for c in cols):
+            continue
+        if new_patient_id is None:
+            raise ValueError("Pilih pasien terlebih dahulu untuk baris baru pada grid.")
+        params = {c: _grid_value(c, added.get(c)) for c in cols}
+        params.update({"patient_id": int(new_patient_id), "branch": branch})
+        inserts.append(params)
+
+    if is_patients:
+        sql_lock = "SELECT t.id FROM pwh.patients t WHERE t.id = ANY(:ids)"
+        if branch:
+            sql_lock += " AND t.cabang = :branch"
+    else:
+        sql_lock = f"SELECT t.id FROM {table} t JOIN pwh.patients p ON p.id = t.patient_id WHERE t.id = ANY(:ids)"
+        sql_patient = "SELECT p.id FROM pwh.patients p WHERE p.id = :patient_id"
+        if branch:
+            sql_lock += " AND p.cabang = :branch"
+            sql_patient += " AND p.cabang = :branch"
+        sql_delete = sql_delete.replace("t.id = :id", "t.id = ANY(:ids)")
+
+    requested = [p["id"] for p in updates] + [p["id"] for p in deletes]
+    with section(f"SQL: grid {scope}"), engine.begin() as conn:
+        missing = []
+        if requested:
+            found = set(conn.execute(text(sql_lock + " FOR UPDATE OF t"),
+                                     {"ids": requested, "branch": branch}).scalars())
+            missing += sorted({i for i in requested if i not in found})
+        if inserts and conn.execute(text(sql_patient + " FOR KEY SHARE"),
+                                    {"patient_id": int(new_patient_id), "branch": branch}).first() is None:
+            missing.append(f"pasien {new_patient_id}")
+        if missing:
+            # Raise di dalam engine.begin(): belum ada yang ditulis, transaksi di-rollback
+            raise ValueError("Perubahan grid dibatalkan (tidak ada yang disimpan): data tidak ditemukan "
+                             f"di cabang Anda atau sudah dihapus (ID {', '.join(map(str, missing))}).")
+        # Baris sudah terkunci: setiap statement batch di bawah pasti mengenai barisnya
+        if deletes:
+            conn.execute(text(sql_delete), {"ids": [p["id"] for p in deletes], "branch": branch})
+        if updates:
+            conn.execute(text(sql_update), updates)
+        if inserts:
+            conn.execute(text(sql_insert), inserts)
+    return {"diubah": len(updates), "ditambah": len(inserts), "dihapus": len(deletes)}
+
+def grid_mode(scope: str) -> bool:
+    return st.toggle("✏️ Edit sebagai grid", key=f"grid_mode_{scope}",
+                     help="Ubah, tambah, dan hapus banyak baris sekaligus lalu simpan dalam satu transaksi.")
+
+def render_grid_editor(scope: str, df: pd.DataFrame, new_patient_id: int | None = None):
+    table, dynamic, related = GRID_TABLES[scope]
+    columns = _grid_columns(scope)
+    editor_key = f"grid_{scope}"
+    base = df.reset_index(drop=True)
+    view = base[["full_name"] + list(columns)]
+    if dynamic:
+        target = format_patient_name(new_patient_id) if new_patient_id else "belum dipilih"
+        st.caption(f"Baris baru ditambahkan untuk pasien yang dipilih di atas: **{target}**.")
+    st.data_editor(
+        view, key=editor_key, hide_index=True, use_container_width=True,
+        num_rows="dynamic" if dynamic else "fixed", disabled=["full_name"],
+        column_config={"full_name": st.column_config.TextColumn("Nama Lengkap"), **columns},
+    )
+    delta = st.session_state.get(editor_key, {})
+    n_changes = len(delta.get("edited_rows", {})) + len(delta.get("added_rows", [])) + len(delta.get("deleted_rows", []))
+    if st.button(f"💾 Simpan Perubahan Grid ({n_changes})", key=f"{editor_key}_save", disabled=not n_changes):
+        try:
+            counts = apply_grid_changes(scope, base, delta, new_patient_id)
+        except ValueError as e:
+            st.error(str(e))
+            return
+        except (IntegrityError, DataError) as e:
+            st.error(f"Perubahan grid dibatalkan (tidak ada yang disimpan): {e.orig}")
+            return
+        st.success("Grid disimpan — " + ", ".join(f"{k}: {v}" for k, v in counts.items()))
+        clear_session_state(editor_key)
+        if scope in ("pasien", "death"):
+            # Data pasien & status meninggal dipakai semua tab
+            invalidate_fragment()
+            st.rerun()
+        invalidate_fragment(scope, *related)
+        st.rerun(scope="fragment")
+
 # ------------------------------------------------------------------------------
 # TABS (Form Input)
 # ------------------------------------------------------------------------------
@@ -1096,1266 +2127,1458 @@ TAB_MAP = {
     "Export": "⬇️ Export"
 }
 
-tab_pat, tab_diag, tab_inh, tab_virus, tab_hospital, tab_death, tab_contacts, tab_view, tab_export = st.tabs(list(TAB_MAP.values()))
+# Mode bagian (default): hanya bagian yang dipilih yang dijalankan, termasuk
+# query dan tabelnya. Mode tab lama menjalankan kesembilan tab setiap rerun.
+nav_sections = st.toggle(
+    "⚡ Muat hanya bagian aktif", value=True, key="input_nav_sections",
+    help="Matikan untuk kembali ke tampilan tab (semua tab dimuat setiap kali).",
+)
+if nav_sections:
+    active_section = st.radio(
+        "Bagian", list(TAB_MAP.keys()), format_func=TAB_MAP.get,
+        horizontal=True, key="input_section", label_visibility="collapsed",
+    )
+else:
+    tab_containers = dict(zip(TAB_MAP.keys(), st.tabs(list(TAB_MAP.values()))))
+
+# Kode top-level hanya berjalan saat full rerun: data fragment dimuat ulang.
+invalidate_fragment()
 
 
 # ==============================================================================
 # --- Blok Kode Umum untuk Semua Tab ---
 # ==============================================================================
 
-current_user_branch_for_cache = st.session_state.get("user_branch", None)
-
-df_all_patients = get_all_patients_for_selection(current_user_branch_for_cache)
-if not df_all_patients.empty:
-    patient_id_map = df_all_patients.set_index('id')['full_name'].to_dict()
-    patient_id_options = [None] + df_all_patients['id'].tolist()
-else:
-    patient_id_map = {}
-    patient_id_options = [None]
-
 def format_patient_name(patient_id):
     if pd.isna(patient_id):
         return "Pilih pasien..."
-    return patient_id_map.get(patient_id, "ID tidak ditemukan")
-
-# --- TAMBAHAN BARU: Fungsi untuk highlight warna merah pasien meninggal ---
-df_deceased_global = run_df_branch("SELECT patient_id FROM pwh.death")
-deceased_ids_global = df_deceased_global['patient_id'].tolist() if not df_deceased_global.empty else []
-
-def style_deceased_row(df_display, orig_df, id_col):
-    """Mewarnai baris menjadi merah jika pasien terdata meninggal."""
-    if orig_df.empty or df_display.empty:
+    return get_patient_index().name(patient_id) or "ID tidak ditemukan"
+
+# --- Highlight merah pasien meninggal ---
+# Status meninggal dihitung di query daftar (kolom is_deceased lewat
+# DECEASED_JOIN); pewarnaan memakai satu mask vektor, bukan callback per baris.
+DECEASED_JOIN = " LEFT JOIN pwh.death death_flag ON death_flag.patient_id = p.id"
+DECEASED_COL = "(death_flag.patient_id IS NOT NULL) AS is_deceased"
+DECEASED_CSS = "background-color: #ffcccc; color: #900000;"
+
+def style_deceased_row(df_display, deceased):
+    """Mewarnai baris menjadi merah jika pasien terdata meninggal (deceased: kolom is_deceased)."""
+    mask = np.asarray(deceased, dtype=bool)
+    if df_display.empty or not mask.any():
         return df_display
-    
-    # Buat mask per baris sesuai tabel awal (karena index bisa di-reset)
-    mask = orig_df[id_col].isin(deceased_ids_global).values
-    mask_series = pd.Series(mask, index=df_display.index)
-    
-    def highlight(row):
-        if mask_series.loc[row.name]:
-            return ['background-color: #ffcccc; color: #900000;'] * len(row)
-        return [''] * len(row)
-        
-    return df_display.style.apply(highlight, axis=1)
-# --- END TAMBAHAN BARU ---
+    css = np.broadcast_to(np.where(mask[:, None], DECEASED_CSS, ""), df_display.shape)
+    styles = pd.DataFrame(css, index=df_display.index, columns=df_display.columns)
+    return df_display.style.apply(lambda _: styles, axis=None)
+# --- END ---
 
 # Patient
-if tab_pat:
-    with tab_pat:
-        st.subheader("🧑‍⚕️ Tambah Data Pasien")
+@st.fragment
+def render_tab_pasien():
+    st.subheader("🧑‍⚕️ Tambah Data Pasien")
 
-        pat_data = st.session_state.get('patient_to_edit', {})
+    pat_data = st.session_state.get('patient_to_edit', {})
 
-        if pat_data:
-            st.info(f"Mode Edit untuk Pasien: {pat_data.get('full_name')} (ID: {pat_data.get('id')})")
-            if st.button("❌ Batal Edit", key="cancel_pat_edit"):
-                clear_session_state('patient_to_edit')
-                clear_session_state('patient_matches') 
-                st.rerun()
+    if pat_data:
+        st.info(f"Mode Edit untuk Pasien: {pat_data.get('full_name')} (ID: {pat_data.get('id')})")
+        if st.button("❌ Batal Edit", key="cancel_pat_edit"):
+            clear_session_state('patient_to_edit')
+            clear_session_state('patient_matches') 
+            st.rerun(scope="fragment")
 
-        df_wilayah_all = fetch_all_wilayah_details()
-        df_hmhi = fetch_hmhi_branches() 
-        occupations_list = fetch_occupations_list()
-        
-        user_branch_form = st.session_state.get("user_branch", None)
-        is_admin_form = (user_branch_form == "ALL" or not user_branch_form)
-
-        with st.container(border=True):
-            full_name = st.text_input("Nama Lengkap*", value=pat_data.get('full_name', ''))
-
-            c1, c2, c3 = st.columns(3)
-            with c1: birth_place = st.text_input("Tempat Lahir*", value=pat_data.get('birth_place', ''))
-            with c2:
-                birth_date_val = pd.to_datetime(pat_data.get('birth_date')).date() if pd.notna(pat_data.get('birth_date')) else None
-                birth_date = st.date_input("Tanggal Lahir*", value=birth_date_val, format="YYYY-MM-DD", min_value=date(1920, 1, 1), max_value=date.today())
-            with c3:
-                nik = st.text_input("NIK*", value=pat_data.get('nik', ''), max_chars=16)
-
-            c_pekerjaan, c_pendidikan = st.columns(2)
-            with c_pekerjaan:
-                occupation_idx = get_safe_index(occupations_list, pat_data.get('occupation'))
-                occupation = st.selectbox("Pekerjaan", occupations_list, index=occupation_idx)
-            with c_pendidikan:
-                education_idx = get_safe_index(EDUCATION_LEVELS, pat_data.get('education'))
-                education = st.selectbox("Pendidikan Terakhir", EDUCATION_LEVELS, index=education_idx)
-
-            c5, c6, c7, c8 = st.columns(4)
-            with c5:
-                blood_group_idx = get_safe_index(BLOOD_GROUPS, pat_data.get('blood_group'))
-                blood_group = st.selectbox("Golongan Darah", BLOOD_GROUPS, index=blood_group_idx)
-            with c6:
-                rhesus_idx = get_safe_index(RHESUS, pat_data.get('rhesus'))
-                rhesus = st.selectbox("Rhesus", RHESUS, index=rhesus_idx)
-            with c7:
-                gender_idx = get_safe_index(GENDERS, pat_data.get('gender'))
-                gender = st.selectbox("Jenis Kelamin", GENDERS, index=gender_idx)
-            with c8:
-                phone = st.text_input("No. Ponsel", max_chars=50, value=pat_data.get('phone', ''))
-
-            address = st.text_area("Alamat", value=pat_data.get('address', ''))
-
-            village_list = [""] + df_wilayah_all['full_display'].tolist()
-            village_name, district_name, city_name, province_name = "", "", "", ""
-            village_display_val = ""
-            if pat_data:
-                v = pat_data.get('village')
-                d = pat_data.get('district')
-                c = pat_data.get('city')
-                p = pat_data.get('province')
-                if v and d and c and p:
-                    village_display_val = f"{v} - {d} - {c} - {p}"
-                if not village_display_val:
-                    village_name = v or ""
-                    district_name = d or ""
-                    city_name = c or ""
-                    province_name = p or ""
+    wilayah_index = get_wilayah_index()
+    df_hmhi = fetch_hmhi_branches() 
+    occupations_list = fetch_occupations_list()
+
+    user_branch_form = st.session_state.get("user_branch", None)
+    is_admin_form = (user_branch_form == "ALL" or not user_branch_form)
 
+    with st.container(border=True):
+        full_name = st.text_input("Nama Lengkap*", value=pat_data.get('full_name', ''))
+
+        c1, c2, c3 = st.columns(3)
+        with c1: birth_place = st.text_input("Tempat Lahir*", value=pat_data.get('birth_place', ''))
+        with c2:
+            birth_date_val = pd.to_datetime(pat_data.get('birth_date')).date() if pd.notna(pat_data.get('birth_date')) else None
+            birth_date = st.date_input("Tanggal Lahir*", value=birth_date_val, format="YYYY-MM-DD", min_value=date(1920, 1, 1), max_value=date.today())
+        with c3:
+            nik = st.text_input("NIK*", value=pat_data.get('nik', ''), max_chars=16)
+
+        c_pekerjaan, c_pendidikan = st.columns(2)
+        with c_pekerjaan:
+            occupation_idx = get_safe_index(occupations_list, pat_data.get('occupation'))
+            occupation = st.selectbox("Pekerjaan", occupations_list, index=occupation_idx)
+        with c_pendidikan:
+            education_idx = get_safe_index(EDUCATION_LEVELS, pat_data.get('education'))
+            education = st.selectbox("Pendidikan Terakhir", EDUCATION_LEVELS, index=education_idx)
+
+        c5, c6, c7, c8 = st.columns(4)
+        with c5:
+            blood_group_idx = get_safe_index(BLOOD_GROUPS, pat_data.get('blood_group'))
+            blood_group = st.selectbox("Golongan Darah", BLOOD_GROUPS, index=blood_group_idx)
+        with c6:
+            rhesus_idx = get_safe_index(RHESUS, pat_data.get('rhesus'))
+            rhesus = st.selectbox("Rhesus", RHESUS, index=rhesus_idx)
+        with c7:
+            gender_idx = get_safe_index(GENDERS, pat_data.get('gender'))
+            gender = st.selectbox("Jenis Kelamin", GENDERS, index=gender_idx)
+        with c8:
+            phone = st.text_input("No. Ponsel", max_chars=50, value=pat_data.get('phone', ''))
+
+        address = st.text_area("Alamat", value=pat_data.get('address', ''))
+
+        village_name, district_name, city_name, province_name = "", "", "", ""
+        village_display_val = ""
+        if pat_data:
+            v = pat_data.get('village')
+            d = pat_data.get('district')
+            c = pat_data.get('city')
+            p = pat_data.get('province')
+            if v and d and c and p:
+                village_display_val = f"{v} - {d} - {c} - {p}"
+            if not village_display_val:
+                village_name = v or ""
+                district_name = d or ""
+                city_name = c or ""
+                province_name = p or ""
+
+        wilayah_mode = st.radio(
+            "Cara memilih wilayah", ["🔎 Cari", "🗂️ Bertingkat"],
+            horizontal=True, key="pat_wilayah_mode",
+        )
+        if wilayah_mode == "🔎 Cari":
+            # Hanya kandidat teratas yang dikirim ke browser, bukan seluruh desa se-Indonesia
+            village_query = st.text_input(
+                "Cari Kelurahan/Desa",
+                key="pat_village_query",
+                placeholder="Ketik minimal 3 huruf (nama desa, kecamatan, atau kota), lalu Enter",
+            )
+            with section("Opsi selectbox: wilayah"):
+                village_list = [""] + ([village_display_val] if village_display_val else [])
+                village_list += [m for m in wilayah_index.search(village_query) if m != village_display_val]
             village_idx = get_safe_index(village_list, village_display_val)
+            if village_query and len(village_list) == 1:
+                st.caption("Tidak ada kelurahan/desa yang cocok.")
+        else:
+            with section("Opsi selectbox: wilayah"):
+                selected_village_display = pick_wilayah_bertingkat(wilayah_index, village_display_val)
 
-            col_vil, col_dis = st.columns(2)
-            with col_vil:
+        col_vil, col_dis = st.columns(2)
+        with col_vil:
+            if wilayah_mode == "🔎 Cari":
                 selected_village_display = st.selectbox(
                     "Kelurahan/Desa (pilih ini untuk autofill)", 
                     village_list,
                     index=village_idx
                 )
-            
-            if selected_village_display:
-                match = df_wilayah_all[df_wilayah_all['full_display'] == selected_village_display]
-                if not match.empty:
-                    village_name = match.iloc[0]['village_name']
-                    district_name = match.iloc[0]['district_name']
-                    city_name = match.iloc[0]['city_name']
-                    province_name = match.iloc[0]['province_name']
-
-            with col_dis:
-                st.text_input("Kecamatan (otomatis)", value=district_name, disabled=True)
-            
-            col_city, col_prov = st.columns(2)
-            with col_city:
-                st.text_input("Kabupaten/Kota (otomatis)", value=city_name, disabled=True)
-            with col_prov:
-                st.text_input("Propinsi (otomatis)", value=province_name, disabled=True)
-            
-            st.markdown("---") 
-            
-            cabang_list = [""] + df_hmhi['cabang'].unique().tolist()
-            kota_cakupan_val = ""
-
-            default_cabang = ""
-            if pat_data:
-                default_cabang = pat_data.get('cabang') or ""
-            elif not is_admin_form and user_branch_form:
-                default_cabang = user_branch_form
-
-            cabang_idx = get_safe_index(cabang_list, default_cabang)
-
-            col_cabang, col_cakupan = st.columns(2)
-            with col_cabang:
-                selected_cabang = st.selectbox(
-                    "HMHI Cabang",
-                    cabang_list,
-                    index=cabang_idx,
-                    disabled=(not is_admin_form) 
-                )
+            else:
+                st.text_input("Kelurahan/Desa (terpilih)", value=selected_village_display, disabled=True)
 
-            active_cabang = user_branch_form if not is_admin_form and user_branch_form else selected_cabang
-            
-            if active_cabang:
-                match_cabang = df_hmhi[df_hmhi['cabang'] == active_cabang]
-                if not match_cabang.empty:
-                    kota_cakupan_val = match_cabang.iloc[0]['kota_cakupan'] or ""
-            elif pat_data and not active_cabang: 
-                 kota_cakupan_val = pat_data.get('kota_cakupan', '')
-            
-            with col_cakupan:
-                st.text_input("Kota Cakupan Cabang (otomatis)", value=kota_cakupan_val, disabled=True)
+        if selected_village_display:
+            hierarchy = wilayah_index.lookup(selected_village_display)
+            if hierarchy:
+                village_name, district_name, city_name, province_name = hierarchy
 
-            note = st.text_area("Catatan (opsional)", value=pat_data.get('note', ''))
+        with col_dis:
+            st.text_input("Kecamatan (otomatis)", value=district_name, disabled=True)
 
-            form_label = "💾 Perbarui Pasien" if pat_data else "💾 Simpan Pasien Baru"
-            submitted = st.button(form_label, type="primary")
+        col_city, col_prov = st.columns(2)
+        with col_city:
+            st.text_input("Kabupaten/Kota (otomatis)", value=city_name, disabled=True)
+        with col_prov:
+            st.text_input("Propinsi (otomatis)", value=province_name, disabled=True)
 
-        if submitted:
-            nik_cleaned = (nik or "").strip()
-            
-            if not (full_name or "").strip():
-                st.error("Nama Lengkap wajib diisi.")
-            elif not (birth_place or "").strip():
-                st.error("Tempat Lahir wajib diisi.")
-            elif not birth_date:
-                st.error("Tanggal Lahir wajib diisi.")
-            elif not nik_cleaned:
-                st.error("NIK wajib diisi.")
-            elif len(nik_cleaned) != 16:
-                st.error(f"NIK harus terdiri dari 16 digit. NIK yang Anda masukkan ({nik_cleaned}) memiliki {len(nik_cleaned)} digit.")
+        st.markdown("---") 
+
+        cabang_list = [""] + df_hmhi['cabang'].unique().tolist()
+        kota_cakupan_val = ""
+
+        default_cabang = ""
+        if pat_data:
+            default_cabang = pat_data.get('cabang') or ""
+        elif not is_admin_form and user_branch_form:
+            default_cabang = user_branch_form
+
+        cabang_idx = get_safe_index(cabang_list, default_cabang)
+
+        col_cabang, col_cakupan = st.columns(2)
+        with col_cabang:
+            selected_cabang = st.selectbox(
+                "HMHI Cabang",
+                cabang_list,
+                index=cabang_idx,
+                disabled=(not is_admin_form) 
+            )
+
+        active_cabang = user_branch_form if not is_admin_form and user_branch_form else selected_cabang
+
+        if active_cabang:
+            match_cabang = df_hmhi[df_hmhi['cabang'] == active_cabang]
+            if not match_cabang.empty:
+                kota_cakupan_val = match_cabang.iloc[0]['kota_cakupan'] or ""
+        elif pat_data and not active_cabang: 
+             kota_cakupan_val = pat_data.get('kota_cakupan', '')
+
+        with col_cakupan:
+            st.text_input("Kota Cakupan Cabang (otomatis)", value=kota_cakupan_val, disabled=True)
+
+        note = st.text_area("Catatan (opsional)", value=pat_data.get('note', ''))
+
+        bundle_children, bundle_problems = {}, []
+        if not pat_data:
+            with st.expander("➕ Data terkait (opsional) — disimpan bersama pasien dalam satu transaksi"):
+                bundle_children, bundle_problems = render_bundle_editors()
+
+        form_label = "💾 Perbarui Pasien" if pat_data else "💾 Simpan Pasien Baru"
+        submitted = st.button(form_label, type="primary")
+
+    if submitted:
+        nik_cleaned = (nik or "").strip()
+
+        if not (full_name or "").strip():
+            st.error("Nama Lengkap wajib diisi.")
+        elif not (birth_place or "").strip():
+            st.error("Tempat Lahir wajib diisi.")
+        elif not birth_date:
+            st.error("Tanggal Lahir wajib diisi.")
+        elif not nik_cleaned:
+            st.error("NIK wajib diisi.")
+        elif len(nik_cleaned) != 16:
+            st.error(f"NIK harus terdiri dari 16 digit. NIK yang Anda masukkan ({nik_cleaned}) memiliki {len(nik_cleaned)} digit.")
+        else:
+            payload = {
+                "full_name": full_name.strip(), "birth_place": (birth_place or "").strip() or None,
+                "birth_date": birth_date, "nik": nik_cleaned, 
+                "blood_group": blood_group or None, "rhesus": rhesus or None,
+                "gender": gender or None,
+                "occupation": occupation or None, "education": education or None,
+                "address": (address or "").strip() or None,
+                "phone": (phone or "").strip() or None, 
+                "province": (province_name or "").strip() or None,
+                "city": (city_name or "").strip() or None,
+                "district": (district_name or "").strip() or None,
+                "village": (village_name or "").strip() or None,
+                "cabang": (selected_cabang or "").strip() or None,
+                "kota_cakupan": (kota_cakupan_val or "").strip() or None,
+                "note": (note or "").strip() or None
+            }
+
+            if not is_admin_form and user_branch_form:
+                payload["cabang"] = user_branch_form
+                match_cabang = df_hmhi[df_hmhi['cabang'] == user_branch_form]
+                if not match_cabang.empty:
+                    payload["kota_cakupan"] = match_cabang.iloc[0]['kota_cakupan'] or None
+                else:
+                    payload["kota_cakupan"] = None
+
+            if bundle_problems:
+                for msg in bundle_problems:
+                    st.error(msg)
+                res = None
+            elif pat_data:
+                res = update_patient(pat_data['id'], payload)
             else:
-                payload = {
-                    "full_name": full_name.strip(), "birth_place": (birth_place or "").strip() or None,
-                    "birth_date": birth_date, "nik": nik_cleaned, 
-                    "blood_group": blood_group or None, "rhesus": rhesus or None,
-                    "gender": gender or None,
-                    "occupation": occupation or None, "education": education or None,
-                    "address": (address or "").strip() or None,
-                    "phone": (phone or "").strip() or None, 
-                    "province": (province_name or "").strip() or None,
-                    "city": (city_name or "").strip() or None,
-                    "district": (district_name or "").strip() or None,
-                    "village": (village_name or "").strip() or None,
-                    "cabang": (selected_cabang or "").strip() or None,
-                    "kota_cakupan": (kota_cakupan_val or "").strip() or None,
-                    "note": (note or "").strip() or None
-                }
-                
-                if not is_admin_form and user_branch_form:
-                    payload["cabang"] = user_branch_form
-                    match_cabang = df_hmhi[df_hmhi['cabang'] == user_branch_form]
-                    if not match_cabang.empty:
-                        payload["kota_cakupan"] = match_cabang.iloc[0]['kota_cakupan'] or None
-                    else:
-                        payload["kota_cakupan"] = None
-                
-                if pat_data:
-                    q_check_nik = "SELECT id FROM pwh.patients WHERE nik = :nik AND id != :current_id"
-                    existing_nik = run_df_branch(q_check_nik, {"nik": payload["nik"], "current_id": pat_data['id']})
-                    q_check_name = "SELECT id FROM pwh.patients WHERE lower(full_name) = lower(:name) AND id != :current_id"
-                    existing_name = run_df_branch(q_check_name, {"name": payload["full_name"], "current_id": pat_data['id']})
-                    
-                    if not existing_nik.empty:
-                        st.error(f"NIK '{payload['nik']}' sudah digunakan oleh pasien lain (ID: {existing_nik.iloc[0]['id']}) di cabang Anda.")
-                    elif not existing_name.empty:
-                        st.error(f"Nama '{payload['full_name']}' sudah digunakan oleh pasien lain (ID: {existing_name.iloc[0]['id']}) di cabang Anda. Gunakan nama yang unik.")
-                    else:
-                        update_patient(pat_data['id'], payload)
-                        st.success(f"Pasien dengan ID {pat_data['id']} berhasil diperbarui.")
-                        fetch_all_wilayah_details.clear() 
-                        fetch_hmhi_branches.clear() 
-                        get_all_patients_for_selection.clear()
-                        clear_session_state('patient_to_edit')
-                        clear_session_state('patient_matches')
-                        st.rerun()
+                bundle = save_patient_bundle(payload, children=bundle_children)
+                if bundle.ok:
+                    res = WriteResult(bundle.patient_id, created=True)
+                elif bundle.failed == "Pasien":
+                    res = bundle.result
                 else:
-                    q_check_nik = "SELECT id FROM pwh.patients WHERE nik = :nik"
-                    existing_nik = run_df_branch(q_check_nik, {"nik": payload["nik"]})
-                    q_check_name = "SELECT id FROM pwh.patients WHERE lower(full_name) = lower(:name)"
-                    existing_name = run_df_branch(q_check_name, {"name": payload["full_name"]})
-                    
-                    if not existing_nik.empty:
-                        st.error(f"NIK '{payload['nik']}' sudah ada di database (ID: {existing_nik.iloc[0]['id']}) di cabang Anda. Gunakan NIK lain.")
-                    elif not existing_name.empty:
-                        st.error(f"Nama '{payload['full_name']}' sudah ada di database (ID: {existing_name.iloc[0]['id']}) di cabang Anda. Gunakan nama lain.")
-                    else:
-                        pid = insert_patient(payload)
-                        st.success(f"Pasien baru berhasil disimpan dengan ID: {pid}")
-                        fetch_all_wilayah_details.clear()
-                        fetch_hmhi_branches.clear() 
-                        get_all_patients_for_selection.clear()
-                        st.rerun()
-
-        st.markdown("---")
-        st.markdown("### 📋 Data Pasien Terbaru")
-
-        st.write("**Edit Data Pasien**")
-        search_name_pat = st.text_input("Ketik nama pasien untuk diedit", key="search_name_pat")
-        if st.button("Cari Pasien", key="search_pat_button"):
-            clear_session_state('patient_to_edit') 
-            if search_name_pat:
-                results_df = run_df_branch("SELECT id, full_name, birth_date FROM pwh.patients WHERE full_name ILIKE :name", {"name": f"%{search_name_pat}%"})
-                if results_df.empty:
-                    st.warning("Pasien tidak ditemukan (di cabang Anda).")
-                    clear_session_state('patient_matches')
-                elif len(results_df) == 1:
-                    set_editing_state('patient_to_edit', results_df.iloc[0]['id'], 'pwh.patients')
+                    res = None
+                    st.error(f"Gagal menyimpan {bundle.failed}: data ganda ({bundle.result.conflict}). "
+                             "Tidak ada data yang disimpan; perbaiki baris tersebut lalu simpan ulang.")
+
+            if res is None:
+                pass
+            elif res.ok:
+                pid = res.id
+                if pat_data:
+                    st.success(f"Pasien dengan ID {pid} berhasil diperbarui.")
+                    clear_session_state('patient_to_edit')
                     clear_session_state('patient_matches')
-                    st.rerun()
                 else:
-                    st.info(f"Ditemukan {len(results_df)} pasien dengan nama serupa. Silakan pilih satu.")
-                    st.session_state.patient_matches = results_df
+                    extra = ", ".join(f"{k}: {v}" for k, v in bundle.counts.items() if k != "Pasien")
+                    st.success(f"Pasien baru berhasil disimpan dengan ID: {pid}" + (f" (beserta {extra})" if extra else ""))
+                    clear_session_state('bundle_')
+                fetch_all_wilayah_details.clear()
+                fetch_hmhi_branches.clear() 
+                patient_index_upsert(pid, payload)
+                invalidate_fragment()
+                st.rerun()
             else:
-                st.warning("Silakan masukkan nama untuk dicari.")
+                # ID pasien lain hanya ditampilkan bila pasien itu ada di cabang Anda
+                other = f" (ID: {res.conflict_id})" if res.conflict_id in get_patient_index() else ""
+                if res.conflict == "nik":
+                    st.error(f"NIK '{payload['nik']}' sudah terdaftar pada pasien lain{other}. Gunakan NIK lain.")
+                elif res.conflict == "full_name":
+                    st.error(f"Nama '{payload['full_name']}' sudah digunakan oleh pasien lain{other} di cabang Anda. Gunakan nama yang unik.")
+                else:
+                    st.error(f"Pasien ID {pat_data.get('id')} tidak ditemukan.")
+
+    st.markdown("---")
+    st.markdown("### 📋 Data Pasien Terbaru")
+
+    st.write("**Edit Data Pasien**")
+    search_name_pat = st.text_input("Ketik nama pasien untuk diedit", key="search_name_pat")
+    if st.button("Cari Pasien", key="search_pat_button"):
+        clear_session_state('patient_to_edit') 
+        if search_name_pat:
+            results_df = get_patient_index().frame(get_patient_index().search(search_name_pat))
+            if results_df.empty:
+                st.warning("Pasien tidak ditemukan (di cabang Anda).")
                 clear_session_state('patient_matches')
-
-        if 'patient_matches' in st.session_state and not st.session_state.patient_matches.empty:
-            df_matches = st.session_state.patient_matches
-            options = {f"ID: {row['id']} - {row['full_name']} (Lahir: {row['birth_date']})": row['id'] for index, row in df_matches.iterrows()}
-            
-            selected_option = st.selectbox("Pilih pasien yang benar:", options.keys())
-            if st.button("Pilih Pasien Ini", key="select_patient_button"):
-                selected_id = options[selected_option]
-                set_editing_state('patient_to_edit', selected_id, 'pwh.patients')
+            elif len(results_df) == 1:
+                set_editing_state('patient_to_edit', results_df.iloc[0]['id'], 'pwh.patients')
                 clear_session_state('patient_matches')
-                st.rerun()
-
-        dfp = run_df_branch("""
-    SELECT
-        p.id,
-        p.full_name,
-        p.birth_place,
-        p.birth_date,
-        p.nik,
-        COALESCE(pa.age_years, EXTRACT(YEAR FROM age(CURRENT_DATE, p.birth_date))) AS age_years,
-        p.blood_group,
-        p.rhesus,
-        p.gender,
-        p.occupation,
-        p.education,
-        p.address,
-        p.village,
-        p.district,
-        p.phone,
-        p.province,
-        p.city,
-        p.cabang,
-        p.kota_cakupan,
-        p.created_at
-    FROM pwh.patients p
-    LEFT JOIN pwh.patient_age pa ON pa.id = p.id
-    ORDER BY p.full_name ASC;
-    """)
-        
-        if not dfp.empty:
-            dfp_display = dfp.copy()
-            
-            # --- FIX: Hilangkan desimal pada kolom umur dengan casting ke Int64 ---
-            if 'age_years' in dfp_display.columns:
-                dfp_display['age_years'] = pd.to_numeric(dfp_display['age_years'], errors='coerce').astype('Int64')
-            # -----------------------------------------------------------------------
-            
-            dfp_display['birth_place'] = dfp_display['birth_place'].apply(lambda x: '*****' if pd.notna(x) and str(x).strip() else x)
-            dfp_display['birth_date'] = dfp_display['birth_date'].apply(lambda x: '*****' if pd.notna(x) else x)
-            dfp_display['nik'] = dfp_display['nik'].apply(lambda x: '*****' if pd.notna(x) and str(x).strip() else x)
-            dfp_display['phone'] = dfp_display['phone'].apply(lambda x: '*****' if pd.notna(x) and str(x).strip() else x)
-            
-            dfp_display = dfp_display.drop(columns=['id'], errors='ignore')
-            dfp_display.index = range(1, len(dfp_display) + 1)
-            dfp_display.index.name = "No."
-            
-            st.write(f"Total Data Pasien (di cabang Anda): **{len(dfp_display)}**")
-            # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
-            styled_dfp = style_deceased_row(_alias_df(dfp_display, ALIAS_PATIENTS), dfp, 'id')
-            st.dataframe(styled_dfp, use_container_width=True)
-            # --- END PERUBAHAN ---
+                st.rerun(scope="fragment")
+            else:
+                st.info(f"Ditemukan {len(results_df)} pasien dengan nama serupa. Silakan pilih satu.")
+                st.session_state.patient_matches = results_df
         else:
-            st.info("Belum ada data pasien (di cabang Anda).")
+            st.warning("Silakan masukkan nama untuk dicari.")
+            clear_session_state('patient_matches')
+
+    if 'patient_matches' in st.session_state and not st.session_state.patient_matches.empty:
+        df_matches = st.session_state.patient_matches
+        options = {f"ID: {row['id']} - {row['full_name']} (Lahir: {row['birth_date']})": row['id'] for index, row in df_matches.iterrows()}
+
+        selected_option = st.selectbox("Pilih pasien yang benar:", options.keys())
+        if st.button("Pilih Pasien Ini", key="select_patient_button"):
+            selected_id = options[selected_option]
+            set_editing_state('patient_to_edit', selected_id, 'pwh.patients')
+            clear_session_state('patient_matches')
+            st.rerun(scope="fragment")
+
+    page_p = paged_table("pasien", f"""
+            p.id,
+            p.full_name,
+            {masked_col("p.birth_place", "birth_place")},
+            {masked_col("p.birth_date", "birth_date")},
+            {masked_col("p.nik", "nik")},
+            COALESCE(pa.age_years, EXTRACT(YEAR FROM age(CURRENT_DATE, p.birth_date)))::int AS age_years,
+            p.blood_group,
+            p.rhesus,
+            p.gender,
+            p.occupation,
+            p.education,
+            p.address,
+            p.village,
+            p.district,
+            {masked_col("p.phone", "phone")},
+            p.province,
+            p.city,
+            p.cabang,
+            p.kota_cakupan,
+            p.created_at,
+            {DECEASED_COL}
+    """,
+        f"pwh.patients p LEFT JOIN pwh.patient_age pa ON pa.id = p.id{DECEASED_JOIN}",
+        id_col="p.id",
+        sort_options={"Terbaru ditambahkan": ("p.id", True)},
+        filters={"Jenis kelamin": ("p.gender", GENDERS), "Golongan darah": ("p.blood_group", BLOOD_GROUPS)},
+        name_filter=True)
+    dfp = page_p.df
+
+    if grid_mode("pasien"):
+        render_grid_editor("pasien", dfp)
+    elif not dfp.empty:
+        # birth_place, birth_date, nik & phone sudah dimasker di query (masked_col)
+        dfp_display = dfp.drop(columns=['id', 'is_deceased'], errors='ignore')
+        dfp_display.index = page_p.index
+        dfp_display.index.name = "No."
+
+        st.write(f"Total Data Pasien (di cabang Anda): **{page_p.total_label}**")
+        # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
+        styled_dfp = style_deceased_row(_alias_df(dfp_display, ALIAS_PATIENTS), dfp['is_deceased'])
+        st.dataframe(styled_dfp, use_container_width=True)
+        # --- END PERUBAHAN ---
+    else:
+        st.info("Belum ada data pasien (di cabang Anda).")
+
+
 
 # ==============================================================================
 # Diagnosis
-if tab_diag:
-    with tab_diag:
-        st.subheader("🧬 Tambah Data Diagnosis Pasien")
+@st.fragment
+def render_tab_diagnosis():
+    st.subheader("🧬 Tambah Data Diagnosis Pasien")
 
-        diag_data = st.session_state.get('diag_to_edit', {})
-        
-        if diag_data:
-            st.info(f"Mode Edit untuk Diagnosis ID: {diag_data.get('id')}")
-            if st.button("❌ Batal Edit", key="cancel_diag_edit"):
-                clear_session_state('diag_to_edit')
-                clear_session_state('diag_matches')
-                st.rerun()
+    diag_data = st.session_state.get('diag_to_edit', {})
 
-        default_patient_id = diag_data.get('patient_id') if diag_data else None
-        
-        pid_diag = st.selectbox(
-            "Pilih Pasien (untuk data baru)",
-            options=patient_id_options, 
-            index=patient_id_options.index(default_patient_id) if default_patient_id in patient_id_options else 0,
-            format_func=format_patient_name,
-            key="diag_patient_selector",
-            disabled=bool(diag_data)
-        )
+    if diag_data:
+        st.info(f"Mode Edit untuk Diagnosis ID: {diag_data.get('id')}")
+        if st.button("❌ Batal Edit", key="cancel_diag_edit"):
+            clear_session_state('diag_to_edit')
+            clear_session_state('diag_matches')
+            st.rerun(scope="fragment")
 
-        with st.form("diag::form", clear_on_submit=False):
-            hemo_opts = [""] + [h for h in HEMO_TYPES if h]
-            sev_opts = [""] + [s for s in SEVERITY_CHOICES if s]
+    default_patient_id = diag_data.get('patient_id') if diag_data else None
 
-            curr_hemo = diag_data.get('hemo_type', '')
-            curr_sev = diag_data.get('severity', '')
-            
-            h_idx = get_safe_index(hemo_opts, curr_hemo)
-            s_idx = get_safe_index(sev_opts, curr_sev)
+    pid_diag = pick_patient("diag_patient_selector", default_id=default_patient_id, disabled=bool(diag_data))
 
-            hemo_type = st.selectbox("Tipe Hemofilia*", hemo_opts, index=h_idx)
-            severity = st.selectbox("Kategori*", sev_opts, index=s_idx)
-            
-            diagnosed_on_val = pd.to_datetime(diag_data.get('diagnosed_on')).date() if pd.notna(diag_data.get('diagnosed_on')) else None
-            diagnosed_on = st.date_input("Tanggal Diagnosis", value=diagnosed_on_val, format="YYYY-MM-DD", min_value=date(1920, 1, 1))
-            source = st.text_input("Sumber (opsional)", value=diag_data.get('source', ''))
-            
-            sdiag_label = "Perbarui Diagnosis" if diag_data else "Simpan Diagnosis Baru"
-            sdiag = st.form_submit_button(f"💾 {sdiag_label}", type="primary")
-
-        if sdiag:
-            if not hemo_type:
-                st.error("Tipe Hemofilia wajib dipilih.")
-            elif not severity:
-                st.error("Kategori wajib dipilih.")
-            else:
-                if diag_data:
-                    q_check = """
-                        SELECT id FROM pwh.hemo_diagnoses 
-                        WHERE patient_id = :pid AND hemo_type = :htype AND id != :current_id
-                    """
-                    exists = run_df_branch(q_check, {
-                        "pid": diag_data['patient_id'], 
-                        "htype": hemo_type, 
-                        "current_id": diag_data['id']
-                    })
-                    
-                    if not exists.empty:
-                        st.error(f"Gagal Update: Pasien ini sudah memiliki data diagnosis untuk tipe '{hemo_type}'. Data tidak boleh ganda.")
-                    else:
-                        payload = {"hemo_type": hemo_type, "severity": severity, "diagnosed_on": diagnosed_on, "source": (source or "").strip() or None}
-                        update_diagnosis(diag_data['id'], payload)
-                        st.success("Diagnosis diperbarui.")
-                        clear_session_state('diag_to_edit')
-                        st.rerun()
-
-                elif pid_diag:
-                    q_check = """
-                        SELECT id FROM pwh.hemo_diagnoses 
-                        WHERE patient_id = :pid AND hemo_type = :htype
-                    """
-                    exists = run_df_branch(q_check, {
-                        "pid": int(pid_diag), 
-                        "htype": hemo_type
-                    })
+    with st.form("diag::form", clear_on_submit=False):
+        hemo_opts = [""] + [h for h in HEMO_TYPES if h]
+        sev_opts = [""] + [s for s in SEVERITY_CHOICES if s]
 
-                    if not exists.empty:
-                        st.error(f"Gagal Simpan: Pasien ini sudah memiliki diagnosis tipe '{hemo_type}'. Data hanya bisa diinput sekali.")
-                    else:
-                        insert_diagnosis(int(pid_diag), hemo_type, severity, diagnosed_on, source)
-                        st.success("Diagnosis disimpan.")
-                        st.rerun()
-                else:
-                    if not diag_data: st.warning("Silakan pilih pasien terlebih dahulu.")
+        curr_hemo = diag_data.get('hemo_type', '')
+        curr_sev = diag_data.get('severity', '')
 
-        st.markdown("---")
-        st.markdown("### 📋 Data Diagnosis Terbaru")
-        st.write("**Edit/Hapus Data Diagnosis**") 
-        search_name_diag = st.text_input("Ketik nama pasien untuk mencari riwayat dan mengedit", key="search_name_diag")
-        if st.button("Cari Riwayat Diagnosis", key="search_diag_button"):
-            clear_session_state('diag_to_edit')
-            clear_session_state('diag_matches')
-            st.session_state.diag_selected_patient_name = search_name_diag
-
-            if search_name_diag:
-                q = """
-                    SELECT d.id, p.full_name, d.hemo_type, d.diagnosed_on
-                    FROM pwh.hemo_diagnoses d
-                    JOIN pwh.patients p ON p.id = d.patient_id
-                    WHERE p.full_name ILIKE :name ORDER BY d.id DESC
-                """
-                results_df = run_df_branch(q, {"name": f"%{search_name_diag}%"})
-
-                if results_df.empty:
-                    st.warning("Riwayat diagnosis tidak ditemukan untuk pasien dengan nama tersebut (di cabang Anda).")
+        h_idx = get_safe_index(hemo_opts, curr_hemo)
+        s_idx = get_safe_index(sev_opts, curr_sev)
+
+        hemo_type = st.selectbox("Tipe Hemofilia*", hemo_opts, index=h_idx)
+        severity = st.selectbox("Kategori*", sev_opts, index=s_idx)
+
+        diagnosed_on_val = pd.to_datetime(diag_data.get('diagnosed_on')).date() if pd.notna(diag_data.get('diagnosed_on')) else None
+        diagnosed_on = st.date_input("Tanggal Diagnosis", value=diagnosed_on_val, format="YYYY-MM-DD", min_value=date(1920, 1, 1))
+        source = st.text_input("Sumber (opsional)", value=diag_data.get('source', ''))
+
+        sdiag_label = "Perbarui Diagnosis" if diag_data else "Simpan Diagnosis Baru"
+        sdiag = st.form_submit_button(f"💾 {sdiag_label}", type="primary")
+
+    if sdiag:
+        if not hemo_type:
+            st.error("Tipe Hemofilia wajib dipilih.")
+        elif not severity:
+            st.error("Kategori wajib dipilih.")
+        else:
+            if diag_data:
+                payload = {"hemo_type": hemo_type, "severity": severity, "diagnosed_on": diagnosed_on, "source": (source or "").strip() or None}
+                res = update_diagnosis(diag_data['id'], payload)
+                if res.ok:
+                    st.success("Diagnosis diperbarui.")
+                    clear_session_state('diag_to_edit')
+                    invalidate_fragment("diag", "ringkasan")
+                    st.rerun(scope="fragment")
+                elif res.conflict == "hemo_type":
+                    st.error(f"Gagal Update: Pasien ini sudah memiliki data diagnosis untuk tipe '{hemo_type}'. Data tidak boleh ganda.")
                 else:
-                    st.info(f"Ditemukan {len(results_df)} riwayat diagnosis. Silakan pilih satu untuk diedit/dihapus.")
-                    st.session_state.diag_matches = results_df
-                    
+                    st.error(f"Diagnosis ID {diag_data['id']} tidak ditemukan.")
+
+            elif pid_diag:
+                res = insert_diagnosis(int(pid_diag), hemo_type, severity, diagnosed_on, source, upsert=False)
+                if res.ok:
+                    st.success("Diagnosis disimpan.")
+                    invalidate_fragment("diag", "ringkasan")
+                    st.rerun(scope="fragment")
+                else:
+                    st.error(f"Gagal Simpan: Pasien ini sudah memiliki diagnosis tipe '{hemo_type}'. Data hanya bisa diinput sekali.")
             else:
-                st.warning("Silakan masukkan nama untuk dicari.")
-                st.session_state.diag_selected_patient_name = ""
-
-        if 'diag_matches' in st.session_state and not st.session_state.diag_matches.empty:
-            df_matches = st.session_state.diag_matches
-            options = {
-                f"ID: {row['id']} - {row['hemo_type']} (Tgl: {row['diagnosed_on']})": row['id']
-                for _, row in df_matches.iterrows()
-            }
-            selected_option = st.selectbox("Pilih riwayat diagnosis yang akan diedit/dihapus:", options.keys(), key="select_diag_box") 
-            
-            c_edit, c_del, c_spacer = st.columns([1, 1, 2])
-            with c_edit:
-                if st.button("📝 Edit Riwayat Ini", key="select_diag_button"):
-                    selected_id = options[selected_option]
-                    set_editing_state('diag_to_edit', selected_id, 'pwh.hemo_diagnoses')
-                    clear_session_state('diag_matches')
-                    st.rerun()
-            with c_del:
-                if st.button("❌ Hapus Riwayat Ini", key="delete_diag_button"):
-                    selected_id = options[selected_option]
-                    try:
-                        delete_hemo_diagnosis(selected_id) 
-                        st.success(f"Data Diagnosis ID {selected_id} berhasil dihapus.")
-                        clear_session_state('diag_matches')
-                        clear_session_state('diag_to_edit') 
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"Gagal menghapus ID {selected_id}: {e}")
-            
-        query_diag = "SELECT d.id, d.patient_id, p.full_name, d.hemo_type, d.severity, d.diagnosed_on, d.source FROM pwh.hemo_diagnoses d JOIN pwh.patients p ON p.id = d.patient_id"
-        params = {}
-        if 'diag_selected_patient_name' in st.session_state and st.session_state.diag_selected_patient_name:
-            query_diag += " WHERE p.full_name ILIKE :name"
-            params['name'] = f"%{st.session_state.diag_selected_patient_name}%"
-        query_diag += " ORDER BY p.full_name ASC, d.id DESC;"
-        
-        df_diag = run_df_branch(query_diag, params)
-
-        if not df_diag.empty:
-            df_diag_display = df_diag.drop(columns=['id', 'patient_id'], errors='ignore')
-            df_diag_display.index = range(1, len(df_diag_display) + 1)
-            df_diag_display.index.name = "No."
-            st.write(f"Total Data Diagnosis: **{len(df_diag_display)}**")
-            # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
-            styled_df_diag = style_deceased_row(_alias_df(df_diag_display, ALIAS_DIAG), df_diag, 'patient_id')
-            st.dataframe(styled_df_diag, use_container_width=True)
-            # --- END PERUBAHAN ---
+                if not diag_data: st.warning("Silakan pilih pasien terlebih dahulu.")
+
+    st.markdown("---")
+    st.markdown("### 📋 Data Diagnosis Terbaru")
+    st.write("**Edit/Hapus Data Diagnosis**") 
+    search_name_diag = st.text_input("Ketik nama pasien untuk mencari riwayat dan mengedit", key="search_name_diag")
+    if st.button("Cari Riwayat Diagnosis", key="search_diag_button"):
+        clear_session_state('diag_to_edit')
+        clear_session_state('diag_matches')
+        st.session_state.diag_selected_patient_name = search_name_diag
+
+        if search_name_diag:
+            q = """
+                SELECT d.id, p.full_name, d.hemo_type, d.diagnosed_on
+                FROM pwh.hemo_diagnoses d
+                JOIN pwh.patients p ON p.id = d.patient_id
+                WHERE p.id = ANY(:ids) ORDER BY d.id DESC
+            """
+            results_df = run_df_branch(q, {"ids": get_patient_index().search(search_name_diag)})
+
+            if results_df.empty:
+                st.warning("Riwayat diagnosis tidak ditemukan untuk pasien dengan nama tersebut (di cabang Anda).")
+            else:
+                st.info(f"Ditemukan {len(results_df)} riwayat diagnosis. Silakan pilih satu untuk diedit/dihapus.")
+                st.session_state.diag_matches = results_df
+
         else:
-            st.info("Tidak ada data diagnosis untuk ditampilkan. Cari nama pasien di atas untuk memfilter.")
+            st.warning("Silakan masukkan nama untuk dicari.")
+            st.session_state.diag_selected_patient_name = ""
+
+    if 'diag_matches' in st.session_state and not st.session_state.diag_matches.empty:
+        df_matches = st.session_state.diag_matches
+        options = {
+            f"ID: {row['id']} - {row['hemo_type']} (Tgl: {row['diagnosed_on']})": row['id']
+            for _, row in df_matches.iterrows()
+        }
+        selected_option = st.selectbox("Pilih riwayat diagnosis yang akan diedit/dihapus:", options.keys(), key="select_diag_box") 
+
+        c_edit, c_del, c_spacer = st.columns([1, 1, 2])
+        with c_edit:
+            if st.button("📝 Edit Riwayat Ini", key="select_diag_button"):
+                selected_id = options[selected_option]
+                set_editing_state('diag_to_edit', selected_id, 'pwh.hemo_diagnoses')
+                clear_session_state('diag_matches')
+                st.rerun(scope="fragment")
+        with c_del:
+            if st.button("❌ Hapus Riwayat Ini", key="delete_diag_button"):
+                selected_id = options[selected_option]
+                try:
+                    delete_hemo_diagnosis(selected_id) 
+                    st.success(f"Data Diagnosis ID {selected_id} berhasil dihapus.")
+                    clear_session_state('diag_matches')
+                    clear_session_state('diag_to_edit') 
+                    invalidate_fragment("diag", "ringkasan")
+                    st.rerun(scope="fragment")
+                except Exception as e:
+                    st.error(f"Gagal menghapus ID {selected_id}: {e}")
+
+    params = {}
+    conditions = []
+    if 'diag_selected_patient_name' in st.session_state and st.session_state.diag_selected_patient_name:
+        conditions.append("p.id = ANY(:ids)")
+        params['ids'] = get_patient_index().search(st.session_state.diag_selected_patient_name)
+
+    page_diag = paged_table("diag",
+        "d.id, d.patient_id, p.full_name, d.hemo_type, d.severity, d.diagnosed_on, d.source, " + DECEASED_COL,
+        "pwh.hemo_diagnoses d JOIN pwh.patients p ON p.id = d.patient_id" + DECEASED_JOIN,
+        id_col="d.id", conditions=conditions, params=params,
+        sort_options={"Terbaru ditambahkan": ("d.id", True),
+                      "Tgl diagnosis terbaru": ("COALESCE(d.diagnosed_on, DATE '0001-01-01')", True)},
+        filters={"Tipe hemofilia": ("d.hemo_type", HEMO_TYPES), "Derajat": ("d.severity", SEVERITY_CHOICES)})
+    df_diag = page_diag.df
+
+    if grid_mode("diag"):
+        render_grid_editor("diag", df_diag, new_patient_id=pid_diag)
+    elif not df_diag.empty:
+        df_diag_display = df_diag.drop(columns=['id', 'patient_id', 'is_deceased'], errors='ignore')
+        df_diag_display.index = page_diag.index
+        df_diag_display.index.name = "No."
+        st.write(f"Total Data Diagnosis: **{page_diag.total_label}**")
+        # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
+        styled_df_diag = style_deceased_row(_alias_df(df_diag_display, ALIAS_DIAG), df_diag['is_deceased'])
+        st.dataframe(styled_df_diag, use_container_width=True)
+        # --- END PERUBAHAN ---
+    else:
+        st.info("Tidak ada data diagnosis untuk ditampilkan. Cari nama pasien di atas untuk memfilter.")
+
+
 
 # ==================== Inhibitor ====================
-if tab_inh:
-    with tab_inh:
-        st.subheader("🧪 Tambah Data Inhibitor (BU)")
+@st.fragment
+def render_tab_inhibitor():
+    st.subheader("🧪 Tambah Data Inhibitor (BU)")
+
+    inh_data = st.session_state.get('inh_to_edit', {})
+    if inh_data:
+        st.info(f"Mode Edit untuk Inhibitor ID: {inh_data.get('id')}")
+        if st.button("❌ Batal Edit", key="cancel_inh_edit"):
+            clear_session_state('inh_to_edit')
+            clear_session_state('inh_matches')
+            st.rerun(scope="fragment")
 
-        inh_data = st.session_state.get('inh_to_edit', {})
-        if inh_data:
-            st.info(f"Mode Edit untuk Inhibitor ID: {inh_data.get('id')}")
-            if st.button("❌ Batal Edit", key="cancel_inh_edit"):
-                clear_session_state('inh_to_edit')
-                clear_session_state('inh_matches')
-                st.rerun()
+    default_patient_id_inh = inh_data.get('patient_id') if inh_data else None
 
-        default_patient_id_inh = inh_data.get('patient_id') if inh_data else None
-        
-        pid_inh = st.selectbox(
-            "Pilih Pasien (untuk data baru)",
-            options=patient_id_options, 
-            index=patient_id_options.index(default_patient_id_inh) if default_patient_id_inh in patient_id_options else 0,
-            format_func=format_patient_name,
-            key="inh_patient_selector",
-            disabled=bool(inh_data)
-        )
+    pid_inh = pick_patient("inh_patient_selector", default_id=default_patient_id_inh, disabled=bool(inh_data))
+
+    with st.form("inh::form", clear_on_submit=False):
+        factor_idx = get_safe_index(INHIB_FACTORS, inh_data.get('factor'))
+        factor = st.selectbox("Faktor", INHIB_FACTORS, index=factor_idx)
+        titer_bu = st.number_input("Titer (BU)", min_value=0.0, step=0.1, value=float(inh_data.get('titer_bu', 0.0)))
+        measured_on_val = pd.to_datetime(inh_data.get('measured_on')).date() if pd.notna(inh_data.get('measured_on')) else None
+        measured_on = st.date_input("Tanggal Ukur", value=measured_on_val, format="YYYY-MM-DD", min_value=date(1920, 1, 1))
+        lab = st.text_input("Lab (opsional)", value=inh_data.get('lab', ''))
+        sinh_label = "Perbarui Riwayat" if inh_data else "Simpan Riwayat Baru"
+        sinh = st.form_submit_button(f"💾 {sinh_label}", type="primary")
 
-        with st.form("inh::form", clear_on_submit=False):
-            factor_idx = get_safe_index(INHIB_FACTORS, inh_data.get('factor'))
-            factor = st.selectbox("Faktor", INHIB_FACTORS, index=factor_idx)
-            titer_bu = st.number_input("Titer (BU)", min_value=0.0, step=0.1, value=float(inh_data.get('titer_bu', 0.0)))
-            measured_on_val = pd.to_datetime(inh_data.get('measured_on')).date() if pd.notna(inh_data.get('measured_on')) else None
-            measured_on = st.date_input("Tanggal Ukur", value=measured_on_val, format="YYYY-MM-DD", min_value=date(1920, 1, 1))
-            lab = st.text_input("Lab (opsional)", value=inh_data.get('lab', ''))
-            sinh_label = "Perbarui Riwayat" if inh_data else "Simpan Riwayat Baru"
-            sinh = st.form_submit_button(f"💾 {sinh_label}", type="primary")
-
-        if sinh:
-            if inh_data:
-                payload = { "factor": factor, "titer_bu": float(titer_bu), "measured_on": measured_on, "lab": (lab or "").strip() or None }
-                update_inhibitor(inh_data['id'], payload)
+    if sinh:
+        if inh_data:
+            payload = { "factor": factor, "titer_bu": float(titer_bu), "measured_on": measured_on, "lab": (lab or "").strip() or None }
+            res = update_inhibitor(inh_data['id'], payload)
+            if res.ok:
                 st.success("Riwayat inhibitor diperbarui.")
                 clear_session_state('inh_to_edit')
-                st.rerun()
-            elif pid_inh:
-                insert_inhibitor(int(pid_inh), factor, float(titer_bu), measured_on, lab)
+                invalidate_fragment("inh", "ringkasan")
+                st.rerun(scope="fragment")
+            elif res.conflict == "not_found":
+                st.error(f"Riwayat inhibitor ID {inh_data['id']} tidak ditemukan.")
+            else:
+                st.error(f"Gagal Update: data bentrok dengan data lain ({res.conflict}).")
+        elif pid_inh:
+            res = insert_inhibitor(int(pid_inh), factor, float(titer_bu), measured_on, lab)
+            if res.ok:
                 st.success("Riwayat inhibitor ditambahkan.")
-                st.rerun()
+                invalidate_fragment("inh", "ringkasan")
+                st.rerun(scope="fragment")
             else:
-                if not inh_data: st.warning("Silakan pilih pasien terlebih dahulu.")
-
-        st.markdown("---")
-        st.markdown("### 📋 Data Inhibitor Terbaru")
-        
-        st.write("**Edit/Hapus Data Inhibitor**") 
-        search_name_inh = st.text_input("Ketik nama pasien untuk mencari riwayat dan mengedit", key="search_name_inh")
-        if st.button("Cari Riwayat Inhibitor", key="search_inh_button"):
-            clear_session_state('inh_to_edit')
-            clear_session_state('inh_matches')
-            st.session_state.inh_selected_patient_name = search_name_inh
-
-            if search_name_inh:
-                q = """
-                    SELECT i.id, p.full_name, i.factor, i.measured_on
-                    FROM pwh.hemo_inhibitors i
-                    JOIN pwh.patients p ON p.id = i.patient_id
-                    WHERE p.full_name ILIKE :name ORDER BY i.id DESC
-                """
-                results_df = run_df_branch(q, {"name": f"%{search_name_inh}%"})
-
-                if results_df.empty:
-                    st.warning("Riwayat inhibitor tidak ditemukan (di cabang Anda).")
-                else:
-                    st.info(f"Ditemukan {len(results_df)} riwayat. Silakan pilih satu untuk diedit/dihapus.")
-                    st.session_state.inh_matches = results_df
-                    
+                st.error(f"Gagal Simpan: data bentrok dengan data lain ({res.conflict}).")
+        else:
+            if not inh_data: st.warning("Silakan pilih pasien terlebih dahulu.")
+
+    st.markdown("---")
+    st.markdown("### 📋 Data Inhibitor Terbaru")
+
+    st.write("**Edit/Hapus Data Inhibitor**") 
+    search_name_inh = st.text_input("Ketik nama pasien untuk mencari riwayat dan mengedit", key="search_name_inh")
+    if st.button("Cari Riwayat Inhibitor", key="search_inh_button"):
+        clear_session_state('inh_to_edit')
+        clear_session_state('inh_matches')
+        st.session_state.inh_selected_patient_name = search_name_inh
+
+        if search_name_inh:
+            q = """
+                SELECT i.id, p.full_name, i.factor, i.measured_on
+                FROM pwh.hemo_inhibitors i
+                JOIN pwh.patients p ON p.id = i.patient_id
+                WHERE p.id = ANY(:ids) ORDER BY i.id DESC
+            """
+            results_df = run_df_branch(q, {"ids": get_patient_index().search(search_name_inh)})
+
+            if results_df.empty:
+                st.warning("Riwayat inhibitor tidak ditemukan (di cabang Anda).")
             else:
-                st.warning("Silakan masukkan nama untuk dicari.")
-                st.session_state.inh_selected_patient_name = ""
-
-        if 'inh_matches' in st.session_state and not st.session_state.inh_matches.empty:
-            df_matches = st.session_state.inh_matches
-            options = {
-                f"ID: {row['id']} - {row['factor']} (Tgl: {row['measured_on']})": row['id']
-                for _, row in df_matches.iterrows()
-            }
-            selected_option = st.selectbox("Pilih riwayat inhibitor:", options.keys(), key="select_inh_box")
-            
-            c_edit, c_del, c_spacer = st.columns([1, 1, 2])
-            with c_edit:
-                if st.button("📝 Edit Riwayat Ini", key="select_inh_button"):
-                    selected_id = options[selected_option]
-                    set_editing_state('inh_to_edit', selected_id, 'pwh.hemo_inhibitors')
-                    clear_session_state('inh_matches')
-                    st.rerun()
-            with c_del:
-                if st.button("❌ Hapus Riwayat Ini", key="delete_inh_button"):
-                    selected_id = options[selected_option]
-                    try:
-                        delete_hemo_inhibitor(selected_id) 
-                        st.success(f"Data Inhibitor ID {selected_id} berhasil dihapus.")
-                        clear_session_state('inh_matches')
-                        clear_session_state('inh_to_edit') 
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"Gagal menghapus ID {selected_id}: {e}")
-
-        query_inh = "SELECT i.id, i.patient_id, p.full_name, i.factor, i.titer_bu, i.measured_on, i.lab FROM pwh.hemo_inhibitors i JOIN pwh.patients p ON p.id = i.patient_id"
-        params_inh = {}
-        if 'inh_selected_patient_name' in st.session_state and st.session_state.inh_selected_patient_name:
-            query_inh += " WHERE p.full_name ILIKE :name"
-            params_inh['name'] = f"%{st.session_state.inh_selected_patient_name}%"
-        query_inh += " ORDER BY p.full_name ASC, i.id DESC LIMIT 500;"
-        
-        df_inh = run_df_branch(query_inh, params_inh)
-
-        if not df_inh.empty:
-            df_inh_display = df_inh.drop(columns=['id', 'patient_id'], errors='ignore')
-            df_inh_display.index = range(1, len(df_inh_display) + 1)
-            df_inh_display.index.name = "No."
-            st.write(f"Total Data Inhibitor: **{len(df_inh_display)}**")
-            # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
-            styled_df_inh = style_deceased_row(_alias_df(df_inh_display, ALIAS_INH), df_inh, 'patient_id')
-            st.dataframe(styled_df_inh, use_container_width=True)
-            # --- END PERUBAHAN ---
+                st.info(f"Ditemukan {len(results_df)} riwayat. Silakan pilih satu untuk diedit/dihapus.")
+                st.session_state.inh_matches = results_df
+
         else:
-            st.info("Tidak ada data inhibitor untuk ditampilkan.")
+            st.warning("Silakan masukkan nama untuk dicari.")
+            st.session_state.inh_selected_patient_name = ""
+
+    if 'inh_matches' in st.session_state and not st.session_state.inh_matches.empty:
+        df_matches = st.session_state.inh_matches
+        options = {
+            f"ID: {row['id']} - {row['factor']} (Tgl: {row['measured_on']})": row['id']
+            for _, row in df_matches.iterrows()
+        }
+        selected_option = st.selectbox("Pilih riwayat inhibitor:", options.keys(), key="select_inh_box")
+
+        c_edit, c_del, c_spacer = st.columns([1, 1, 2])
+        with c_edit:
+            if st.button("📝 Edit Riwayat Ini", key="select_inh_button"):
+                selected_id = options[selected_option]
+                set_editing_state('inh_to_edit', selected_id, 'pwh.hemo_inhibitors')
+                clear_session_state('inh_matches')
+                st.rerun(scope="fragment")
+        with c_del:
+            if st.button("❌ Hapus Riwayat Ini", key="delete_inh_button"):
+                selected_id = options[selected_option]
+                try:
+                    delete_hemo_inhibitor(selected_id) 
+                    st.success(f"Data Inhibitor ID {selected_id} berhasil dihapus.")
+                    clear_session_state('inh_matches')
+                    clear_session_state('inh_to_edit') 
+                    invalidate_fragment("inh", "ringkasan")
+                    st.rerun(scope="fragment")
+                except Exception as e:
+                    st.error(f"Gagal menghapus ID {selected_id}: {e}")
+
+    params_inh = {}
+    conditions = []
+    if 'inh_selected_patient_name' in st.session_state and st.session_state.inh_selected_patient_name:
+        conditions.append("p.id = ANY(:ids)")
+        params_inh['ids'] = get_patient_index().search(st.session_state.inh_selected_patient_name)
+
+    page_inh = paged_table("inh",
+        "i.id, i.patient_id, p.full_name, i.factor, i.titer_bu, i.measured_on, i.lab, " + DECEASED_COL,
+        "pwh.hemo_inhibitors i JOIN pwh.patients p ON p.id = i.patient_id" + DECEASED_JOIN,
+        id_col="i.id", conditions=conditions, params=params_inh,
+        sort_options={"Terbaru ditambahkan": ("i.id", True),
+                      "Tgl ukur terbaru": ("COALESCE(i.measured_on, DATE '0001-01-01')", True)},
+        filters={"Faktor": ("i.factor", INHIB_FACTORS)})
+    df_inh = page_inh.df
+
+    if grid_mode("inh"):
+        render_grid_editor("inh", df_inh, new_patient_id=pid_inh)
+    elif not df_inh.empty:
+        df_inh_display = df_inh.drop(columns=['id', 'patient_id', 'is_deceased'], errors='ignore')
+        df_inh_display.index = page_inh.index
+        df_inh_display.index.name = "No."
+        st.write(f"Total Data Inhibitor: **{page_inh.total_label}**")
+        # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
+        styled_df_inh = style_deceased_row(_alias_df(df_inh_display, ALIAS_INH), df_inh['is_deceased'])
+        st.dataframe(styled_df_inh, use_container_width=True)
+        # --- END PERUBAHAN ---
+    else:
+        st.info("Tidak ada data inhibitor untuk ditampilkan.")
+
+
 
 # Virus Tests
-if tab_virus:
-    with tab_virus:
-        st.subheader("🧫 Tambah Data Virus Tests")
-            
-        virus_data = st.session_state.get('virus_to_edit', {})
-        if virus_data:
-            st.info(f"Mode Edit untuk Tes Virus ID: {virus_data.get('id')}")
-            if st.button("❌ Batal Edit", key="cancel_virus_edit"):
-                clear_session_state('virus_to_edit')
-                clear_session_state('virus_matches')
-                st.rerun()
+@st.fragment
+def render_tab_virus():
+    st.subheader("🧫 Tambah Data Virus Tests")
+
+    virus_data = st.session_state.get('virus_to_edit', {})
+    if virus_data:
+        st.info(f"Mode Edit untuk Tes Virus ID: {virus_data.get('id')}")
+        if st.button("❌ Batal Edit", key="cancel_virus_edit"):
+            clear_session_state('virus_to_edit')
+            clear_session_state('virus_matches')
+            st.rerun(scope="fragment")
 
-        default_patient_id_virus = virus_data.get('patient_id') if virus_data else None
-        
-        pid_virus = st.selectbox(
-            "Pilih Pasien (untuk data baru)",
-            options=patient_id_options, 
-            index=patient_id_options.index(default_patient_id_virus) if default_patient_id_virus in patient_id_options else 0,
-            format_func=format_patient_name,
-            key="virus_patient_selector",
-            disabled=bool(virus_data)
-        )
+    default_patient_id_virus = virus_data.get('patient_id') if virus_data else None
+
+    pid_virus = pick_patient("virus_patient_selector", default_id=default_patient_id_virus, disabled=bool(virus_data))
 
-        with st.form("virus::form", clear_on_submit=False):
-            test_type_idx = get_safe_index(VIRUS_TESTS, virus_data.get('test_type'))
-            test_type = st.selectbox("Jenis Tes", VIRUS_TESTS, index=test_type_idx)
-            result_idx = get_safe_index(TEST_RESULTS, virus_data.get('result'))
-            result = st.selectbox("Hasil", TEST_RESULTS, index=result_idx)
-            tested_on_val = pd.to_datetime(virus_data.get('tested_on')).date() if pd.notna(virus_data.get('tested_on')) else None
-            tested_on = st.date_input("Tanggal Tes", value=tested_on_val, format="YYYY-MM-DD", min_value=date(1920, 1, 1))
-            lab = st.text_input("Lab (opsional)", value=virus_data.get('lab', ''))
-            svirus_label = "Perbarui Hasil Tes" if virus_data else "Simpan Hasil Tes Baru"
-            svirus = st.form_submit_button(f"💾 {svirus_label}", type="primary")
-
-        if svirus:
-            if virus_data:
-                payload = {"test_type": test_type, "result": result, "tested_on": tested_on, "lab": (lab or "").strip() or None}
-                update_virus_test(virus_data['id'], payload)
+    with st.form("virus::form", clear_on_submit=False):
+        test_type_idx = get_safe_index(VIRUS_TESTS, virus_data.get('test_type'))
+        test_type = st.selectbox("Jenis Tes", VIRUS_TESTS, index=test_type_idx)
+        result_idx = get_safe_index(TEST_RESULTS, virus_data.get('result'))
+        result = st.selectbox("Hasil", TEST_RESULTS, index=result_idx)
+        tested_on_val = pd.to_datetime(virus_data.get('tested_on')).date() if pd.notna(virus_data.get('tested_on')) else None
+        tested_on = st.date_input("Tanggal Tes", value=tested_on_val, format="YYYY-MM-DD", min_value=date(1920, 1, 1))
+        lab = st.text_input("Lab (opsional)", value=virus_data.get('lab', ''))
+        svirus_label = "Perbarui Hasil Tes" if virus_data else "Simpan Hasil Tes Baru"
+        svirus = st.form_submit_button(f"💾 {svirus_label}", type="primary")
+
+    if svirus:
+        if virus_data:
+            payload = {"test_type": test_type, "result": result, "tested_on": tested_on, "lab": (lab or "").strip() or None}
+            res = update_virus_test(virus_data['id'], payload)
+            if res.ok:
                 st.success("Hasil tes diperbarui.")
                 clear_session_state('virus_to_edit')
-                st.rerun()
-            elif pid_virus:
-                insert_virus_test(int(pid_virus), test_type, result, tested_on, lab)
+                invalidate_fragment("virus", "ringkasan")
+                st.rerun(scope="fragment")
+            elif res.conflict == "not_found":
+                st.error(f"Hasil tes ID {virus_data['id']} tidak ditemukan.")
+            else:
+                st.error(f"Hasil tes {test_type} untuk pasien ini pada tanggal tersebut sudah ada.")
+        elif pid_virus:
+            res = insert_virus_test(int(pid_virus), test_type, result, tested_on, lab)
+            if res.ok:
                 st.success("Hasil tes disimpan.")
-                st.rerun()
+                invalidate_fragment("virus", "ringkasan")
+                st.rerun(scope="fragment")
             else:
-                if not virus_data: st.warning("Silakan pilih pasien terlebih dahulu.")
-
-        st.markdown("---")
-        st.markdown("### 📋 Data Tes Virus Terbaru")
-        
-        st.write("**Edit/Hapus Data Tes Virus**") 
-        search_name_virus = st.text_input("Ketik nama pasien untuk mencari riwayat dan mengedit", key="search_name_virus")
-        if st.button("Cari Riwayat Tes Virus", key="search_virus_button"):
-            clear_session_state('virus_to_edit')
-            clear_session_state('virus_matches')
-            st.session_state.virus_selected_patient_name = search_name_virus
-
-            if search_name_virus:
-                q = """
-                    SELECT v.id, p.full_name, v.test_type, v.result, v.tested_on
-                    FROM pwh.virus_tests v
-                    JOIN pwh.patients p ON p.id = v.patient_id
-                    WHERE p.full_name ILIKE :name ORDER BY v.id DESC
-                """
-                results_df = run_df_branch(q, {"name": f"%{search_name_virus}%"})
-
-                if results_df.empty:
-                    st.warning("Riwayat tes virus tidak ditemukan (di cabang Anda).")
-                else:
-                    st.info(f"Ditemukan {len(results_df)} riwayat. Silakan pilih satu untuk diedit/dihapus.")
-                    st.session_state.virus_matches = results_df
-                    
+                st.error(f"Hasil tes {test_type} untuk pasien ini pada tanggal tersebut sudah ada (ID: {res.conflict_id}).")
+        else:
+            if not virus_data: st.warning("Silakan pilih pasien terlebih dahulu.")
+
+    st.markdown("---")
+    st.markdown("### 📋 Data Tes Virus Terbaru")
+
+    st.write("**Edit/Hapus Data Tes Virus**") 
+    search_name_virus = st.text_input("Ketik nama pasien untuk mencari riwayat dan mengedit", key="search_name_virus")
+    if st.button("Cari Riwayat Tes Virus", key="search_virus_button"):
+        clear_session_state('virus_to_edit')
+        clear_session_state('virus_matches')
+        st.session_state.virus_selected_patient_name = search_name_virus
+
+        if search_name_virus:
+            q = """
+                SELECT v.id, p.full_name, v.test_type, v.result, v.tested_on
+                FROM pwh.virus_tests v
+                JOIN pwh.patients p ON p.id = v.patient_id
+                WHERE p.id = ANY(:ids) ORDER BY v.id DESC
+            """
+            results_df = run_df_branch(q, {"ids": get_patient_index().search(search_name_virus)})
+
+            if results_df.empty:
+                st.warning("Riwayat tes virus tidak ditemukan (di cabang Anda).")
             else:
-                st.warning("Silakan masukkan nama untuk dicari.")
-                st.session_state.virus_selected_patient_name = ""
-
-        if 'virus_matches' in st.session_state and not st.session_state.virus_matches.empty:
-            df_matches = st.session_state.virus_matches
-            options = {
-                f"ID: {row['id']} - {row['test_type']}: {row['result']} (Tgl: {row['tested_on']})": row['id']
-                for _, row in df_matches.iterrows()
-            }
-            selected_option = st.selectbox("Pilih riwayat tes:", options.keys(), key="select_virus_box")
+                st.info(f"Ditemukan {len(results_df)} riwayat. Silakan pilih satu untuk diedit/dihapus.")
+                st.session_state.virus_matches = results_df
+
+        else:
+            st.warning("Silakan masukkan nama untuk dicari.")
+            st.session_state.virus_selected_patient_name = ""
+
+    if 'virus_matches' in st.session_state and not st.session_state.virus_matches.empty:
+        df_matches = st.session_state.virus_matches
+        options = {
+            f"ID: {row['id']} - {row['test_type']}: {row['result']} (Tgl: {row['tested_on']})": row['id']
+            for _, row in df_matches.iterrows()
+        }
+        selected_option = st.selectbox("Pilih riwayat tes:", options.keys(), key="select_virus_box")
 
-            c_edit, c_del, c_spacer = st.columns([1, 1, 2])
-            with c_edit:
-                if st.button("📝 Edit Riwayat Ini", key="select_virus_button"):
-                    selected_id = options[selected_option]
-                    set_editing_state('virus_to_edit', selected_id, 'pwh.virus_tests')
+        c_edit, c_del, c_spacer = st.columns([1, 1, 2])
+        with c_edit:
+            if st.button("📝 Edit Riwayat Ini", key="select_virus_button"):
+                selected_id = options[selected_option]
+                set_editing_state('virus_to_edit', selected_id, 'pwh.virus_tests')
+                clear_session_state('virus_matches')
+                st.rerun(scope="fragment")
+        with c_del:
+            if st.button("❌ Hapus Riwayat Ini", key="delete_virus_button"):
+                selected_id = options[selected_option]
+                try:
+                    delete_virus_test(selected_id) 
+                    st.success(f"Data Tes Virus ID {selected_id} berhasil dihapus.")
                     clear_session_state('virus_matches')
-                    st.rerun()
-            with c_del:
-                if st.button("❌ Hapus Riwayat Ini", key="delete_virus_button"):
-                    selected_id = options[selected_option]
-                    try:
-                        delete_virus_test(selected_id) 
-                        st.success(f"Data Tes Virus ID {selected_id} berhasil dihapus.")
-                        clear_session_state('virus_matches')
-                        clear_session_state('virus_to_edit') 
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"Gagal menghapus ID {selected_id}: {e}")
-
-        query_virus = "SELECT v.id, v.patient_id, p.full_name, v.test_type, v.result, v.tested_on, v.lab FROM pwh.virus_tests v JOIN pwh.patients p ON p.id = v.patient_id"
-        params_virus = {}
-        if 'virus_selected_patient_name' in st.session_state and st.session_state.virus_selected_patient_name:
-            query_virus += " WHERE p.full_name ILIKE :name"
-            params_virus['name'] = f"%{st.session_state.virus_selected_patient_name}%"
-        query_virus += " ORDER BY p.full_name ASC, v.id DESC LIMIT 500;"
-        
-        df_virus = run_df_branch(query_virus, params_virus)
+                    clear_session_state('virus_to_edit') 
+                    invalidate_fragment("virus", "ringkasan")
+                    st.rerun(scope="fragment")
+                except Exception as e:
+                    st.error(f"Gagal menghapus ID {selected_id}: {e}")
+
+    # Hasil tes dimasker di query untuk tabel tampilan; grid edit butuh nilai asli
+    grid_on_virus = grid_mode("virus")
+    result_col = "v.result" if grid_on_virus else f"{MASK_LITERAL} AS result"
+    params_virus = {}
+    conditions = []
+    if 'virus_selected_patient_name' in st.session_state and st.session_state.virus_selected_patient_name:
+        conditions.append("p.id = ANY(:ids)")
+        params_virus['ids'] = get_patient_index().search(st.session_state.virus_selected_patient_name)
+
+    page_virus = paged_table("virus",
+        f"v.id, v.patient_id, p.full_name, v.test_type, {result_col}, v.tested_on, v.lab, " + DECEASED_COL,
+        "pwh.virus_tests v JOIN pwh.patients p ON p.id = v.patient_id" + DECEASED_JOIN,
+        id_col="v.id", conditions=conditions, params=params_virus,
+        sort_options={"Terbaru ditambahkan": ("v.id", True),
+                      "Tgl tes terbaru": ("COALESCE(v.tested_on, DATE '0001-01-01')", True)},
+        filters={"Jenis tes": ("v.test_type", VIRUS_TESTS)})
+    df_virus = page_virus.df
+
+    if grid_on_virus:
+        render_grid_editor("virus", df_virus, new_patient_id=pid_virus)
+    elif not df_virus.empty:
+        df_virus_display = df_virus.drop(columns=['id', 'patient_id', 'is_deceased'], errors='ignore')
+        df_virus_display.index = page_virus.index
+        df_virus_display.index.name = "No."
+        st.write(f"Total Data Tes Virus: **{page_virus.total_label}**")
+        # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
+        styled_df_virus = style_deceased_row(_alias_df(df_virus_display, ALIAS_VIRUS), df_virus['is_deceased'])
+        st.dataframe(styled_df_virus, use_container_width=True)
+        # --- END PERUBAHAN ---
+    else:
+        st.info("Tidak ada data tes virus untuk ditampilkan.")
+
 
-        if not df_virus.empty:
-            df_virus_display = df_virus.copy()
-            df_virus_display['result'] = '*****'
-            
-            df_virus_display = df_virus_display.drop(columns=['id', 'patient_id'], errors='ignore')
-            df_virus_display.index = range(1, len(df_virus_display) + 1)
-            df_virus_display.index.name = "No."
-            st.write(f"Total Data Tes Virus: **{len(df_virus_display)}**")
-            # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
-            styled_df_virus = style_deceased_row(_alias_df(df_virus_display, ALIAS_VIRUS), df_virus, 'patient_id')
-            st.dataframe(styled_df_virus, use_container_width=True)
-            # --- END PERUBAHAN ---
-        else:
-            st.info("Tidak ada data tes virus untuk ditampilkan.")
 
 
 # ==============================================================================
 # Rumah Sakit Penangan
 # ==============================================================================
-if tab_hospital:
-    with tab_hospital:
-        st.subheader("🏥 Tambah Data Rumah Sakit Penangan")
-            
-        hosp_data = st.session_state.get('hosp_to_edit', {})
-        if hosp_data:
-            st.info(f"Mode Edit untuk Data RS ID: {hosp_data.get('id')}")
-            if st.button("❌ Batal Edit", key="cancel_hosp_edit"):
-                clear_session_state('hosp_to_edit')
-                clear_session_state('hosp_matches')
-                st.rerun()
-                
-        default_patient_id_hosp = hosp_data.get('patient_id') if hosp_data else None
-        
-        pid_hosp = st.selectbox(
-            "Pilih Pasien (untuk data baru)",
-            options=patient_id_options, 
-            index=patient_id_options.index(default_patient_id_hosp) if default_patient_id_hosp in patient_id_options else 0,
-            format_func=format_patient_name,
-            key="hosp_patient_selector",
-            disabled=bool(hosp_data)
-        )
-        
-        with st.form("hospital::form", clear_on_submit=False):
-            hospital_list = fetch_hospitals()
-            name_h, city_h, prov_h = hosp_data.get('name_hospital'), hosp_data.get('city_hospital'), hosp_data.get('province_hospital')
-            hosp_val = f"{name_h} - {city_h} - {prov_h}" if all([name_h, city_h, prov_h]) else ''
-            hosp_idx = get_safe_index(hospital_list, hosp_val)
-            hospital_selection = st.selectbox("Nama Rumah Sakit*", hospital_list, index=hosp_idx)
-            
-            col_date, col_doc = st.columns(2)
-            with col_date:
-                visit_date_val = pd.to_datetime(hosp_data.get('date_of_visit')).date() if pd.notna(hosp_data.get('date_of_visit')) else None
-                date_of_visit = st.date_input("Tanggal Kunjungan", value=visit_date_val, format="YYYY-MM-DD", min_value=date(1920, 1, 1))
-            with col_doc:
-                doctor_in_charge = st.text_input("DPJP", value=hosp_data.get('doctor_in_charge', ''))
-
-            col1, col2 = st.columns(2)
-            with col1:
-                ttype_idx = get_safe_index(TREATMENT_TYPES, hosp_data.get('treatment_type'))
-                treatment_type = st.selectbox("Jenis Penanganan", TREATMENT_TYPES, index=ttype_idx)
-            with col2:
-                cserv_idx = get_safe_index(CARE_SERVICES, hosp_data.get('care_services'))
-                care_services = st.selectbox("Layanan Rawat", CARE_SERVICES, index=cserv_idx)
-            col3, col4 = st.columns(2)
-            with col3: frequency = st.text_input("Frekuensi", placeholder="Contoh: 1x Seminggu", value=hosp_data.get('frequency', ''))
-            with col4: dose = st.text_input("Dosis", placeholder="Contoh: 1000 IU", value=hosp_data.get('dose', ''))
-            prod_idx = get_safe_index(PRODUCTS, hosp_data.get('product'))
-            product = st.selectbox("Produk", PRODUCTS, index=prod_idx) 
-            merk = st.text_input("Merk", value=hosp_data.get('merk', ''))
-            shosp_label = "Perbarui Data" if hosp_data else "Simpan Data Baru"
-            shosp = st.form_submit_button(f"💾 {shosp_label}", type="primary")
-
-        if shosp:
-            if not hospital_selection: st.error("Nama Rumah Sakit wajib diisi.")
-            else:
-                parts = hospital_selection.split(' - ')
-                name_h, city_h, prov_h = (parts[0].strip(), parts[1].strip(), parts[2].strip()) if len(parts) == 3 else (hospital_selection, None, None)
-                payload = { 
-                    "name_hospital": name_h, "city_hospital": city_h, "province_hospital": prov_h, 
-                    "date_of_visit": date_of_visit, "doctor_in_charge": (doctor_in_charge or "").strip() or None,
-                    "treatment_type": treatment_type or None, "care_services": care_services or None, 
-                    "frequency": (frequency or "").strip() or None, "dose": (dose or "").strip() or None, 
-                    "product": product or None, "merk": (merk or "").strip() or None, 
-                }
-                if hosp_data:
-                    update_treatment_hospital(hosp_data['id'], payload)
+@st.fragment
+def render_tab_hospital():
+    st.subheader("🏥 Tambah Data Rumah Sakit Penangan")
+
+    hosp_data = st.session_state.get('hosp_to_edit', {})
+    if hosp_data:
+        st.info(f"Mode Edit untuk Data RS ID: {hosp_data.get('id')}")
+        if st.button("❌ Batal Edit", key="cancel_hosp_edit"):
+            clear_session_state('hosp_to_edit')
+            clear_session_state('hosp_matches')
+            st.rerun(scope="fragment")
+
+    default_patient_id_hosp = hosp_data.get('patient_id') if hosp_data else None
+
+    pid_hosp = pick_patient("hosp_patient_selector", default_id=default_patient_id_hosp, disabled=bool(hosp_data))
+
+    with st.form("hospital::form", clear_on_submit=False):
+        hospital_list = fetch_hospitals()
+        name_h, city_h, prov_h = hosp_data.get('name_hospital'), hosp_data.get('city_hospital'), hosp_data.get('province_hospital')
+        hosp_val = f"{name_h} - {city_h} - {prov_h}" if all([name_h, city_h, prov_h]) else ''
+        hosp_idx = get_safe_index(hospital_list, hosp_val)
+        hospital_selection = st.selectbox("Nama Rumah Sakit*", hospital_list, index=hosp_idx)
+
+        col_date, col_doc = st.columns(2)
+        with col_date:
+            visit_date_val = pd.to_datetime(hosp_data.get('date_of_visit')).date() if pd.notna(hosp_data.get('date_of_visit')) else None
+            date_of_visit = st.date_input("Tanggal Kunjungan", value=visit_date_val, format="YYYY-MM-DD", min_value=date(1920, 1, 1))
+        with col_doc:
+            doctor_in_charge = st.text_input("DPJP", value=hosp_data.get('doctor_in_charge', ''))
+
+        col1, col2 = st.columns(2)
+        with col1:
+            ttype_idx = get_safe_index(TREATMENT_TYPES, hosp_data.get('treatment_type'))
+            treatment_type = st.selectbox("Jenis Penanganan", TREATMENT_TYPES, index=ttype_idx)
+        with col2:
+            cserv_idx = get_safe_index(CARE_SERVICES, hosp_data.get('care_services'))
+            care_services = st.selectbox("Layanan Rawat", CARE_SERVICES, index=cserv_idx)
+        col3, col4 = st.columns(2)
+        with col3: frequency = st.text_input("Frekuensi", placeholder="Contoh: 1x Seminggu", value=hosp_data.get('frequency', ''))
+        with col4: dose = st.text_input("Dosis", placeholder="Contoh: 1000 IU", value=hosp_data.get('dose', ''))
+        prod_idx = get_safe_index(PRODUCTS, hosp_data.get('product'))
+        product = st.selectbox("Produk", PRODUCTS, index=prod_idx) 
+        merk = st.text_input("Merk", value=hosp_data.get('merk', ''))
+        shosp_label = "Perbarui Data" if hosp_data else "Simpan Data Baru"
+        shosp = st.form_submit_button(f"💾 {shosp_label}", type="primary")
+
+    if shosp:
+        if not hospital_selection: st.error("Nama Rumah Sakit wajib diisi.")
+        else:
+            parts = hospital_selection.split(' - ')
+            name_h, city_h, prov_h = (parts[0].strip(), parts[1].strip(), parts[2].strip()) if len(parts) == 3 else (hospital_selection, None, None)
+            payload = { 
+                "name_hospital": name_h, "city_hospital": city_h, "province_hospital": prov_h, 
+                "date_of_visit": date_of_visit, "doctor_in_charge": (doctor_in_charge or "").strip() or None,
+                "treatment_type": treatment_type or None, "care_services": care_services or None, 
+                "frequency": (frequency or "").strip() or None, "dose": (dose or "").strip() or None, 
+                "product": product or None, "merk": (merk or "").strip() or None, 
+            }
+            if hosp_data:
+                res = update_treatment_hospital(hosp_data['id'], payload)
+                if res.ok:
                     st.success("Data penanganan diperbarui.")
                     clear_session_state('hosp_to_edit')
-                    st.rerun()
-                elif pid_hosp:
-                    payload['patient_id'] = int(pid_hosp)
-                    insert_treatment_hospital(payload)
-                    st.success("Data penanganan disimpan.")
-                    st.rerun()
+                    invalidate_fragment("hosp")
+                    st.rerun(scope="fragment")
+                elif res.conflict == "not_found":
+                    st.error(f"Data penanganan ID {hosp_data['id']} tidak ditemukan.")
                 else:
-                    if not hosp_data: st.warning("Silakan pilih pasien terlebih dahulu.")
-                
-        st.markdown("---")
-        st.markdown("### 📋 Data Penanganan RS Terbaru")
-        
-        st.write("**Edit/Hapus Data Penanganan RS**") 
-        search_name_hosp = st.text_input("Ketik nama pasien untuk mencari riwayat dan mengedit", key="search_name_hosp")
-        if st.button("Cari Riwayat Penanganan", key="search_hosp_button"):
-            clear_session_state('hosp_to_edit')
-            clear_session_state('hosp_matches')
-            st.session_state.hosp_selected_patient_name = search_name_hosp
-
-            if search_name_hosp:
-                q = """
-                    SELECT th.id, p.full_name, th.name_hospital, th.date_of_visit, th.product
-                    FROM pwh.treatment_hospital th
-                    JOIN pwh.patients p ON p.id = th.patient_id
-                    WHERE p.full_name ILIKE :name ORDER BY th.id DESC
-                """
-                results_df = run_df_branch(q, {"name": f"%{search_name_hosp}%"})
-
-                if results_df.empty:
-                    st.warning("Riwayat penanganan RS tidak ditemukan (di cabang Anda).")
+                    st.error(f"Gagal Update: data bentrok dengan data lain ({res.conflict}).")
+            elif pid_hosp:
+                payload['patient_id'] = int(pid_hosp)
+                res = insert_treatment_hospital(payload)
+                if res.ok:
+                    st.success("Data penanganan disimpan.")
+                    invalidate_fragment("hosp")
+                    st.rerun(scope="fragment")
                 else:
-                    st.info(f"Ditemukan {len(results_df)} riwayat. Silakan pilih satu untuk diedit/dihapus.")
-                    st.session_state.hosp_matches = results_df
-                    
+                    st.error(f"Gagal Simpan: data bentrok dengan data lain ({res.conflict}).")
             else:
-                st.warning("Silakan masukkan nama untuk dicari.")
-                st.session_state.hosp_selected_patient_name = ""
-
-        if 'hosp_matches' in st.session_state and not st.session_state.hosp_matches.empty:
-            df_matches = st.session_state.hosp_matches
-            options = {
-                f"ID: {row['id']} - {row['name_hospital']} (Kunjungan: {row['date_of_visit']})": row['id']
-                for _, row in df_matches.iterrows()
-            }
-            selected_option = st.selectbox("Pilih riwayat penanganan:", options.keys(), key="select_hosp_box")
-            
-            c_edit, c_del, c_spacer = st.columns([1, 1, 2]) 
-            
-            with c_edit:
-                if st.button("📝 Edit Riwayat Ini", key="select_hosp_button"): 
-                    selected_id = options[selected_option]
-                    set_editing_state('hosp_to_edit', selected_id, 'pwh.treatment_hospital')
-                    clear_session_state('hosp_matches')
-                    st.rerun()
-            
-            with c_del:
-                if st.button("❌ Hapus Riwayat Ini", key="delete_hosp_button"):
-                    selected_id = options[selected_option]
-                    try:
-                        delete_treatment_hospital(selected_id)
-                        st.success(f"Data Penanganan ID {selected_id} berhasil dihapus.")
-                        clear_session_state('hosp_matches')
-                        clear_session_state('hosp_to_edit') 
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"Gagal menghapus ID {selected_id}: {e}")
-
-        query_hosp = "SELECT th.id, th.patient_id, p.full_name, th.name_hospital, th.city_hospital, th.province_hospital, th.date_of_visit, th.doctor_in_charge, th.treatment_type, th.care_services, th.frequency, th.dose, th.product, th.merk FROM pwh.treatment_hospital th JOIN pwh.patients p ON p.id = th.patient_id"
-        params_hosp = {}
-        if 'hosp_selected_patient_name' in st.session_state and st.session_state.hosp_selected_patient_name:
-            query_hosp += " WHERE p.full_name ILIKE :name"
-            params_hosp['name'] = f"%{st.session_state.hosp_selected_patient_name}%"
-        query_hosp += " ORDER BY p.full_name ASC, th.id DESC;"
-
-        df_th = run_df_branch(query_hosp, params_hosp)
-        
-        if not df_th.empty:
-            df_th_display = df_th.drop(columns=['id', 'patient_id'], errors='ignore')
-            df_th_display.index = range(1, len(df_th_display) + 1)
-            df_th_display.index.name = "No."
-            st.write(f"Total Data Penanganan: **{len(df_th_display)}**")
-            # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
-            styled_df_th = style_deceased_row(_alias_df(df_th_display, ALIAS_HOSPITAL), df_th, 'patient_id')
-            st.dataframe(styled_df_th, use_container_width=True)
-            # --- END PERUBAHAN ---
+                if not hosp_data: st.warning("Silakan pilih pasien terlebih dahulu.")
+
+    st.markdown("---")
+    st.markdown("### 📋 Data Penanganan RS Terbaru")
+
+    st.write("**Edit/Hapus Data Penanganan RS**") 
+    search_name_hosp = st.text_input("Ketik nama pasien untuk mencari riwayat dan mengedit", key="search_name_hosp")
+    if st.button("Cari Riwayat Penanganan", key="search_hosp_button"):
+        clear_session_state('hosp_to_edit')
+        clear_session_state('hosp_matches')
+        st.session_state.hosp_selected_patient_name = search_name_hosp
+
+        if search_name_hosp:
+            q = """
+                SELECT th.id, p.full_name, th.name_hospital, th.date_of_visit, th.product
+                FROM pwh.treatment_hospital th
+                JOIN pwh.patients p ON p.id = th.patient_id
+                WHERE p.id = ANY(:ids) ORDER BY th.id DESC
+            """
+            results_df = run_df_branch(q, {"ids": get_patient_index().search(search_name_hosp)})
+
+            if results_df.empty:
+                st.warning("Riwayat penanganan RS tidak ditemukan (di cabang Anda).")
+            else:
+                st.info(f"Ditemukan {len(results_df)} riwayat. Silakan pilih satu untuk diedit/dihapus.")
+                st.session_state.hosp_matches = results_df
+
         else:
-            st.info("Tidak ada data penanganan RS untuk ditampilkan.")
+            st.warning("Silakan masukkan nama untuk dicari.")
+            st.session_state.hosp_selected_patient_name = ""
+
+    if 'hosp_matches' in st.session_state and not st.session_state.hosp_matches.empty:
+        df_matches = st.session_state.hosp_matches
+        options = {
+            f"ID: {row['id']} - {row['name_hospital']} (Kunjungan: {row['date_of_visit']})": row['id']
+            for _, row in df_matches.iterrows()
+        }
+        selected_option = st.selectbox("Pilih riwayat penanganan:", options.keys(), key="select_hosp_box")
 
-# Kematian
-if tab_death:
-    with tab_death:
-        st.subheader("⚰️ Tambah Data Data Kematian")
+        c_edit, c_del, c_spacer = st.columns([1, 1, 2]) 
 
-        death_data = st.session_state.get('death_to_edit', {})
-        if death_data:
-            st.info(f"Mode Edit untuk Data Kematian ID: {death_data.get('id')}")
-            if st.button("❌ Batal Edit", key="cancel_death_edit"):
-                clear_session_state('death_to_edit')
-                clear_session_state('death_matches') 
-                st.rerun()
-        
-        default_patient_id_death = death_data.get('patient_id') if death_data else None
-
-        pid_death = st.selectbox(
-            "Pilih Pasien (untuk data baru)",
-            options=patient_id_options, 
-            index=patient_id_options.index(default_patient_id_death) if default_patient_id_death in patient_id_options else 0,
-            format_func=format_patient_name,
-            key="death_patient_selector",
-            disabled=bool(death_data)
-        )
+        with c_edit:
+            if st.button("📝 Edit Riwayat Ini", key="select_hosp_button"): 
+                selected_id = options[selected_option]
+                set_editing_state('hosp_to_edit', selected_id, 'pwh.treatment_hospital')
+                clear_session_state('hosp_matches')
+                st.rerun(scope="fragment")
 
-        with st.form("death::form", clear_on_submit=False):
-            cause_of_death = st.text_area("Penyebab Kematian", value=death_data.get('cause_of_death', ''))
-            current_year = date.today().year
-            year_of_death_val = death_data.get('year_of_death')
-            if year_of_death_val:
+        with c_del:
+            if st.button("❌ Hapus Riwayat Ini", key="delete_hosp_button"):
+                selected_id = options[selected_option]
                 try:
-                    year_of_death_val = int(year_of_death_val)
-                except (ValueError, TypeError):
-                    year_of_death_val = current_year 
-            else:
-                 year_of_death_val = current_year 
+                    delete_treatment_hospital(selected_id)
+                    st.success(f"Data Penanganan ID {selected_id} berhasil dihapus.")
+                    clear_session_state('hosp_matches')
+                    clear_session_state('hosp_to_edit') 
+                    invalidate_fragment("hosp")
+                    st.rerun(scope="fragment")
+                except Exception as e:
+                    st.error(f"Gagal menghapus ID {selected_id}: {e}")
+
+    params_hosp = {}
+    conditions = []
+    if 'hosp_selected_patient_name' in st.session_state and st.session_state.hosp_selected_patient_name:
+        conditions.append("p.id = ANY(:ids)")
+        params_hosp['ids'] = get_patient_index().search(st.session_state.hosp_selected_patient_name)
+
+    page_th = paged_table("hosp",
+        "th.id, th.patient_id, p.full_name, th.name_hospital, th.city_hospital, th.province_hospital, th.date_of_visit, th.doctor_in_charge, th.treatment_type, th.care_services, th.frequency, th.dose, th.product, th.merk, " + DECEASED_COL,
+        "pwh.treatment_hospital th JOIN pwh.patients p ON p.id = th.patient_id" + DECEASED_JOIN,
+        id_col="th.id", conditions=conditions, params=params_hosp,
+        sort_options={"Terbaru ditambahkan": ("th.id", True),
+                      "Tgl kunjungan terbaru": ("COALESCE(th.date_of_visit, DATE '0001-01-01')", True)},
+        filters={"Jenis penanganan": ("th.treatment_type", TREATMENT_TYPES), "Layanan": ("th.care_services", CARE_SERVICES)})
+    df_th = page_th.df
+
+    if grid_mode("hosp"):
+        render_grid_editor("hosp", df_th, new_patient_id=pid_hosp)
+    elif not df_th.empty:
+        df_th_display = df_th.drop(columns=['id', 'patient_id', 'is_deceased'], errors='ignore')
+        df_th_display.index = page_th.index
+        df_th_display.index.name = "No."
+        st.write(f"Total Data Penanganan: **{page_th.total_label}**")
+        # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
+        styled_df_th = style_deceased_row(_alias_df(df_th_display, ALIAS_HOSPITAL), df_th['is_deceased'])
+        st.dataframe(styled_df_th, use_container_width=True)
+        # --- END PERUBAHAN ---
+    else:
+        st.info("Tidak ada data penanganan RS untuk ditampilkan.")
 
-            year_of_death = st.number_input("Tahun Kematian", min_value=1900, max_value=current_year, value=year_of_death_val, step=1)
-            
-            sdeath_label = "Perbarui Data Kematian" if death_data else "Simpan Data Kematian"
-            sdeath = st.form_submit_button(f"💾 {sdeath_label}", type="primary")
 
-        if sdeath:
-            payload = { "cause_of_death": (cause_of_death or "").strip() or None, "year_of_death": int(year_of_death) if year_of_death else None }
-            if death_data:
-                update_death_record(death_data['id'], payload)
+
+# Kematian
+@st.fragment
+def render_tab_kematian():
+    st.subheader("⚰️ Tambah Data Data Kematian")
+
+    death_data = st.session_state.get('death_to_edit', {})
+    if death_data:
+        st.info(f"Mode Edit untuk Data Kematian ID: {death_data.get('id')}")
+        if st.button("❌ Batal Edit", key="cancel_death_edit"):
+            clear_session_state('death_to_edit')
+            clear_session_state('death_matches') 
+            st.rerun(scope="fragment")
+
+    default_patient_id_death = death_data.get('patient_id') if death_data else None
+
+    pid_death = pick_patient("death_patient_selector", default_id=default_patient_id_death, disabled=bool(death_data))
+
+    with st.form("death::form", clear_on_submit=False):
+        cause_of_death = st.text_area("Penyebab Kematian", value=death_data.get('cause_of_death', ''))
+        current_year = date.today().year
+        year_of_death_val = death_data.get('year_of_death')
+        if year_of_death_val:
+            try:
+                year_of_death_val = int(year_of_death_val)
+            except (ValueError, TypeError):
+                year_of_death_val = current_year 
+        else:
+             year_of_death_val = current_year 
+
+        year_of_death = st.number_input("Tahun Kematian", min_value=1900, max_value=current_year, value=year_of_death_val, step=1)
+
+        sdeath_label = "Perbarui Data Kematian" if death_data else "Simpan Data Kematian"
+        sdeath = st.form_submit_button(f"💾 {sdeath_label}", type="primary")
+
+    if sdeath:
+        payload = { "cause_of_death": (cause_of_death or "").strip() or None, "year_of_death": int(year_of_death) if year_of_death else None }
+        if death_data:
+            res = update_death_record(death_data['id'], payload)
+            if res.ok:
                 st.success("Data kematian diperbarui.")
                 clear_session_state('death_to_edit')
                 clear_session_state('death_matches') 
+                invalidate_fragment()
                 st.rerun()
-            elif pid_death:
-                payload['patient_id'] = int(pid_death)
-                insert_death_record(payload)
-                st.success("Data kematian disimpan.")
+            elif res.conflict == "not_found":
+                st.error(f"Data kematian ID {death_data['id']} tidak ditemukan.")
+            else:
+                st.error(f"Gagal Update: data bentrok dengan data lain ({res.conflict}).")
+        elif pid_death:
+            payload['patient_id'] = int(pid_death)
+            res = insert_death_record(payload)
+            if res.ok:
+                st.success("Data kematian disimpan." if res.created else "Data kematian pasien ini sudah ada dan telah diperbarui.")
+                invalidate_fragment()
                 st.rerun()
             else:
-                if not death_data: st.warning("Silakan pilih pasien terlebih dahulu.")
+                st.error(f"Gagal Simpan: data bentrok dengan data lain ({res.conflict}).")
+        else:
+            if not death_data: st.warning("Silakan pilih pasien terlebih dahulu.")
+
+    st.markdown("---")
+    st.markdown("### 📋 Data Kematian Terbaru")
+
+    st.write("**Edit/Hapus Data Kematian**") 
+    search_name_death = st.text_input("Ketik nama pasien untuk mencari & mengedit/hapus", key="search_name_death") 
+
+    if st.button("Cari Data Kematian", key="search_death_button"):
+        clear_session_state('death_to_edit')
+        clear_session_state('death_matches') 
+        st.session_state.death_selected_patient_name = search_name_death
+
+        if search_name_death:
+            q = """
+                SELECT d.id, p.full_name, d.year_of_death
+                FROM pwh.death d
+                JOIN pwh.patients p ON p.id = d.patient_id
+                WHERE p.id = ANY(:ids)
+            """
+            results_df = run_df_branch(q, {"ids": get_patient_index().search(search_name_death)})
+
+            if results_df.empty:
+                st.warning("Data kematian tidak ditemukan (di cabang Anda).")
+            else:
+                st.info(f"Ditemukan 1 data kematian. Pilih untuk edit/hapus.")
+                st.session_state.death_matches = results_df
 
-        st.markdown("---")
-        st.markdown("### 📋 Data Kematian Terbaru")
+        else:
+            st.warning("Silakan masukkan nama untuk dicari.")
+            st.session_state.death_selected_patient_name = ""
+
+    if 'death_matches' in st.session_state and not st.session_state.death_matches.empty:
+        df_matches = st.session_state.death_matches
+        row = df_matches.iloc[0]
+        options = {
+            f"ID: {row['id']} - {row['full_name']} (Tahun: {row['year_of_death']})": row['id']
+        }
 
-        st.write("**Edit/Hapus Data Kematian**") 
-        search_name_death = st.text_input("Ketik nama pasien untuk mencari & mengedit/hapus", key="search_name_death") 
-        
-        if st.button("Cari Data Kematian", key="search_death_button"):
-            clear_session_state('death_to_edit')
-            clear_session_state('death_matches') 
-            st.session_state.death_selected_patient_name = search_name_death
-
-            if search_name_death:
-                q = """
-                    SELECT d.id, p.full_name, d.year_of_death
-                    FROM pwh.death d
-                    JOIN pwh.patients p ON p.id = d.patient_id
-                    WHERE p.full_name ILIKE :name
-                """
-                results_df = run_df_branch(q, {"name": f"%{search_name_death}%"})
-                
-                if results_df.empty:
-                    st.warning("Data kematian tidak ditemukan (di cabang Anda).")
-                else:
-                    st.info(f"Ditemukan 1 data kematian. Pilih untuk edit/hapus.")
-                    st.session_state.death_matches = results_df
-                
-            else:
-                st.warning("Silakan masukkan nama untuk dicari.")
-                st.session_state.death_selected_patient_name = ""
-        
-        if 'death_matches' in st.session_state and not st.session_state.death_matches.empty:
-            df_matches = st.session_state.death_matches
-            row = df_matches.iloc[0]
-            options = {
-                f"ID: {row['id']} - {row['full_name']} (Tahun: {row['year_of_death']})": row['id']
-            }
-            
-            selected_option = st.selectbox("Pilih data kematian:", options.keys(), key="select_death_box")
-            
-            c_edit, c_del, c_spacer = st.columns([1, 1, 2])
-            with c_edit:
-                if st.button("📝 Edit Data Ini", key="select_death_button"):
-                    selected_id = options[selected_option]
-                    set_editing_state('death_to_edit', selected_id, 'pwh.death')
+        selected_option = st.selectbox("Pilih data kematian:", options.keys(), key="select_death_box")
+
+        c_edit, c_del, c_spacer = st.columns([1, 1, 2])
+        with c_edit:
+            if st.button("📝 Edit Data Ini", key="select_death_button"):
+                selected_id = options[selected_option]
+                set_editing_state('death_to_edit', selected_id, 'pwh.death')
+                clear_session_state('death_matches')
+                st.rerun(scope="fragment")
+        with c_del:
+            if st.button("❌ Hapus Data Ini", key="delete_death_button"):
+                selected_id = options[selected_option]
+                try:
+                    delete_death_record(selected_id) 
+                    st.success(f"Data Kematian ID {selected_id} berhasil dihapus.")
                     clear_session_state('death_matches')
+                    clear_session_state('death_to_edit')
+                    invalidate_fragment()
                     st.rerun()
-            with c_del:
-                if st.button("❌ Hapus Data Ini", key="delete_death_button"):
-                    selected_id = options[selected_option]
-                    try:
-                        delete_death_record(selected_id) 
-                        st.success(f"Data Kematian ID {selected_id} berhasil dihapus.")
-                        clear_session_state('death_matches')
-                        clear_session_state('death_to_edit')
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"Gagal menghapus ID {selected_id}: {e}")
-
-        query_death = "SELECT d.id, d.patient_id, p.full_name, d.cause_of_death, d.year_of_death FROM pwh.death d JOIN pwh.patients p ON p.id = d.patient_id"
-        params_death = {}
-        if 'death_selected_patient_name' in st.session_state and st.session_state.death_selected_patient_name:
-            query_death += " WHERE p.full_name ILIKE :name"
-            params_death['name'] = f"%{st.session_state.death_selected_patient_name}%"
-        query_death += " ORDER BY p.full_name ASC, d.id DESC;"
-        
-        df_death = run_df_branch(query_death, params_death)
-
-        if not df_death.empty:
-            df_death_display = df_death.drop(columns=['id', 'patient_id'], errors='ignore')
-            df_death_display.index = range(1, len(df_death_display) + 1)
-            df_death_display.index.name = "No."
-            st.write(f"Total Data Kematian: **{len(df_death_display)}**")
-            # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
-            styled_df_death = style_deceased_row(_alias_df(df_death_display, ALIAS_DEATH), df_death, 'patient_id')
-            st.dataframe(styled_df_death, use_container_width=True)
-            # --- END PERUBAHAN ---
-        else:
-            st.info("Tidak ada data kematian untuk ditampilkan.")
+                except Exception as e:
+                    st.error(f"Gagal menghapus ID {selected_id}: {e}")
+
+    params_death = {}
+    conditions = []
+    if 'death_selected_patient_name' in st.session_state and st.session_state.death_selected_patient_name:
+        conditions.append("p.id = ANY(:ids)")
+        params_death['ids'] = get_patient_index().search(st.session_state.death_selected_patient_name)
+
+    page_death = paged_table("death",
+        "d.id, d.patient_id, p.full_name, d.cause_of_death, d.year_of_death, TRUE AS is_deceased",
+        "pwh.death d JOIN pwh.patients p ON p.id = d.patient_id",
+        id_col="d.id", conditions=conditions, params=params_death,
+        sort_options={"Terbaru ditambahkan": ("d.id", True),
+                      "Tahun wafat terbaru": ("COALESCE(d.year_of_death, 0)", True)})
+    df_death = page_death.df
+
+    if grid_mode("death"):
+        render_grid_editor("death", df_death, new_patient_id=pid_death)
+    elif not df_death.empty:
+        df_death_display = df_death.drop(columns=['id', 'patient_id', 'is_deceased'], errors='ignore')
+        df_death_display.index = page_death.index
+        df_death_display.index.name = "No."
+        st.write(f"Total Data Kematian: **{page_death.total_label}**")
+        # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
+        styled_df_death = style_deceased_row(_alias_df(df_death_display, ALIAS_DEATH), df_death['is_deceased'])
+        st.dataframe(styled_df_death, use_container_width=True)
+        # --- END PERUBAHAN ---
+    else:
+        st.info("Tidak ada data kematian untuk ditampilkan.")
+
+
 
 
 # Kontak
-if tab_contacts:
-    with tab_contacts:
-        st.subheader("👨‍👩‍👧 Tambah Data Kontak")
-
-        cont_data = st.session_state.get('contact_to_edit', {})
-        if cont_data:
-            st.info(f"Mode Edit untuk Kontak ID: {cont_data.get('id')}")
-            if st.button("❌ Batal Edit", key="cancel_cont_edit"):
-                clear_session_state('contact_to_edit')
-                clear_session_state('contact_matches')
-                st.rerun()
-        
-        default_patient_id_cont = cont_data.get('patient_id') if cont_data else None
-        
-        pid_cont = st.selectbox(
-            "Pilih Pasien (untuk data baru)",
-            options=patient_id_options, 
-            index=patient_id_options.index(default_patient_id_cont) if default_patient_id_cont in patient_id_options else 0,
-            format_func=format_patient_name,
-            key="cont_patient_selector",
-            disabled=bool(cont_data)
-        )
-        
-        with st.form("contact::form", clear_on_submit=False):
-            relation_idx = get_safe_index(RELATIONS, cont_data.get('relation'))
-            relation = st.selectbox("Relasi", RELATIONS, index=relation_idx)
-            name = st.text_input("Nama Kontak*", value=cont_data.get('name', ''))
-            phone = st.text_input("No. Telp", value=cont_data.get('phone', ''))
-            is_primary = st.checkbox("Kontak Utama?", value=bool(cont_data.get('is_primary', False)))
-            scont_label = "Perbarui Kontak" if cont_data else "Simpan Kontak Baru"
-            scont = st.form_submit_button(f"💾 {scont_label}", type="primary")
-
-        if scont:
-            if not name.strip():
-                st.error("Nama Kontak wajib diisi.")
-            elif not relation:
-                st.error("Relasi wajib diisi.")
-            else:
-                payload = {"relation": relation, "name": name, "phone": (phone or "").strip() or None, "is_primary": is_primary}
-                if cont_data:
-                    update_contact(cont_data['id'], payload)
+@st.fragment
+def render_tab_kontak():
+    st.subheader("👨‍👩‍👧 Tambah Data Kontak")
+
+    cont_data = st.session_state.get('contact_to_edit', {})
+    if cont_data:
+        st.info(f"Mode Edit untuk Kontak ID: {cont_data.get('id')}")
+        if st.button("❌ Batal Edit", key="cancel_cont_edit"):
+            clear_session_state('contact_to_edit')
+            clear_session_state('contact_matches')
+            st.rerun(scope="fragment")
+
+    default_patient_id_cont = cont_data.get('patient_id') if cont_data else None
+
+    pid_cont = pick_patient("cont_patient_selector", default_id=default_patient_id_cont, disabled=bool(cont_data))
+
+    with st.form("contact::form", clear_on_submit=False):
+        relation_idx = get_safe_index(RELATIONS, cont_data.get('relation'))
+        relation = st.selectbox("Relasi", RELATIONS, index=relation_idx)
+        name = st.text_input("Nama Kontak*", value=cont_data.get('name', ''))
+        phone = st.text_input("No. Telp", value=cont_data.get('phone', ''))
+        is_primary = st.checkbox("Kontak Utama?", value=bool(cont_data.get('is_primary', False)))
+        scont_label = "Perbarui Kontak" if cont_data else "Simpan Kontak Baru"
+        scont = st.form_submit_button(f"💾 {scont_label}", type="primary")
+
+    if scont:
+        if not name.strip():
+            st.error("Nama Kontak wajib diisi.")
+        elif not relation:
+            st.error("Relasi wajib diisi.")
+        else:
+            payload = {"relation": relation, "name": name, "phone": (phone or "").strip() or None, "is_primary": is_primary}
+            if cont_data:
+                res = update_contact(cont_data['id'], payload)
+                if res.ok:
                     st.success("Kontak diperbarui.")
                     clear_session_state('contact_to_edit')
-                    st.rerun()
-                elif pid_cont:
-                    insert_contact(int(pid_cont), relation, name, phone, is_primary)
-                    st.success("Kontak baru ditambahkan.")
-                    st.rerun()
+                    invalidate_fragment("kontak", "ringkasan")
+                    st.rerun(scope="fragment")
+                elif res.conflict == "not_found":
+                    st.error(f"Kontak ID {cont_data['id']} tidak ditemukan.")
                 else:
-                    if not cont_data: st.warning("Silakan pilih pasien terlebih dahulu.")
-
-        st.markdown("---")
-        st.markdown("### 📋 Data Kontak Terbaru")
-        
-        st.write("**Edit/Hapus Data Kontak**") 
-        search_name_cont = st.text_input("Ketik nama pasien untuk mencari riwayat dan mengedit", key="search_name_cont")
-        if st.button("Cari Kontak", key="search_cont_button"):
-            clear_session_state('contact_to_edit')
-            clear_session_state('contact_matches')
-            st.session_state.cont_selected_patient_name = search_name_cont
-
-            if search_name_cont:
-                q = """
-                    SELECT c.id, p.full_name, c.name, c.relation
-                    FROM pwh.contacts c
-                    JOIN pwh.patients p ON p.id = c.patient_id
-                    WHERE p.full_name ILIKE :name ORDER BY c.id DESC
-                """
-                results_df = run_df_branch(q, {"name": f"%{search_name_cont}%"})
-
-                if results_df.empty:
-                    st.warning("Kontak tidak ditemukan (di cabang Anda).")
+                    st.error(f"Gagal Update: data bentrok dengan data lain ({res.conflict}).")
+            elif pid_cont:
+                res = insert_contact(int(pid_cont), relation, name, phone, is_primary)
+                if res.ok:
+                    st.success("Kontak baru ditambahkan.")
+                    invalidate_fragment("kontak", "ringkasan")
+                    st.rerun(scope="fragment")
                 else:
-                    st.info(f"Ditemukan {len(results_df)} kontak. Silakan pilih satu untuk diedit/dihapus.")
-                    st.session_state.contact_matches = results_df
-                    
+                    st.error(f"Gagal Simpan: data bentrok dengan data lain ({res.conflict}).")
             else:
-                st.warning("Silakan masukkan nama untuk dicari.")
-                st.session_state.cont_selected_patient_name = ""
-
-        if 'contact_matches' in st.session_state and not st.session_state.contact_matches.empty:
-            df_matches = st.session_state.contact_matches
-            options = {
-                f"ID: {row['id']} - {row['name']} ({row['relation']})": row['id']
-                for _, row in df_matches.iterrows()
-            }
-            selected_option = st.selectbox("Pilih kontak:", options.keys(), key="select_cont_box")
+                if not cont_data: st.warning("Silakan pilih pasien terlebih dahulu.")
+
+    st.markdown("---")
+    st.markdown("### 📋 Data Kontak Terbaru")
+
+    st.write("**Edit/Hapus Data Kontak**") 
+    search_name_cont = st.text_input("Ketik nama pasien untuk mencari riwayat dan mengedit", key="search_name_cont")
+    if st.button("Cari Kontak", key="search_cont_button"):
+        clear_session_state('contact_to_edit')
+        clear_session_state('contact_matches')
+        st.session_state.cont_selected_patient_name = search_name_cont
+
+        if search_name_cont:
+            q = """
+                SELECT c.id, p.full_name, c.name, c.relation
+                FROM pwh.contacts c
+                JOIN pwh.patients p ON p.id = c.patient_id
+                WHERE p.id = ANY(:ids) ORDER BY c.id DESC
+            """
+            results_df = run_df_branch(q, {"ids": get_patient_index().search(search_name_cont)})
+
+            if results_df.empty:
+                st.warning("Kontak tidak ditemukan (di cabang Anda).")
+            else:
+                st.info(f"Ditemukan {len(results_df)} kontak. Silakan pilih satu untuk diedit/dihapus.")
+                st.session_state.contact_matches = results_df
 
-            c_edit, c_del, c_spacer = st.columns([1, 1, 2])
-            with c_edit:
-                if st.button("📝 Edit Kontak Ini", key="select_cont_button"):
-                    selected_id = options[selected_option]
-                    set_editing_state('contact_to_edit', selected_id, 'pwh.contacts')
-                    clear_session_state('contact_matches')
-                    st.rerun()
-            with c_del:
-                if st.button("❌ Hapus Kontak Ini", key="delete_cont_button"):
-                    selected_id = options[selected_option]
-                    try:
-                        delete_contact(selected_id) 
-                        st.success(f"Data Kontak ID {selected_id} berhasil dihapus.")
-                        clear_session_state('contact_matches')
-                        clear_session_state('contact_to_edit') 
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"Gagal menghapus ID {selected_id}: {e}")
-
-        query_cont = "SELECT c.id, c.patient_id, p.full_name, c.relation, c.name, c.phone, c.is_primary FROM pwh.contacts c JOIN pwh.patients p ON p.id = c.patient_id"
-        params_cont = {}
-        if 'cont_selected_patient_name' in st.session_state and st.session_state.cont_selected_patient_name:
-            query_cont += " WHERE p.full_name ILIKE :name"
-            params_cont['name'] = f"%{st.session_state.cont_selected_patient_name}%"
-        query_cont += " ORDER BY p.full_name ASC, c.id DESC LIMIT 500;"
-        
-        df_contacts = run_df_branch(query_cont, params_cont)
-
-        if not df_contacts.empty:
-            df_contacts_display = df_contacts.drop(columns=['id', 'patient_id'], errors='ignore')
-            df_contacts_display.index = range(1, len(df_contacts_display) + 1)
-            df_contacts_display.index.name = "No."
-            st.write(f"Total Data Kontak: **{len(df_contacts_display)}**")
-            # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
-            styled_df_contacts = style_deceased_row(_alias_df(df_contacts_display, ALIAS_CONTACTS), df_contacts, 'patient_id')
-            st.dataframe(styled_df_contacts, use_container_width=True)
-            # --- END PERUBAHAN ---
         else:
-            st.info("Tidak ada data kontak untuk ditampilkan.")
+            st.warning("Silakan masukkan nama untuk dicari.")
+            st.session_state.cont_selected_patient_name = ""
+
+    if 'contact_matches' in st.session_state and not st.session_state.contact_matches.empty:
+        df_matches = st.session_state.contact_matches
+        options = {
+            f"ID: {row['id']} - {row['name']} ({row['relation']})": row['id']
+            for _, row in df_matches.iterrows()
+        }
+        selected_option = st.selectbox("Pilih kontak:", options.keys(), key="select_cont_box")
+
+        c_edit, c_del, c_spacer = st.columns([1, 1, 2])
+        with c_edit:
+            if st.button("📝 Edit Kontak Ini", key="select_cont_button"):
+                selected_id = options[selected_option]
+                set_editing_state('contact_to_edit', selected_id, 'pwh.contacts')
+                clear_session_state('contact_matches')
+                st.rerun(scope="fragment")
+        with c_del:
+            if st.button("❌ Hapus Kontak Ini", key="delete_cont_button"):
+                selected_id = options[selected_option]
+                try:
+                    delete_contact(selected_id) 
+                    st.success(f"Data Kontak ID {selected_id} berhasil dihapus.")
+                    clear_session_state('contact_matches')
+                    clear_session_state('contact_to_edit') 
+                    invalidate_fragment("kontak", "ringkasan")
+                    st.rerun(scope="fragment")
+                except Exception as e:
+                    st.error(f"Gagal menghapus ID {selected_id}: {e}")
+
+    params_cont = {}
+    conditions = []
+    if 'cont_selected_patient_name' in st.session_state and st.session_state.cont_selected_patient_name:
+        conditions.append("p.id = ANY(:ids)")
+        params_cont['ids'] = get_patient_index().search(st.session_state.cont_selected_patient_name)
+
+    page_cont = paged_table("kontak",
+        "c.id, c.patient_id, p.full_name, c.relation, c.name, c.phone, c.is_primary, " + DECEASED_COL,
+        "pwh.contacts c JOIN pwh.patients p ON p.id = c.patient_id" + DECEASED_JOIN,
+        id_col="c.id", conditions=conditions, params=params_cont,
+        sort_options={"Terbaru ditambahkan": ("c.id", True)},
+        filters={"Hubungan": ("c.relation", RELATIONS)})
+    df_contacts = page_cont.df
+
+    if grid_mode("kontak"):
+        render_grid_editor("kontak", df_contacts, new_patient_id=pid_cont)
+    elif not df_contacts.empty:
+        df_contacts_display = df_contacts.drop(columns=['id', 'patient_id', 'is_deceased'], errors='ignore')
+        df_contacts_display.index = page_cont.index
+        df_contacts_display.index.name = "No."
+        st.write(f"Total Data Kontak: **{page_cont.total_label}**")
+        # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
+        styled_df_contacts = style_deceased_row(_alias_df(df_contacts_display, ALIAS_CONTACTS), df_contacts['is_deceased'])
+        st.dataframe(styled_df_contacts, use_container_width=True)
+        # --- END PERUBAHAN ---
+    else:
+        st.info("Tidak ada data kontak untuk ditampilkan.")
+
+
 
 # Ringkasan
-if tab_view:
-    with tab_view:
-        st.subheader("📄 Ringkasan Pasien") 
-        
-        df = run_df_branch("""
-            SELECT s.* FROM pwh.patient_summary s
-            JOIN pwh.patients p ON s.id = p.id
-            ORDER BY p.full_name ASC;
-        """)
-        
-        if df.empty:
-            st.info("Belum ada data (di cabang Anda).")
-        else:
-            df_summary_display = df.copy()
-            sensitive_cols = ['Lahir: Tempat', 'Lahir: Tanggal', 'Alamat', 'No. Telp', 'Org Tua: Ayah', 'Org Tua: Ibu']
-            for col in sensitive_cols:
-                if col in df_summary_display.columns:
-                    df_summary_display[col] = '*****'
-
-            # --- FIX: Hilangkan desimal umur di tab Ringkasan ---
-            if 'Umur (tahun)' in df_summary_display.columns:
-                df_summary_display['Umur (tahun)'] = pd.to_numeric(df_summary_display['Umur (tahun)'], errors='coerce').astype('Int64')
-            # ----------------------------------------------------
-            df_summary_display = df_summary_display.drop(columns=['id'], errors='ignore')
-            df_summary_display.index = range(1, len(df_summary_display) + 1)
-            df_summary_display.index.name = "No."
-            st.write(f"Total Data Pasien (di cabang Anda): **{len(df_summary_display)}**")
-            # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
-            styled_df_summary = style_deceased_row(_alias_df(df_summary_display, ALIAS_SUMMARY), df, 'id')
-            st.dataframe(styled_df_summary, use_container_width=True)
-            # --- END PERUBAHAN ---
-            st.caption("View ini mengambil hasil terbaru per pasien (diagnosis A/B/vWD, inhibitor FVIII/FIX, dan tes HBsAg/Anti-HCV/HIV).")
+@st.fragment
+def render_tab_ringkasan():
+    st.subheader("📄 Ringkasan Pasien") 
+
+    page_sum = paged_table("ringkasan", f"{summary_masked_select()}, {DECEASED_COL}",
+        f"pwh.patient_summary s JOIN pwh.patients p ON s.id = p.id{DECEASED_JOIN}",
+        id_col="p.id", name_filter=True)
+    df = page_sum.df
+
+    if df.empty:
+        st.info("Belum ada data (di cabang Anda).")
+    else:
+        # Kolom pribadi sudah dimasker & umur di-cast di query (summary_masked_select)
+        df_summary_display = df.drop(columns=['id', 'is_deceased'], errors='ignore')
+        df_summary_display.index = page_sum.index
+        df_summary_display.index.name = "No."
+        st.write(f"Total Data Pasien (di cabang Anda): **{page_sum.total_label}**")
+        # --- PERUBAHAN DI SINI: Implementasi pewarnaan merah ---
+        styled_df_summary = style_deceased_row(_alias_df(df_summary_display, ALIAS_SUMMARY), df['is_deceased'])
+        st.dataframe(styled_df_summary, use_container_width=True)
+        # --- END PERUBAHAN ---
+        st.caption("View ini mengambil hasil terbaru per pasien (diagnosis A/B/vWD, inhibitor FVIII/FIX, dan tes HBsAg/Anti-HCV/HIV).")
+
+
 
 # Export
-if tab_export:
-    with tab_export:
-        st.subheader("⬇️ Export Excel (semua tab)")
-        st.write("Klik tombol di bawah untuk membuat file Excel dengan semua data (nama sheet dan kolom dalam Bahasa Indonesia) **yang ada di cabang Anda**.")
-        if st.button("Generate file Excel"):
+@st.fragment
+def render_tab_export():
+    st.subheader("⬇️ Export Data (semua tab)")
+    st.write("Klik tombol di bawah untuk membuat file dengan semua data (nama sheet dan kolom dalam Bahasa Indonesia) **yang ada di cabang Anda**.")
+    format_label = st.radio("Format", list(EXPORT_FORMAT_CHOICES), horizontal=True, key="export_format",
+                            help="CSV/Parquet: satu file per sheet dalam ZIP, lebih cepat dan tanpa batas baris Excel. "
+                                 "Cocok untuk ekstrak riset yang besar.")
+    fmt, file_name = EXPORT_FORMAT_CHOICES[format_label]
+    since = None
+    if incremental_export_available():
+        if st.checkbox("Hanya data baru/berubah sejak...", key="export_incremental",
+                       help="Untuk rekonsiliasi berkala: hanya baris yang dibuat atau diubah sejak waktu ini. "
+                            "Baris yang dihapus tidak ikut."):
+            week_ago = datetime.now(EXPORT_TZ) - pd.Timedelta(days=7)
+            c_date, c_time = st.columns(2)
+            since_date = c_date.date_input("Tanggal", value=week_ago.date(), key="export_since_date")
+            since_time = c_time.time_input("Jam", value=datetime.min.time(), key="export_since_time",
+                                           help=f"Zona waktu {EXPORT_TZ.key}.")
+            since = datetime.combine(since_date, since_time, tzinfo=EXPORT_TZ)
+            stem, ext = os.path.splitext(file_name)
+            file_name = f"{stem}_sejak_{since:%Y%m%d-%H%M}{ext}"
+    else:
+        st.caption("Export inkremental (hanya data baru/berubah) tersedia setelah sql/005_row_timestamps.sql dijalankan.")
+    with st.expander("🔎 Pilih sheet & filter", expanded=False):
+        sheet_names = [sh.name for sh in export_sheets()]
+        chosen = st.multiselect("Sheet", sheet_names, default=sheet_names, key="export_sheets")
+        date_from = date_to = None
+        if st.checkbox("Batasi rentang tanggal", key="export_use_dates"):
+            today = date.today()
+            picked = st.date_input("Rentang tanggal", value=(date(today.year, 1, 1), today), key="export_dates")
+            if isinstance(picked, (tuple, list)) and len(picked) == 2:
+                date_from, date_to = picked
+            st.caption("Tanggal yang dipakai per sheet: "
+                       + ", ".join(f"{k}: {v}" for k, v in EXPORT_DATE_COLUMNS.items())
+                       + ". Sheet lain tidak difilter tanggal.")
+        hemo_types = st.multiselect("Jenis hemofilia (pasien dengan diagnosis ini)", HEMO_TYPES, key="export_hemo")
+        provinces = st.multiselect("Propinsi pasien", fetch_patient_provinces(_session_branch()), key="export_prov")
+        status = st.radio("Status pasien", [EXPORT_STATUS_ALL, EXPORT_STATUS_ALIVE, EXPORT_STATUS_DECEASED],
+                          horizontal=True, key="export_status")
+    filters = ExportFilters(
+        sheets=tuple(chosen) if set(chosen) != set(sheet_names) else (),
+        date_from=date_from, date_to=date_to, hemo_types=tuple(hemo_types),
+        provinces=tuple(provinces), status=status,
+    )
+    if filters.active:
+        stem, ext = os.path.splitext(file_name)
+        file_name = f"{stem}_filter{ext}"
+    if st.button("Generate file export", disabled=not chosen):
+        try:
+            st.session_state["export_job"] = submit_export(fmt, file_name, since, filters).id
+            st.rerun()  # panel 'Pekerjaan Saya' di sidebar mulai memantau progres
+        except Exception as e: st.error(f"Gagal membuat file export: {e}")
+    export_job = jobs_runner().get(_job_owner(), st.session_state.get("export_job"))
+    if export_job is not None and export_job.active:
+        st.info(f"⚙️ {export_job.label} berjalan di latar belakang. Pantau progres & unduh file di panel "
+                "**🗂️ Pekerjaan Saya** (sidebar); halaman tetap bisa dipakai.")
+
+    st.markdown("---")
+    st.subheader("📥 Template Bulk & ⬆️ Import")
+    c1, c2 = st.columns([1,2])
+    with c1:
+        try:
+            tpl = get_bulk_template_bytes()
+            st.download_button(label="📄 Download Template Bulk (.xlsx)", data=tpl, file_name="pwh_bulk_template.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            st.success("Template bulk (Bahasa Indonesia) siap diunduh.")
+        except Exception as e: st.error(f"Gagal membuat template: {e}")
+
+    with c2:
+        up = st.file_uploader("Unggah file Template Bulk (.xlsx) untuk di-import", type=["xlsx", "zip"],
+                              help="Selain .xlsx, bisa juga ZIP berisi satu file CSV atau Parquet per sheet "
+                                   "dengan nama sheet sebagai nama file (mis. 'Pasien.csv', 'Diagnosa.parquet') "
+                                   "dan header yang sama dengan template. Format ini jauh lebih cepat dibaca.")
+        st.caption("Perhatian: Jika Anda bukan admin, data pasien baru akan secara otomatis dimasukkan ke cabang Anda, mengabaikan isi kolom 'HMHI Cabang' di Excel.")
+        c_dry, c_run = st.columns(2)
+        if up and c_dry.button("🔍 Validasi Saja (Dry Run)"):
             try:
-                excel_bytes = build_excel_bytes() 
-                st.download_button(label="💾 Download data_pwh.xlsx", data=excel_bytes, file_name="data_pwh.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-                st.success("File siap diunduh.")
-            except Exception as e: st.error(f"Gagal membuat file Excel: {e}")
-
-        st.markdown("---")
-        st.subheader("📥 Template Bulk & ⬆️ Import")
-        c1, c2 = st.columns([1,2])
-        with c1:
+                st.session_state["import_job"] = submit_bulk_import(up, dry_run=True).id
+                st.rerun()
+            except Exception as e:
+                st.error(f"Gagal validasi: {e}")
+                st.exception(e)
+        if up and c_run.button("🚀 Import Bulk ke Database", type="primary"):
             try:
-                tpl = build_bulk_template_bytes()
-                st.download_button(label="📄 Download Template Bulk (.xlsx)", data=tpl, file_name="pwh_bulk_template.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-                st.success("Template bulk (Bahasa Indonesia) siap diunduh.")
-            except Exception as e: st.error(f"Gagal membuat template: {e}")
+                st.session_state["import_job"] = submit_bulk_import(up).id
+                st.rerun()
+            except Exception as e:
+                st.error(f"Gagal import: {e}")
+                st.exception(e)
+
+        import_job = jobs_runner().get(_job_owner(), st.session_state.get("import_job"))
+        report = import_job.result if import_job is not None else None
+        if import_job is not None and import_job.active:
+            st.info(f"⚙️ {import_job.label} berjalan di latar belakang ({import_job.progress:.0%}). "
+                    "Hasilnya muncul di sini dan di panel **🗂️ Pekerjaan Saya** setelah selesai.")
+        elif import_job is not None and import_job.error:
+            st.error(f"Gagal import: {import_job.error}")
+            st.caption("Jika ledger import aktif, chunk yang sudah tersimpan tidak akan ditulis ulang: "
+                       "unggah kembali file yang sama untuk melanjutkan.")
+        if report is not None:
+            summary = ", ".join(f"{k}: {v}" for k, v in report.counts.items())
+            if report.dry_run:
+                st.info("Dry run selesai, belum ada data yang disimpan. Baris siap di-import — " + summary)
+            else:
+                st.success("Import selesai — " + summary)
+            if report.note:
+                st.info(report.note)
+            if report.skipped:
+                st.caption(f"{report.skipped} baris sudah pernah di-import (tercatat di ledger) dan dilewati.")
+            if not report.errors.empty:
+                st.warning(f"{len(report.errors)} masalah pada baris yang {'akan dilewati' if report.dry_run else 'tidak di-import'}. Perbaiki baris tersebut lalu import ulang.")
+                st.dataframe(report.errors, use_container_width=True, hide_index=True)
+                st.download_button("⬇️ Download Laporan Error (.csv)", data=report.errors.to_csv(index=False).encode("utf-8"),
+                                   file_name="pwh_import_error.csv", mime="text/csv")
+            if report.dry_run and import_job.path:
+                # File dibaca hanya setelah diminta, bukan setiap rerun (sama seperti panel Pekerjaan Saya)
+                prepared = st.session_state.get("import_download") == import_job.id
+                if not prepared and st.button("📦 Siapkan Workbook Beranotasi (.xlsx)", key="import_prep"):
+                    st.session_state["import_download"], prepared = import_job.id, True
+                if prepared:
+                    try:
+                        with open(import_job.path, "rb") as f:
+                            data = f.read()
+                    except OSError:
+                        st.session_state.pop("import_download", None)
+                        st.warning("File workbook beranotasi sudah tidak tersedia (dihapus atau kedaluwarsa).")
+                    else:
+                        st.download_button("⬇️ Download Workbook Beranotasi (.xlsx)", data=data,
+                                           file_name=import_job.file_name, mime=import_job.mime,
+                                           on_click=st.session_state.pop, args=("import_download", None))
 
-        with c2:
-            up = st.file_uploader("Unggah file Template Bulk (.xlsx) untuk di-import", type=["xlsx"])
-            st.caption("Perhatian: Jika Anda bukan admin, data pasien baru akan secara otomatis dimasukkan ke cabang Anda, mengabaikan isi kolom 'HMHI Cabang' di Excel.")
-            if up and st.button("🚀 Import Bulk ke Database", type="primary"):
-                try:
-                    result = import_bulk_excel(up) 
-                    msg = "Import selesai — " + ", ".join(f"{k}: {v}" for k, v in result.items())
-                    st.success(msg)
-                    fetch_all_wilayah_details.clear()
-                    get_all_patients_for_selection.clear()
-                    fetch_occupations_list.clear()
-                    fetch_hospitals.clear()
-                    fetch_hmhi_branches.clear() 
-                    st.rerun() 
-                except Exception as e:
-                    st.error(f"Gagal import: {e}")
-                    st.exception(e)
+
+# ------------------------------------------------------------------------------
+# Menjalankan bagian
+# ------------------------------------------------------------------------------
+SECTION_RENDERERS = {
+    "Pasien": render_tab_pasien,
+    "Diagnosis": render_tab_diagnosis,
+    "Inhibitor": render_tab_inhibitor,
+    "Virus": render_tab_virus,
+    "Hospital": render_tab_hospital,
+    "Kematian": render_tab_kematian,
+    "Kontak": render_tab_kontak,
+    "Ringkasan": render_tab_ringkasan,
+    "Export": render_tab_export,
+}
+
+apply_finished_import_jobs()
+if nav_sections:
+    with section(f"Tab: {active_section}"):
+        SECTION_RENDERERS[active_section]()
+else:
+    for section_key, render in SECTION_RENDERERS.items():
+        with tab_containers[section_key], section(f"Tab: {section_key}"):
+            render()
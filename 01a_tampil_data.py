@@ -2,12 +2,15 @@ import os
 import re
 import io
 import math
+import zipfile
 import pandas as pd
 import streamlit as st
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Engine
 from fpdf import FPDF
 
+import pwh_jobs
+
 # ==============================================================================
 # 1. KONFIGURASI HALAMAN & KONEKSI DATABASE
 # ==============================================================================
@@ -207,6 +210,16 @@ def generate_pdf(row_dict):
         
     return bytes(pdf.output())
 
+def write_pdf_zip(ctx: pwh_jobs.JobContext, rows: list) -> str:
+    """Pekerjaan latar belakang: satu PDF per pasien, dikemas ke ZIP di ctx.path."""
+    total = len(rows)
+    with zipfile.ZipFile(ctx.path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for i, row_dict in enumerate(rows, start=1):
+            nama = str(row_dict.get("Nama Lengkap", "Tanpa Nama")).strip().replace(" ", "_")
+            zf.writestr(f"PWH_{i:04d}_{nama}.pdf", generate_pdf(row_dict))
+            ctx.progress(i / total, f"PDF {i}/{total}")
+    return f"{total} PDF pasien."
+
 # ==============================================================================
 # 4. UI & MAIN LOGIC
 # ==============================================================================
@@ -270,6 +283,14 @@ try:
 
     st.info(f"Ditemukan **{total_data}** pasien unik. Menampilkan halaman **{st.session_state.page_number + 1}** dari **{total_pages}**.")
 
+    if total_data and st.button("🖨️ Cetak semua PDF hasil pencarian (ZIP)"):
+        label = f"Cetak {total_data} PDF" + (f" ('{search_term}')" if search_term else "")
+        pwh_jobs.runner().submit(
+            st.session_state.get("username", ""), "pdf", label,
+            lambda ctx, rows=list(data_list): write_pdf_zip(ctx, rows),
+            file_name="PWH_hasil_pencarian.zip", mime="application/zip")
+        st.rerun()  # panel 'Pekerjaan Saya' di sidebar memantau progres & menyediakan unduhan
+
     col_prev, col_spacer, col_next = st.columns([1, 4, 1])
     with col_prev:
         if st.button("⬅️ Sebelumnya", disabled=(st.session_state.page_number == 0), key="top_prev"):
@@ -64,6 +64,62 @@ def _fetch_count_by_column(engine: Engine, column: str) -> pd.DataFrame:
         st.error(f"Gagal mengambil data: {e}")
         return pd.DataFrame(columns=["province", "jumlah", "persentase"])
 
+# Rollup per tingkat administrasi memakai pwh.wilayah_dim (lihat sql/001_wilayah_dim.sql).
+# Kode hanya di-resolve pada tingkat yang dipilih: pasien dicocokkan ke himpunan
+# (nama provinsi[, kota[, kecamatan]]) -> kode tingkat itu, sehingga tingkat di
+# bawahnya yang kosong/tidak cocok tidak memecah baris. Nama diambil dari dim;
+# pengelompokan per nama hanya untuk pasien yang memang tidak ter-resolve.
+# Nilai: (kolom kode, kolom nama, kolom pasien, jalur nama dim -> kolom pasien).
+ROLLUP_LEVELS = {
+    "Provinsi": ("province_kode", "province_name", "province",
+                 [("province_name", "province")]),
+    "Kabupaten/Kota": ("city_kode", "city_name", "city",
+                       [("province_name", "province"), ("city_name", "city")]),
+    "Kecamatan": ("district_kode", "district_name", "district",
+                  [("province_name", "province"), ("city_name", "city"), ("district_name", "district")]),
+    "Kelurahan/Desa": ("village_kode", "village_name", "village",
+                       [("province_name", "province"), ("city_name", "city"),
+                        ("district_name", "district"), ("village_name", "village")]),
+}
+
+def _wilayah_dim_exists(engine: Engine) -> bool:
+    with engine.connect() as conn:
+        return bool(conn.execute(text("SELECT to_regclass('pwh.wilayah_dim') IS NOT NULL")).scalar())
+
+def _fetch_rollup(engine: Engine, level: str) -> pd.DataFrame:
+    kode_col, name_col, patient_col, path = ROLLUP_LEVELS[level]
+    path_cols = ", ".join(d for d, _ in path)
+    on = " AND ".join(f"w.{d} = p.{c}" for d, c in path)
+    q = text(f"""
+        WITH w AS (
+            SELECT DISTINCT ON ({path_cols}) {path_cols}, {kode_col} AS kode
+            FROM pwh.wilayah_dim
+            ORDER BY {path_cols}, {kode_col}
+        )
+        SELECT
+            COALESCE(w.{name_col}, NULLIF(TRIM(p.{patient_col}::text), ''), 'Unknown') AS province,
+            w.kode,
+            COUNT(*)::int AS jumlah
+        FROM pwh.patients p
+        LEFT JOIN w ON {on}
+        GROUP BY w.kode, 1
+        ORDER BY jumlah DESC, province ASC;
+    """)
+    try:
+        if not _wilayah_dim_exists(engine):
+            # wilayah_dim belum dibuat: rekap langsung dari kolom nama di pwh.patients
+            df = _fetch_count_by_column(engine, patient_col)
+            df.insert(1, "kode", None)
+            return df
+        with engine.connect() as conn:
+            df = pd.read_sql(q, conn)
+    except Exception as e:
+        st.error(f"Gagal mengambil data: {e}")
+        return pd.DataFrame(columns=["province", "kode", "jumlah", "persentase"])
+    total = int(df["jumlah"].sum()) if not df.empty else 0
+    df["persentase"] = (df["jumlah"] / total * 100).round(2) if total > 0 else 0.0
+    return df
+
 def _to_excel_bytes(df: pd.DataFrame, sheet_name: str = "Rekap_Provinsi") -> bytes:
     output = io.BytesIO()
     with pd.ExcelWriter(output, engine="openpyxl") as writer:
@@ -71,7 +127,7 @@ def _to_excel_bytes(df: pd.DataFrame, sheet_name: str = "Rekap_Provinsi") -> byt
     return output.getvalue()
 
 # ========================= PLOTTING =========================
-def plot_bar_with_labels(df: pd.DataFrame) -> plt.Figure:
+def plot_bar_with_labels(df: pd.DataFrame, level: str = "Provinsi") -> plt.Figure:
     """
     Membuat bar chart dengan label jumlah di atas setiap batang.
     """
@@ -82,8 +138,8 @@ def plot_bar_with_labels(df: pd.DataFrame) -> plt.Figure:
     bars = ax.bar(df_sorted["province"].astype(str), df_sorted["jumlah"])
 
     # Judul & axis
-    ax.set_title("Distribusi Pasien per Provinsi", fontsize=16)
-    ax.set_xlabel("Provinsi", fontsize=12)
+    ax.set_title(f"Distribusi Pasien per {level}", fontsize=16)
+    ax.set_xlabel(level, fontsize=12)
     ax.set_ylabel("Jumlah", fontsize=12)
 
     # Label sumbu-X miring agar muat
@@ -113,7 +169,8 @@ def plot_bar_with_labels(df: pd.DataFrame) -> plt.Figure:
 db_url = _resolve_db_url()
 engine = get_engine(db_url)
 
-df_prov = _fetch_count_by_column(engine, "province")
+level = st.radio("Tingkat wilayah", list(ROLLUP_LEVELS), horizontal=True)
+df_prov = _fetch_rollup(engine, level)
 
 if df_prov.empty:
     st.warning("Tidak ada data yang dapat ditampilkan.")
@@ -121,7 +178,7 @@ if df_prov.empty:
 
 # Kontrol di area utama (hanya jumlah Top-N)
 top_n = st.number_input(
-    "Tampilkan Top-N Provinsi (berdasarkan jumlah pasien)",
+    f"Tampilkan Top-N {level} (berdasarkan jumlah pasien)",
     min_value=1,
     max_value=50,
     value=20,
@@ -130,26 +187,27 @@ top_n = st.number_input(
 
 df_top = df_prov.head(top_n)
 
-st.subheader("📊 Tabel Rekap Provinsi")
+df_view = df_top.rename(columns={"province": level, "kode": "Kode", "jumlah": "Jumlah", "persentase": "Persentase"})
+
+st.subheader(f"📊 Tabel Rekap {level}")
 st.dataframe(
-    df_top.rename(columns={"province": "Provinsi", "jumlah": "Jumlah", "persentase": "Persentase"})
-          .style.format({"Persentase": "{:.2f}%"}),
+    df_view.style.format({"Persentase": "{:.2f}%"}),
     use_container_width=True,
     hide_index=True
 )
 
 st.download_button(
-    "📥 Download Rekap Provinsi (Excel)",
-    data=_to_excel_bytes(df_top.rename(columns={
-        "province": "Provinsi", "jumlah": "Jumlah", "persentase": "Persentase"})),
-    file_name="rekap_provinsi.xlsx",
+    f"📥 Download Rekap {level} (Excel)",
+    data=_to_excel_bytes(df_view),
+    file_name=f"rekap_{ROLLUP_LEVELS[level][2]}.xlsx",
     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
 )
 
 st.markdown(" ")
-st.pyplot(plot_bar_with_labels(df_top))
+st.pyplot(plot_bar_with_labels(df_top, level))
 
 st.markdown("---")
 st.caption(
-    "Sumber data: **pwh.patients** (kolom `province`). Nilai kosong dipetakan otomatis ke **'Unknown'**."
+    "Sumber data: **pwh.patients**, dipetakan ke **pwh.wilayah_dim** per tingkat wilayah. "
+    "Nilai kosong dipetakan otomatis ke **'Unknown'**."
 )
@@ -1,11 +1,18 @@
 import runpy
 import os
 import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import streamlit as st
 import streamlit.components.v1 as components
 from streamlit_option_menu import option_menu
 from sqlalchemy import create_engine, text, Engine
 from passlib.context import CryptContext
+import pwh_jobs
+import pwh_profiler
 
 # -----------------------------
 # Konfigurasi halaman
@@ -74,12 +81,170 @@ else:
 # -----------------------------
 # Keamanan Password
 # -----------------------------
+def _resolve_setting(name: str, default):
+    """Membaca pengaturan dari blok [secrets], lalu environment variable, lalu default."""
+    try:
+        sec = st.secrets.get("secrets", {}).get(name, "")
+        if sec:
+            return sec
+    except Exception:
+        pass
+    return os.environ.get(name) or default
+
+# Nilai rounds dihasilkan oleh tools/calibrate_password_hash.py di server produksi.
+PBKDF2_ROUNDS = int(_resolve_setting("PWD_PBKDF2_ROUNDS", 29000))
+BCRYPT_ROUNDS = int(_resolve_setting("PWD_BCRYPT_ROUNDS", 12))
+VERIFY_WORKERS = int(_resolve_setting("PWD_VERIFY_WORKERS", 2))
+VERIFY_TIMEOUT_S = 30
+
+# min_rounds = max_rounds = rounds hasil kalibrasi: hash yang lebih lemah maupun
+# yang lebih mahal dari target dianggap usang oleh needs_update() dan di-hash ulang.
 pwd_context = CryptContext(
     schemes=["pbkdf2_sha256", "bcrypt_sha256", "bcrypt"],
     default="pbkdf2_sha256",
-    deprecated="auto"
+    deprecated="auto",
+    pbkdf2_sha256__default_rounds=PBKDF2_ROUNDS,
+    pbkdf2_sha256__min_rounds=PBKDF2_ROUNDS,
+    pbkdf2_sha256__max_rounds=PBKDF2_ROUNDS,
+    bcrypt_sha256__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
 )
 
+@st.cache_resource(show_spinner=False)
+def get_verify_executor(workers: int) -> ThreadPoolExecutor:
+    """
+    Pool kecil untuk verifikasi hash, dipakai bersama oleh semua sesi.
+    pbkdf2/bcrypt melepas GIL, jadi thread cukup; jumlah worker yang dibatasi
+    membuat lonjakan login mengantre alih-alih menghabiskan seluruh CPU.
+    """
+    return ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="pwd-verify")
+
+def verify_password(password: str, hashed: str) -> bool:
+    """Verifikasi password di luar thread script Streamlit."""
+    future = get_verify_executor(VERIFY_WORKERS).submit(pwd_context.verify, password, hashed)
+    return future.result(timeout=VERIFY_TIMEOUT_S)
+
+def rehash_if_needed(username: str, password: str, hashed: str) -> None:
+    """Menyimpan hash baru jika parameter hash lama sudah usang (skema/rounds)."""
+    try:
+        if not pwd_context.needs_update(hashed):
+            return
+        new_hash = get_verify_executor(VERIFY_WORKERS).submit(pwd_context.hash, password).result(timeout=VERIFY_TIMEOUT_S)
+        with DB_ENGINE.begin() as conn:
+            conn.execute(
+                text("UPDATE pwh.users SET hashed_password = :h WHERE username = :user AND hashed_password = :old"),
+                {"h": new_hash, "user": username, "old": hashed},
+            )
+    except Exception as e:
+        # Rehash bersifat oportunistis; kegagalan tidak boleh menggagalkan login.
+        print(f"Rehash password untuk {username} gagal: {e}")
+
+# -----------------------------
+# Pembatas Percobaan Login
+# -----------------------------
+LOGIN_WINDOW_S = int(_resolve_setting("LOGIN_WINDOW_S", 300))
+LOGIN_MAX_PER_USER = int(_resolve_setting("LOGIN_MAX_PER_USER", 5))
+LOGIN_MAX_PER_CLIENT = int(_resolve_setting("LOGIN_MAX_PER_CLIENT", 20))
+# Jumlah reverse proxy tepercaya di depan aplikasi yang menambahkan IP ke
+# X-Forwarded-For. 0 = header proxy diabaikan (bisa dipalsukan klien).
+LOGIN_TRUSTED_PROXY_HOPS = int(_resolve_setting("LOGIN_TRUSTED_PROXY_HOPS", 0))
+
+class LoginRateLimiter:
+    """
+    Sliding window di memori proses, per username dan per klien.
+    Dicek sebelum query pwh.users dan verifikasi hash, jadi percobaan yang
+    ditolak tidak menyentuh database maupun CPU hashing.
+    """
+
+    def __init__(self, window_s: int, max_per_user: int, max_per_client: int):
+        self.window_s = window_s
+        self.limits = {"user": max_per_user, "client": max_per_client}
+        self._hits: dict[tuple[str, str], deque] = {}
+        self._lock = threading.Lock()
+        self.counters = {"allowed": 0, "blocked_user": 0, "blocked_client": 0, "failed": 0, "succeeded": 0}
+
+    def _prune(self, key, now: float) -> deque:
+        q = self._hits.setdefault(key, deque())
+        while q and q[0] <= now - self.window_s:
+            q.popleft()
+        return q
+
+    def try_acquire(self, username: str, client: str) -> float:
+        """Mencatat satu percobaan. Mengembalikan 0 jika boleh, atau detik tunggu jika ditolak."""
+        now = time.monotonic()
+        keys = {"user": ("user", username.lower()), "client": ("client", client)}
+        with self._lock:
+            for kind, key in keys.items():
+                q = self._prune(key, now)
+                if len(q) >= self.limits[kind]:
+                    self.counters[f"blocked_{kind}"] += 1
+                    return max(1.0, q[0] + self.window_s - now)
+            for key in keys.values():
+                self._hits[key].append(now)
+            self.counters["allowed"] += 1
+            # Buang key yang sudah kosong agar memori tidak tumbuh tanpa batas
+            if len(self._hits) > 10000:
+                for k in [k for k, q in self._hits.items() if not q or q[-1] <= now - self.window_s]:
+                    del self._hits[k]
+        return 0.0
+
+    def record_result(self, username: str, ok: bool):
+        with self._lock:
+            self.counters["succeeded" if ok else "failed"] += 1
+            if ok:
+                # Login sukses membuka kembali kuota username tersebut
+                self._hits.pop(("user", username.lower()), None)
+
+    def snapshot(self) -> dict:
+        """Salinan counter + jumlah key aktif, untuk monitoring."""
+        now = time.monotonic()
+        with self._lock:
+            active = {kind: 0 for kind in self.limits}
+            for (kind, _), q in self._hits.items():
+                if q and q[-1] > now - self.window_s:
+                    active[kind] += 1
+            return {
+                **self.counters,
+                "active_users": active["user"],
+                "active_clients": active["client"],
+                "window_s": self.window_s,
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_login_limiter(window_s: int, max_per_user: int, max_per_client: int) -> LoginRateLimiter:
+    return LoginRateLimiter(window_s, max_per_user, max_per_client)
+
+def _client_key() -> str:
+    """
+    Identitas klien untuk batas percobaan per klien. Entri kiri X-Forwarded-For
+    ditulis oleh klien sendiri, jadi hanya hop yang ditambahkan proxy tepercaya
+    yang dipakai: dengan LOGIN_TRUSTED_PROXY_HOPS = N, IP klien adalah entri ke-N
+    dari kanan (proxy terluar menambahkan alamat peer-nya). X-Real-Ip dipercaya
+    hanya bila proxy dikonfigurasi (proxy menimpanya). Tanpa proxy tepercaya:
+    alamat koneksi langsung, lalu ID sesi Streamlit.
+    """
+    try:
+        headers = st.context.headers
+        if LOGIN_TRUSTED_PROXY_HOPS > 0:
+            hops = [h.strip() for h in (headers.get("X-Forwarded-For") or "").split(",") if h.strip()]
+            if hops:
+                return hops[-min(LOGIN_TRUSTED_PROXY_HOPS, len(hops))]
+            if headers.get("X-Real-Ip"):
+                return headers["X-Real-Ip"].strip()
+        ip = getattr(st.context, "ip_address", None)
+        if ip:
+            return ip
+    except Exception:
+        pass
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        if ctx is not None:
+            return f"session:{ctx.session_id}"
+    except Exception:
+        pass
+    return "unknown"
+
 # -----------------------------
 # Fungsi Helper CAPTCHA
 # -----------------------------
@@ -212,15 +377,24 @@ def check_password() -> bool:
             st.error("CAPTCHA harus berupa angka.")
             return False
 
-        # 3. Validasi Database
+        # 3. Pembatasan percobaan (sebelum query & hashing)
+        username_cleaned = username.strip()
+        limiter = get_login_limiter(LOGIN_WINDOW_S, LOGIN_MAX_PER_USER, LOGIN_MAX_PER_CLIENT)
+        wait_s = limiter.try_acquire(username_cleaned, _client_key())
+        if wait_s:
+            st.error(f"Terlalu banyak percobaan login. Silakan coba lagi dalam {int(wait_s // 60) + 1} menit.")
+            reset_captcha()
+            return False
+
+        # 4. Validasi Database
         try:
-            username_cleaned = username.strip()
             with DB_ENGINE.connect() as conn:
                 query = text("SELECT username, hashed_password, cabang FROM pwh.users WHERE username = :user")
                 result = conn.execute(query, {"user": username_cleaned})
                 user_data = result.mappings().fetchone()
 
             if not user_data:
+                limiter.record_result(username_cleaned, False)
                 st.error("Username atau password salah.")
                 reset_captcha() 
                 return False
@@ -228,7 +402,9 @@ def check_password() -> bool:
             password_to_check = password
 
             # Verifikasi hash
-            if pwd_context.verify(password_to_check, user_data['hashed_password']):
+            if verify_password(password_to_check, user_data['hashed_password']):
+                limiter.record_result(username_cleaned, True)
+                rehash_if_needed(user_data['username'], password_to_check, user_data['hashed_password'])
                 st.session_state.auth_ok = True
                 st.session_state.username = user_data['username']
                 st.session_state.user_branch = user_data['cabang']
@@ -238,6 +414,7 @@ def check_password() -> bool:
                 
                 st.rerun()
             else:
+                limiter.record_result(username_cleaned, False)
                 st.error("Username atau password salah.")
                 reset_captcha()
                 return False
@@ -269,6 +446,91 @@ FULL_ICONS = [
     "book", "map", "geo-alt", "building"
 ]
 
+# -----------------------------
+# Profiler (khusus Admin)
+# -----------------------------
+def render_profile(prof: "pwh_profiler.RerunProfile", page_path: str):
+    """Menampilkan rincian waktu rerun terakhir dan tombol unduh stats mentah."""
+    with st.expander(f"⏱️ Profil rerun: {page_path} — {prof.total_s * 1000:.0f} ms", expanded=True):
+        df = prof.to_dataframe()
+        if df.empty:
+            st.caption("Halaman ini belum memiliki timer per bagian.")
+        else:
+            st.dataframe(df, use_container_width=True, hide_index=True)
+        stats_text = prof.stats_text()
+        if stats_text:
+            st.code(stats_text, language="text")
+            st.download_button(
+                "💾 Download stats mentah (.prof)",
+                data=prof.stats_bytes(),
+                file_name=f"profile_{os.path.splitext(page_path)[0]}.prof",
+                mime="application/octet-stream",
+            )
+
+# -----------------------------
+# Pekerjaan latar belakang (pwh_jobs)
+# -----------------------------
+JOB_POLL_S = 2
+JOB_PANEL_LIMIT = 10
+JOB_ICONS = {pwh_jobs.JOB_QUEUED: "⏳", pwh_jobs.JOB_RUNNING: "⚙️",
+             pwh_jobs.JOB_DONE: "✅", pwh_jobs.JOB_FAILED: "❌"}
+
+def _job_download(job: "pwh_jobs.Job"):
+    """
+    Unduhan hasil pekerjaan yang sudah selesai, juga saat pekerjaan lain masih
+    berjalan. File dibaca hanya untuk pekerjaan yang diminta ('Siapkan unduhan'),
+    bukan untuk setiap pekerjaan pada setiap rerun/polling.
+    """
+    prepared = st.session_state.get("job_download") == job.id
+    if not prepared and st.button("📦 Siapkan unduhan", key=f"job_prep_{job.id}"):
+        st.session_state["job_download"], prepared = job.id, True
+    if not prepared:
+        return
+    try:
+        with open(job.path, "rb") as f:
+            data = f.read()
+    except OSError:
+        st.session_state.pop("job_download", None)
+        st.caption("⚠️ File hasil sudah tidak tersedia.")
+        return
+    st.download_button(f"💾 {job.file_name}", data=data, file_name=job.file_name,
+                       mime=job.mime, key=f"job_dl_{job.id}", use_container_width=True,
+                       on_click=st.session_state.pop, args=("job_download", None))
+
+def _jobs_panel_body(owner: str) -> bool:
+    """Isi panel; mengembalikan True bila masih ada pekerjaan aktif."""
+    runner = pwh_jobs.runner()
+    jobs = runner.jobs_for(owner)[:JOB_PANEL_LIMIT]
+    if not jobs:
+        st.caption("Belum ada pekerjaan. Export, import bulk, dan cetak PDF massal berjalan di sini.")
+        return False
+    for job in jobs:
+        st.markdown(f"{JOB_ICONS.get(job.status, '')} **{job.label}**  \n"
+                    f"<small>{time.strftime('%d/%m %H:%M', time.localtime(job.created_at))} · {job.status}</small>",
+                    unsafe_allow_html=True)
+        if job.active:
+            st.progress(job.progress or 0.0, text=job.message or None)
+        elif job.status == pwh_jobs.JOB_FAILED:
+            st.caption(f"⚠️ {job.error}")
+        else:
+            if job.summary:
+                st.caption(job.summary)
+            if job.path:
+                _job_download(job)
+        if not job.active and st.button("🗑️ Hapus", key=f"job_rm_{job.id}"):
+            runner.remove(owner, job.id)
+            st.rerun(scope="fragment")
+    return runner.has_active(owner)
+
+@st.fragment
+def render_jobs_panel(owner: str):
+    _jobs_panel_body(owner)
+
+@st.fragment(run_every=JOB_POLL_S)
+def render_jobs_panel_live(owner: str):
+    if not _jobs_panel_body(owner):
+        st.rerun()  # semua pekerjaan selesai: rerun penuh agar halaman & tombol unduh memakai hasil terbaru
+
 # -----------------------------
 # Main App
 # -----------------------------
@@ -335,13 +597,31 @@ def main():
                 st.session_state.clear()
                 st.rerun()
 
+        owner = st.session_state.get("username", "")
+        live = pwh_jobs.runner().has_active(owner)
+        with st.expander("🗂️ Pekerjaan Saya", expanded=live):
+            (render_jobs_panel_live if live else render_jobs_panel)(owner)
+
+        profile_on, use_cprofile = False, False
+        if user_branch == 'ALL':
+            with st.expander("🛡️ Monitoring Login"):
+                stats = get_login_limiter(LOGIN_WINDOW_S, LOGIN_MAX_PER_USER, LOGIN_MAX_PER_CLIENT).snapshot()
+                st.json(stats)
+            profile_on = st.toggle("⏱️ Profiler halaman", key="admin_profiler_on")
+            if profile_on:
+                use_cprofile = st.checkbox("Sertakan cProfile", key="admin_profiler_cprofile")
+
     page_path = current_menu[selection]
-    try:
-        runpy.run_path(page_path, run_name="__main__")
-    except FileNotFoundError:
-        st.error(f"File halaman tidak ditemukan: `{page_path}`")
-    except Exception as e:
-        st.exception(e)
+    with pwh_profiler.profiling(use_cprofile) if profile_on else nullcontext() as prof:
+        try:
+            runpy.run_path(page_path, run_name="__main__")
+        except FileNotFoundError:
+            st.error(f"File halaman tidak ditemukan: `{page_path}`")
+        except Exception as e:
+            st.exception(e)
+
+    if prof is not None:
+        render_profile(prof, page_path)
 
     st.markdown("---")
     st.caption("© PWH Dashboard — Streamlit")
@@ -0,0 +1,335 @@
+# pwh_export.py
+# Export data PWH (semua sheet) secara streaming untuk halaman input (01_pwh_input.py):
+#   - setiap sheet dibaca dari server-side cursor per chunk (yield_per),
+#   - ditulis ke xlsxwriter mode constant_memory langsung ke file di disk, atau
+#     ke ZIP berisi CSV / Parquet per sheet (untuk ekstrak riset yang besar),
+#   - lebar kolom diperkirakan dari chunk pertama (panjang string vektor),
+#   - opsional inkremental: hanya baris yang dibuat/berubah sejak watermark,
+#   - filter (sheet, rentang tanggal, jenis hemofilia, ...) langsung di SQL per sheet,
+#   - file jadi di-cache per versi tabel (sql/004_table_versions.sql), sehingga
+#     unduhan berulang untuk data yang belum berubah tidak membangun ulang file.
+#
+# Modul ini sengaja tidak mengimpor streamlit supaya bisa dipakai dari tools/.
+import csv
+import glob
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+from collections.abc import Callable, Iterator
+from typing import NamedTuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xlsxwriter
+from sqlalchemy import text
+
+EXPORT_CHUNK_ROWS = 2000
+EXPORT_MAX_COL_WIDTH = 50
+XLSX_MAX_ROWS = 1_048_575  # batas baris data per sheet Excel (di luar header)
+# Naikkan bila isi/format file export berubah agar file cache lama tidak dipakai
+EXPORT_LAYOUT_VERSION = 1
+EXPORT_TABLES = ["patients", "hemo_diagnoses", "hemo_inhibitors", "virus_tests",
+                 "treatment_hospital", "death", "contacts"]
+
+
+class ExportSheet(NamedTuple):
+    """
+    Satu sheet export. sql memuat placeholder {where} (kondisi cabang dsb.,
+    alias pasien 'p'); header kolom diambil dari alias (kolom lain apa adanya).
+    changed_since: kondisi baris baru/berubah (memakai :since) yang ditambahkan
+    bila params berisi 'since' (export inkremental, sql/005_row_timestamps.sql).
+    date_range: kondisi tanggal kejadian sheet (memakai :date_from & :date_to)
+    yang ditambahkan bila params berisi keduanya; sheet tanpa tanggal None.
+    """
+    name: str
+    sql: str
+    alias: dict
+    numbered: bool = False      # tambah kolom 'No' (1..n) di paling kiri
+    after_id: tuple = ()        # kolom yang dipindah tepat setelah 'id'
+    changed_since: str | None = None
+    date_range: str | None = None
+
+
+class ExportFile(NamedTuple):
+    path: str
+    cached: bool
+    rows: dict                  # sheet -> jumlah baris (kosong bila dari cache)
+
+
+def _where(conditions: list[str]) -> str:
+    return " AND ".join(f"({c})" for c in conditions) or "TRUE"
+
+
+def _column_order(keys: list[str], after_id: tuple) -> list[int]:
+    order = [k for k in keys if k not in after_id]
+    if "id" in order:
+        pos = order.index("id") + 1
+        order[pos:pos] = [k for k in after_id if k in keys]
+    return [keys.index(k) for k in order]
+
+
+def _estimate_widths(headers: list[str], sample: list[tuple]) -> list[int]:
+    """Lebar kolom dari sampel baris: panjang string maksimum per kolom (vektor, bukan per cell)."""
+    lengths = pd.Series([len(h) for h in headers], dtype="int64")
+    if sample:
+        df = pd.DataFrame.from_records(sample)
+        for i in range(df.shape[1]):
+            n = df[i].astype("string").str.len().max()
+            lengths[i] = max(lengths[i], 0 if pd.isna(n) else int(n))
+    return [min(int(n) + 2, EXPORT_MAX_COL_WIDTH) for n in lengths]
+
+
+class _SheetRows(NamedTuple):
+    headers: list[str]
+    types: list            # tipe pyarrow per kolom (None = tidak diketahui)
+    chunks: Iterator[list[tuple]]
+
+
+# OID tipe PostgreSQL (cursor.description psycopg2) -> tipe kolom Parquet
+PG_ARROW_TYPES = {
+    16: pa.bool_(), 20: pa.int64(), 21: pa.int32(), 23: pa.int32(), 700: pa.float64(), 701: pa.float64(),
+    1700: pa.float64(), 1082: pa.date32(), 1114: pa.timestamp("us"), 1184: pa.timestamp("us", tz="UTC"),
+}
+
+
+def _sheet_rows(conn, sheet: ExportSheet, where: str, params: dict | None, chunk_rows: int) -> _SheetRows:
+    """Baris satu sheet per chunk dari server-side cursor (yield_per), sudah diurutkan & bernomor."""
+    params = params or {}
+    if params.get("since") is not None and sheet.changed_since:
+        where = f"{where} AND ({sheet.changed_since})"
+    if params.get("date_from") is not None and params.get("date_to") is not None and sheet.date_range:
+        where = f"{where} AND ({sheet.date_range})"
+    result = conn.execution_options(yield_per=chunk_rows).execute(text(sheet.sql.format(where=where)), params)
+    keys = list(result.keys())
+    order = _column_order(keys, sheet.after_id)
+    headers = (["No"] if sheet.numbered else []) + [sheet.alias.get(keys[i], keys[i]) for i in order]
+    description = getattr(getattr(result, "cursor", None), "description", None) or []
+    codes = [d[1] for d in description] if len(description) == len(keys) else [None] * len(keys)
+    types = ([pa.int64()] if sheet.numbered else []) + [PG_ARROW_TYPES.get(codes[i]) for i in order]
+
+    def chunks():
+        n = 0
+        for part in result.partitions():
+            if sheet.numbered:
+                rows = [(n + j, *(row[i] for i in order)) for j, row in enumerate(part, start=1)]
+            else:
+                rows = [tuple(row[i] for i in order) for row in part]
+            n += len(rows)
+            yield rows
+
+    return _SheetRows(headers, types, chunks())
+
+
+def write_export_xlsx(conn, path: str, sheets: list[ExportSheet], conditions: list[str] | None = None,
+                      params: dict | None = None, chunk_rows: int = EXPORT_CHUNK_ROWS,
+                      progress: Callable[[str], None] | None = None) -> dict:
+    """
+    Menulis semua sheet ke path dengan memori konstan: baris mengalir dari
+    server-side cursor ke xlsxwriter (constant_memory) tanpa DataFrame penuh.
+    Mengembalikan jumlah baris per sheet.
+    """
+    progress = progress or (lambda label: None)
+    where = _where(conditions or [])
+    wb = xlsxwriter.Workbook(path, {
+        "constant_memory": True,
+        "default_date_format": "yyyy-mm-dd",
+        "remove_timezone": True,
+        "strings_to_formulas": False,   # teks '=...' dari database tidak jadi formula
+        "strings_to_urls": False,
+    })
+    fmt_header = wb.add_format({"bold": True, "border": 1})
+    counts = {}
+    try:
+        for sheet in sheets:
+            progress(sheet.name)
+            ws = wb.add_worksheet(sheet.name)
+            data = _sheet_rows(conn, sheet, where, params, chunk_rows)
+            ws.write_row(0, 0, data.headers, fmt_header)
+            r = 0
+            for rows in data.chunks:
+                if r + len(rows) > XLSX_MAX_ROWS:
+                    raise ValueError(f"Sheet {sheet.name} melebihi batas baris Excel ({XLSX_MAX_ROWS:,}); "
+                                     "gunakan export CSV atau Parquet.")
+                if r == 0:
+                    for c, width in enumerate(_estimate_widths(data.headers, rows)):
+                        ws.set_column(c, c, width)
+                for values in rows:
+                    r += 1
+                    ws.write_row(r, 0, values)
+            if r == 0:
+                for c, width in enumerate(_estimate_widths(data.headers, [])):
+                    ws.set_column(c, c, width)
+            counts[sheet.name] = r
+    finally:
+        wb.close()
+    return counts
+
+
+def write_export_csv_zip(conn, path: str, sheets: list[ExportSheet], conditions: list[str] | None = None,
+                         params: dict | None = None, chunk_rows: int = EXPORT_CHUNK_ROWS,
+                         progress: Callable[[str], None] | None = None) -> dict:
+    """ZIP berisi satu CSV (UTF-8 BOM, agar terbaca benar di Excel) per sheet, ditulis streaming."""
+    progress = progress or (lambda label: None)
+    where = _where(conditions or [])
+    counts = {}
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for sheet in sheets:
+            progress(sheet.name)
+            data = _sheet_rows(conn, sheet, where, params, chunk_rows)
+            with zf.open(f"{sheet.name}.csv", "w", force_zip64=True) as raw, \
+                    io.TextIOWrapper(raw, encoding="utf-8-sig", newline="") as fh:
+                writer = csv.writer(fh)
+                writer.writerow(data.headers)
+                n = 0
+                for rows in data.chunks:
+                    writer.writerows(rows)
+                    n += len(rows)
+            counts[sheet.name] = n
+    return counts
+
+
+def _arrow_table(headers: list[str], types: list, rows: list[tuple]) -> pa.Table:
+    columns = list(zip(*rows)) if rows else [()] * len(headers)
+    arrays = []
+    for values, typ in zip(columns, types):
+        if typ == pa.float64():
+            values = [None if v is None else float(v) for v in values]   # numeric (Decimal)
+        elif typ == pa.string():
+            values = [None if v is None else str(v) for v in values]
+        arrays.append(pa.array(values, type=typ))
+    return pa.Table.from_arrays(arrays, names=headers)
+
+
+def write_export_parquet_zip(conn, path: str, sheets: list[ExportSheet], conditions: list[str] | None = None,
+                             params: dict | None = None, chunk_rows: int = EXPORT_CHUNK_ROWS,
+                             progress: Callable[[str], None] | None = None) -> dict:
+    """
+    ZIP berisi satu file Parquet per sheet. Setiap chunk cursor menjadi satu
+    row group; tipe kolom dari tipe PostgreSQL (selain itu teks).
+    """
+    progress = progress or (lambda label: None)
+    where = _where(conditions or [])
+    counts = {}
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as zf:  # Parquet sudah terkompresi
+        for sheet in sheets:
+            progress(sheet.name)
+            data = _sheet_rows(conn, sheet, where, params, chunk_rows)
+            types = [t if t is not None else pa.string() for t in data.types]
+            schema = pa.schema(list(zip(data.headers, types)))
+            n = 0
+            with zf.open(f"{sheet.name}.parquet", "w", force_zip64=True) as raw, \
+                    pq.ParquetWriter(raw, schema, compression="zstd") as writer:
+                for rows in data.chunks:
+                    writer.write_table(_arrow_table(data.headers, types, rows))
+                    n += len(rows)
+                if n == 0:
+                    writer.write_table(schema.empty_table())
+            counts[sheet.name] = n
+    return counts
+
+
+# Format export -> (penulis, ekstensi file, mime)
+EXPORT_FORMATS = {
+    "xlsx": (write_export_xlsx, ".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": (write_export_csv_zip, ".zip", "application/zip"),
+    "parquet": (write_export_parquet_zip, ".zip", "application/zip"),
+}
+
+
+# ------------------------------------------------------------------------------
+# Versi tabel & cache file
+# ------------------------------------------------------------------------------
+def table_versions(conn) -> dict | None:
+    """
+    Versi per tabel = jumlah transaksi penulis yang tercatat di pwh.table_changes
+    (sql/004_table_versions.sql); None bila objeknya belum dibuat.
+    """
+    if not conn.execute(text("SELECT to_regclass('pwh.table_changes') IS NOT NULL")).scalar():
+        return None
+    rows = conn.execute(text(
+        "SELECT table_name, count(*) FROM pwh.table_changes WHERE table_name = ANY(:tables) GROUP BY 1"
+    ), {"tables": EXPORT_TABLES}).all()
+    versions = dict.fromkeys(EXPORT_TABLES, 0)
+    versions.update({name: int(v) for name, v in rows})
+    return versions
+
+
+def export_key(versions: dict, sheets: list[ExportSheet], scope: dict) -> str:
+    """Kunci cache: versi tabel + definisi sheet + cakupan (cabang, filter, ...)."""
+    payload = json.dumps([EXPORT_LAYOUT_VERSION, versions, [tuple(s) for s in sheets], scope],
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:20]
+
+
+# File cakupan lain (filter/since berbeda) yang tidak dipakai selama ini ikut dibersihkan
+EXPORT_CACHE_KEEP_S = 24 * 3600
+# Membuat/memakai file cache, keep() dan pembersihan versi lama berjalan di bawah
+# lock ini: pekerjaan export paralel tidak menghapus file yang baru diambil pekerjaan lain.
+_cache_lock = threading.Lock()
+
+
+def _prune_cache(cache_dir: str, base: str, ext: str, scope_prefix: str, keep_path: str):
+    """Menghapus versi lama cakupan yang sama dan file cakupan lain yang sudah lama tidak dipakai."""
+    cutoff = time.time() - EXPORT_CACHE_KEEP_S
+    for old in glob.glob(os.path.join(cache_dir, f"{base}_*{ext}")):
+        if old == keep_path:
+            continue
+        try:
+            if os.path.basename(old).startswith(f"{scope_prefix}_") or os.path.getmtime(old) < cutoff:
+                os.remove(old)
+        except OSError:
+            pass
+
+
+def cached_export(engine, cache_dir: str, prefix: str, sheets: list[ExportSheet],
+                  conditions: list[str] | None = None, params: dict | None = None,
+                  progress: Callable[[str], None] | None = None, fmt: str = "xlsx",
+                  keep: Callable[[str], None] | None = None) -> ExportFile:
+    """
+    File export (fmt: kunci EXPORT_FORMATS) untuk versi data saat ini. Bila
+    tabel versi tersedia, file di-cache di cache_dir per (prefix, format,
+    cakupan, kunci versi) dan dipakai ulang selama tidak ada tabel PWH yang
+    berubah; versi lama dengan cakupan yang sama dihapus. Cakupan = sheet +
+    kondisi + parameter (cabang, filter, since). Tanpa tabel versi file selalu
+    dibangun ulang (tetap streaming).
+
+    keep(path): dipanggil di bawah lock cache sebelum file lama dibersihkan,
+    mis. untuk me-link file ke folder hasil pekerjaan latar belakang.
+    """
+    writer, ext, _ = EXPORT_FORMATS[fmt]
+    base = f"{prefix}_{fmt}"
+    with engine.connect() as conn:
+        versions = table_versions(conn)
+    scope = {"conditions": conditions or [], "params": params or {}}
+    scope_prefix = f"{base}_{export_key({}, sheets, scope)[:12]}"
+    key = export_key(versions, sheets, scope) if versions is not None else "nocache"
+    path = os.path.join(cache_dir, f"{scope_prefix}_{key}{ext}")
+    if versions is not None:
+        with _cache_lock:
+            if os.path.exists(path):
+                os.utime(path)  # tanda dipakai, lihat EXPORT_CACHE_KEEP_S
+                if keep is not None:
+                    keep(path)
+                return ExportFile(path, True, {})
+
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    # REPEATABLE READ: semua sheet dibaca dari snapshot yang sama
+    try:
+        with engine.connect().execution_options(isolation_level="REPEATABLE READ") as conn:
+            counts = writer(conn, tmp, sheets, conditions, params, progress=progress)
+            conn.rollback()
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    with _cache_lock:
+        os.replace(tmp, path)
+        if keep is not None:
+            keep(path)
+        _prune_cache(cache_dir, base, ext, scope_prefix, path)
+    return ExportFile(path, False, counts)
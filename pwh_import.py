@@ -0,0 +1,818 @@
+# pwh_import.py
+# Pipeline import bulk berbasis set untuk halaman input (01_pwh_input.py):
+#   1. baca sheet template bulk secara streaming per chunk (bisa paralel per sheet),
+#      dari workbook .xlsx atau ZIP berisi CSV/Parquet per sheet,
+#   2. validasi & normalisasi vektor per sheet (tanpa iterrows) + laporan error per baris;
+#      chunk valid disimpan ke file sementara (SpooledChunks) sehingga memori tetap per chunk,
+#   3. COPY ke tabel staging sementara lalu INSERT ... SELECT per tabel tujuan,
+#      dengan rujukan pasien di-resolve lewat join,
+#   4. bila ada ledger import: commit per chunk + hash baris agar unggah ulang idempoten.
+#
+# Modul ini sengaja tidak mengimpor streamlit supaya bisa dipakai dari tools/.
+import io
+import json
+import os
+import pickle
+import tempfile
+import zipfile
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Executor, as_completed
+from datetime import date, datetime
+from typing import NamedTuple
+
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xlsxwriter
+from sqlalchemy import text
+
+# ------------------------------------------------------------------------------
+# Peta header template -> kolom database
+# ------------------------------------------------------------------------------
+MAP_PAT = {
+    "Nama Lengkap": "full_name", "Tempat Lahir": "birth_place", "Tanggal Lahir": "birth_date", "NIK": "nik",
+    "Gol. Darah": "blood_group", "Rhesus": "rhesus", "Jenis Kelamin": "gender", "Pekerjaan": "occupation",
+    "Pendidikan Terakhir": "education", "Alamat": "address", "No. Ponsel": "phone", "Propinsi": "province",
+    "Kabupaten/Kota": "city", "Kecamatan": "district", "Kelurahan/Desa": "village",
+    "HMHI Cabang": "cabang", "Kota Cakupan Cabang": "kota_cakupan",
+    "Catatan": "note"
+}
+MAP_DIAG = {
+    "Nama Lengkap": "full_name", "Jenis Hemofilia": "hemo_type", "Kategori": "severity",
+    "Tgl Diagnosis": "diagnosed_on", "Sumber": "source", "patient_id": "patient_id"
+}
+MAP_INH = {
+    "Nama Lengkap": "full_name", "Faktor": "factor", "Titer (BU)": "titer_bu",
+    "Tgl Ukur": "measured_on", "Lab": "lab", "patient_id": "patient_id"
+}
+MAP_VIRUS = {
+    "Nama Lengkap": "full_name", "Jenis Tes": "test_type", "Hasil": "result",
+    "Tgl Tes": "tested_on", "Lab": "lab", "patient_id": "patient_id"
+}
+MAP_HOSP = {
+    "Nama Lengkap": "full_name", "Nama RS": "name_hospital", "Kota RS": "city_hospital", "Provinsi RS": "province_hospital",
+    "Tanggal Kunjungan": "date_of_visit", "DPJP": "doctor_in_charge", "Jenis Penanganan": "treatment_type",
+    "Layanan Rawat": "care_services", "Frekuensi": "frequency", "Dosis": "dose", "Produk": "product",
+    "Merk": "merk", "patient_id": "patient_id"
+}
+MAP_DEATH = {
+    "Nama Lengkap": "full_name", "Penyebab Kematian": "cause_of_death", "Tahun Kematian": "year_of_death",
+    "patient_id": "patient_id"
+}
+MAP_CONTACT = {
+    "Nama Lengkap": "full_name", "Relasi": "relation", "Nama Kontak": "name", "No. Telp": "phone",
+    "Primary": "is_primary", "patient_id": "patient_id"
+}
+
+# Bagian (= nama sheet template) -> (peta header, {kolom: jenis}, kolom wajib).
+# Jenis: text | nik | phone | date | number | int | bool | ref (patient_id)
+IMPORT_SHEETS = {
+    "Pasien": (MAP_PAT, {
+        "full_name": "text", "birth_place": "text", "birth_date": "date", "nik": "nik",
+        "blood_group": "text", "rhesus": "text", "gender": "text", "occupation": "text",
+        "education": "text", "address": "text", "phone": "phone", "province": "text", "city": "text",
+        "note": "text", "village": "text", "district": "text", "cabang": "text", "kota_cakupan": "text",
+    }, ["full_name", "nik"]),
+    "Diagnosa": (MAP_DIAG, {
+        "patient_id": "ref", "full_name": "text", "hemo_type": "text", "severity": "text",
+        "diagnosed_on": "date", "source": "text",
+    }, ["hemo_type"]),
+    "Inhibitor": (MAP_INH, {
+        "patient_id": "ref", "full_name": "text", "factor": "text", "titer_bu": "number",
+        "measured_on": "date", "lab": "text",
+    }, ["factor"]),
+    "Virus Tes": (MAP_VIRUS, {
+        "patient_id": "ref", "full_name": "text", "test_type": "text", "result": "text",
+        "tested_on": "date", "lab": "text",
+    }, ["test_type", "result"]),
+    "RS Penangan": (MAP_HOSP, {
+        "patient_id": "ref", "full_name": "text", "name_hospital": "text", "city_hospital": "text",
+        "province_hospital": "text", "date_of_visit": "date", "doctor_in_charge": "text",
+        "treatment_type": "text", "care_services": "text", "frequency": "text", "dose": "text",
+        "product": "text", "merk": "text",
+    }, []),
+    "Kematian": (MAP_DEATH, {
+        "patient_id": "ref", "full_name": "text", "cause_of_death": "text", "year_of_death": "int",
+    }, []),
+    "Kontak": (MAP_CONTACT, {
+        "patient_id": "ref", "full_name": "text", "relation": "text", "name": "text",
+        "phone": "text", "is_primary": "bool",
+    }, ["relation"]),
+}
+
+# Bagian data terkait -> (tabel tujuan, kunci unik selain patient_id atau None, klausa ON CONFLICT).
+# Baris dengan kunci sama di satu file diringkas (baris terakhir menang) karena
+# ON CONFLICT DO UPDATE tidak boleh menyentuh baris yang sama dua kali.
+IMPORT_TARGETS = {
+    "Diagnosa": ("pwh.hemo_diagnoses", ["hemo_type"],
+                 "ON CONFLICT (patient_id, hemo_type) DO UPDATE SET severity = EXCLUDED.severity, "
+                 "diagnosed_on = COALESCE(EXCLUDED.diagnosed_on, t.diagnosed_on), "
+                 "source = COALESCE(EXCLUDED.source, t.source)"),
+    "Inhibitor": ("pwh.hemo_inhibitors", None, ""),
+    "Virus Tes": ("pwh.virus_tests", ["test_type", "tested_on"],
+                  "ON CONFLICT (patient_id, test_type, tested_on) DO NOTHING"),
+    "RS Penangan": ("pwh.treatment_hospital", None, ""),
+    "Kematian": ("pwh.death", [],
+                 "ON CONFLICT (patient_id) DO UPDATE SET cause_of_death = EXCLUDED.cause_of_death, "
+                 "year_of_death = EXCLUDED.year_of_death"),
+    "Kontak": ("pwh.contacts", None, ""),
+}
+
+PATIENT_IMPORT_COLUMNS = list(IMPORT_SHEETS["Pasien"][1])
+# Bagian -> tabel tujuan (untuk batas panjang kolom, lihat column_limits)
+IMPORT_TABLES = {"Pasien": "pwh.patients", **{part: t[0] for part, t in IMPORT_TARGETS.items()}}
+REF_COLUMNS = ("patient_id", "full_name")
+TRUE_VALUES = ("true", "1", "yes", "ya", "y")
+ERROR_COLUMNS = ["Sheet", "Baris", "Kolom", "Pesan"]
+
+
+class ImportReport(NamedTuple):
+    """Jumlah baris yang ditulis per bagian dan laporan baris yang ditolak."""
+    counts: dict
+    errors: pd.DataFrame
+    dry_run: bool = False
+    skipped: int = 0               # baris yang sudah tercatat di ledger import
+    note: str | None = None
+
+
+def concat_errors(frames: list[pd.DataFrame]) -> pd.DataFrame:
+    frames = [f for f in frames if f is not None and not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=ERROR_COLUMNS)
+    return pd.concat(frames, ignore_index=True).sort_values(["Sheet", "Baris"], kind="stable", ignore_index=True)
+
+
+# ------------------------------------------------------------------------------
+# Baca workbook (openpyxl read-only, streaming per chunk)
+# ------------------------------------------------------------------------------
+# pd.ExcelFile memuat seluruh sheet (objek cell openpyxl) ke memori sebelum
+# diproses. Mode read_only membaca XML sheet secara streaming sehingga memori
+# hanya sebesar satu chunk baris; tiap sheet bisa diparse di proses terpisah.
+IMPORT_CHUNK_ROWS = 5000
+
+
+def _sheet_name(sheetnames: list[str], part: str) -> str | None:
+    return {name.strip().lower(): name for name in sheetnames}.get(part.lower())
+
+
+# Sumber import: workbook template (.xlsx), atau ZIP berisi satu file per sheet
+# dengan nama bagian sebagai nama file (mis. "Pasien.csv", "Virus Tes.parquet").
+# Header & peta kolom (MAP_*) sama untuk semua format.
+IMPORT_FORMATS = {".xlsx": "Excel (.xlsx)", ".zip": "ZIP berisi CSV/Parquet per sheet"}
+ZIP_MEMBER_TYPES = (".csv", ".parquet")
+
+
+def _is_zip_source(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() == ".zip"
+
+
+def _zip_members(zf: zipfile.ZipFile) -> dict[str, str]:
+    """Bagian IMPORT_SHEETS -> nama anggota ZIP (folder di dalam ZIP diabaikan)."""
+    members = {}
+    for info in zf.infolist():
+        base = os.path.basename(info.filename)
+        stem, ext = os.path.splitext(base)
+        if info.is_dir() or base.startswith(".") or ext.lower() not in ZIP_MEMBER_TYPES:
+            continue
+        part = _sheet_name(list(IMPORT_SHEETS), stem.strip())
+        if part and part not in members:
+            members[part] = info.filename
+    return members
+
+
+def _as_raw(df: pd.DataFrame, first_row: int) -> pd.DataFrame:
+    """Chunk CSV/Parquet -> bentuk yang sama dengan chunk xlsx (object, None, index = nomor baris)."""
+    df.columns = [str(c).strip() for c in df.columns]
+    df.index = range(first_row, first_row + len(df))
+    blank = df.isna().all(axis=1) if df.shape[1] else pd.Series(True, index=df.index)
+    for c in df.columns[df.dtypes == object]:
+        blank &= df[c].isna() | df[c].astype("string").str.strip().eq("").fillna(True)
+    df = df[~blank]
+    return df.astype(object).where(df.notna(), None)
+
+
+def _csv_sep(header: str) -> str:
+    # Excel berlokal Indonesia menyimpan CSV dengan ';'
+    return max(",;\t", key=header.count)
+
+
+def _iter_csv_chunks(zf: zipfile.ZipFile, member: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    with zf.open(member) as fh:
+        header = fh.readline().decode("utf-8-sig", errors="replace")
+    with zf.open(member) as fh:
+        reader = pd.read_csv(fh, sep=_csv_sep(header), dtype=str, keep_default_na=False,
+                             encoding="utf-8-sig", chunksize=chunk_rows)
+        row_no = 2  # nomor record + 1, seperti baris Excel (header = baris 1)
+        for df in reader:
+            yield _as_raw(df, row_no)
+            row_no += len(df)
+
+
+def _iter_parquet_chunks(zf: zipfile.ZipFile, member: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    pf = pq.ParquetFile(pa.BufferReader(zf.read(member)))
+    row_no = 2
+    for batch in pf.iter_batches(batch_size=chunk_rows):
+        df = batch.to_pandas()
+        yield _as_raw(df, row_no)
+        row_no += len(df)
+
+
+def iter_sheet_chunks(path: str, part: str, chunk_rows: int = IMPORT_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """
+    Sheet template -> DataFrame mentah per chunk (header sesuai template). Index
+    DataFrame adalah nomor baris Excel (header = baris 1; untuk CSV/Parquet
+    nomor record + 1) untuk laporan error; baris yang seluruhnya kosong
+    dilewati di sini.
+    """
+    if _is_zip_source(path):
+        with zipfile.ZipFile(path) as zf:
+            member = _zip_members(zf).get(part)
+            if member is None:
+                return
+            if member.lower().endswith(".parquet"):
+                yield from _iter_parquet_chunks(zf, member, chunk_rows)
+            else:
+                yield from _iter_csv_chunks(zf, member, chunk_rows)
+        return
+
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        name = _sheet_name(wb.sheetnames, part)
+        if name is None:
+            return
+        rows = wb[name].iter_rows(values_only=True)
+        header = next(rows, None)
+        if not header:
+            return
+        columns = [str(h).strip() if h is not None else f"_kolom_{i}" for i, h in enumerate(header)]
+        width = len(columns)
+        buf, index = [], []
+        for row_no, values in enumerate(rows, start=2):
+            values = tuple(values[:width]) + (None,) * (width - len(values))
+            if all(v is None or (isinstance(v, str) and not v.strip()) for v in values):
+                continue
+            buf.append(values)
+            index.append(row_no)
+            if len(buf) >= chunk_rows:
+                yield pd.DataFrame(buf, columns=columns, index=index, dtype=object)
+                buf, index = [], []
+        if buf:
+            yield pd.DataFrame(buf, columns=columns, index=index, dtype=object)
+    finally:
+        wb.close()
+
+
+def workbook_parts(path: str) -> list[str]:
+    """Bagian IMPORT_SHEETS yang sheet-nya ada di workbook (atau file-nya ada di ZIP)."""
+    if _is_zip_source(path):
+        with zipfile.ZipFile(path) as zf:
+            members = _zip_members(zf)
+        return [part for part in IMPORT_SHEETS if part in members]
+    wb = openpyxl.load_workbook(path, read_only=True)
+    try:
+        return [part for part in IMPORT_SHEETS if _sheet_name(wb.sheetnames, part)]
+    finally:
+        wb.close()
+
+
+class SpooledChunks:
+    """
+    Chunk baris valid satu sheet, ditulis parse_sheet ke file sementara (pickle
+    berurutan) dan dibaca ulang satu per satu saat load. Memori tetap sebesar
+    satu chunk, dan yang dikirim balik dari process pool hanya path + jumlah
+    baris. Bisa diiterasi berulang; hapus filenya dengan remove().
+    """
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix="pwh_import_", suffix=".pkl")
+        os.close(fd)
+        self.rows = 0
+        self.exclude: frozenset = frozenset()  # row_no yang ditolak setelah chunk ditulis
+
+    def __iter__(self) -> Iterator[pd.DataFrame]:
+        with open(self.path, "rb") as fh:
+            while True:
+                try:
+                    chunk = pickle.load(fh)
+                except EOFError:
+                    return
+                if self.exclude:
+                    chunk = chunk[~chunk["row_no"].isin(self.exclude)]
+                if not chunk.empty:
+                    yield chunk
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def parse_sheet(path: str, part: str, enums: dict | None = None,
+                chunk_rows: int = IMPORT_CHUNK_ROWS, limits: dict | None = None) -> tuple[str, SpooledChunks, pd.DataFrame]:
+    """
+    Stream + normalisasi satu sheet: (bagian, chunk baris valid di disk, laporan error).
+    Fungsi level modul agar bisa dijalankan di ProcessPoolExecutor.
+    """
+    spool, errors, nik_keys = SpooledChunks(), [], []
+    try:
+        with open(spool.path, "wb") as fh:
+            for raw in iter_sheet_chunks(path, part, chunk_rows):
+                clean, err = normalize_sheet(part, raw, enums, limits)
+                if not clean.empty:
+                    pickle.dump(clean, fh, protocol=pickle.HIGHEST_PROTOCOL)
+                    spool.rows += len(clean)
+                    if part == "Pasien":
+                        nik_keys.append(clean[["row_no", "nik"]])
+                errors.append(err)
+        if part == "Pasien":
+            dup_rows, err = duplicate_nik_rows(nik_keys)
+            spool.exclude = frozenset(dup_rows)
+            spool.rows -= len(dup_rows)
+            errors.append(err)
+    except BaseException:
+        spool.remove()
+        raise
+    return part, spool, concat_errors(errors)
+
+
+def iter_parsed_sheets(path: str, enums: dict | None = None, executor: Executor | None = None,
+                       limits: dict | None = None) -> Iterator[tuple[str, SpooledChunks, pd.DataFrame]]:
+    """
+    parse_sheet untuk setiap sheet template, paralel bila executor diberikan
+    (hasil keluar sesuai urutan selesai), selain itu berurutan di proses ini.
+    """
+    parts = workbook_parts(path)
+    if executor is None:
+        for part in parts:
+            yield parse_sheet(path, part, enums, limits=limits)
+        return
+    futures = [executor.submit(parse_sheet, path, part, enums, limits=limits) for part in parts]
+    for future in as_completed(futures):
+        yield future.result()
+
+
+# ------------------------------------------------------------------------------
+# Validasi & normalisasi vektor
+# ------------------------------------------------------------------------------
+def _text(s: pd.Series) -> pd.Series:
+    s = s.astype("string").str.strip()
+    return s.mask(s == "")
+
+
+def normalize_sheet(part: str, raw: pd.DataFrame, enums: dict | None = None,
+                    limits: dict | None = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Validasi & normalisasi satu sheet tanpa loop per baris.
+
+    enums: {(bagian, kolom): nilai yang diizinkan}, mis. dari fetch_enum_vals.
+    limits: {(bagian, kolom): panjang maksimum}, dari column_limits.
+    Mengembalikan (baris valid dengan kolom row_no, laporan error per baris).
+    Baris kosong, baris catatan template, dan baris data terkait tanpa
+    patient_id/Nama Lengkap dilewati tanpa dilaporkan (sama seperti sebelumnya).
+    """
+    rename_map, kinds, required = IMPORT_SHEETS[part]
+    enums, limits = enums or {}, limits or {}
+    df = raw.rename(columns=lambda c: str(c).strip()).rename(columns=rename_map)
+    df = df.loc[:, ~df.columns.duplicated()]
+    missing = pd.Series(pd.NA, index=df.index, dtype="object")
+    col = lambda c: df[c] if c in df.columns else missing
+
+    out = pd.DataFrame({"row_no": df.index}, index=df.index)
+    for c, kind in kinds.items():
+        out[c] = _text(col(c)) if kind in ("text", "nik", "phone", "bool") else col(c)
+
+    # Baris yang dilewati diam-diam
+    first = _text(raw.iloc[:, 0]) if raw.shape[1] else missing.astype("string")
+    skip = first.str.lower().str.startswith("catatan:").fillna(False).astype(bool)
+    if part == "Pasien":
+        skip |= out["full_name"].isna()
+    else:
+        skip |= out["patient_id"].isna() & out["full_name"].isna()
+    out = out[~skip]
+
+    bad = pd.Series(False, index=out.index)
+    errors = []
+    headers = {v: k for k, v in rename_map.items()}  # laporan memakai header template
+
+    def flag(mask: pd.Series, column: str, message):
+        nonlocal bad
+        mask = mask.fillna(False).astype(bool)
+        if mask.any():
+            msg = message[mask] if isinstance(message, pd.Series) else message
+            errors.append(pd.DataFrame({"Sheet": part, "Baris": out.index[mask],
+                                        "Kolom": headers.get(column, column), "Pesan": msg}))
+            bad |= mask
+
+    for c, kind in kinds.items():
+        s = out[c]
+        present = s.notna() & (s.astype("string").str.strip() != "")
+        if kind == "nik":
+            s = s.str.replace(r"\.0$", "", regex=True)
+            flag(s.isna(), c, "NIK wajib diisi.")
+            flag(s.notna() & (s.str.len() != 16), c,
+                 "NIK '" + s + "' harus 16 digit (memiliki " + s.str.len().astype("string") + " digit).")
+        elif kind == "phone":
+            # Sama seperti _patient_params: ambil nomor pertama bila dipisah '/', maks. 20 karakter
+            long = s.str.len() > 20
+            s = s.where(~long.fillna(False), s.str.split("/").str[0].str.strip().str[:20])
+        elif kind == "date":
+            s = pd.to_datetime(s, errors="coerce", format="mixed")
+            flag(present & s.isna(), c, "Tanggal tidak valid (gunakan yyyy-mm-dd).")
+        elif kind in ("number", "int", "ref"):
+            s = pd.to_numeric(s, errors="coerce")
+            flag(present & s.isna(), c, "Harus berupa angka.")
+            if kind != "number":
+                fraction = s.notna() & (s % 1 != 0)
+                flag(fraction, c, "Harus berupa angka bulat.")
+                s = s.where(~fraction).astype("Int64")
+        elif kind == "bool":
+            s = s.str.lower().isin(TRUE_VALUES)
+        if c in required:
+            flag(~present, c, "Wajib diisi.")
+        max_len = limits.get((part, c))
+        if max_len and kind in ("text", "nik", "phone"):
+            flag(s.str.len() > max_len, c,
+                 f"Maksimal {max_len} karakter (terisi " + s.str.len().astype("string") + ").")
+        allowed = enums.get((part, c))
+        if allowed:
+            flag(s.notna() & ~s.isin([a for a in allowed if a]), c, "Nilai tidak dikenal: '" + s.astype("string") + "'.")
+        out[c] = s
+
+    if part != "Pasien":
+        out["name_key"] = out["full_name"].str.lower()
+    return out[~bad], concat_errors(errors)
+
+
+def duplicate_nik_rows(keys: list[pd.DataFrame]) -> tuple[set[int], pd.DataFrame]:
+    """
+    NIK yang muncul lebih dari sekali di sheet Pasien (keys: chunk row_no + nik):
+    baris pertama dipakai, row_no sisanya dikembalikan untuk ditolak.
+    """
+    if not keys:
+        return set(), concat_errors([])
+    keys = pd.concat(keys, ignore_index=True)
+    first_row = keys.groupby("nik")["row_no"].transform("min")
+    dup = keys[keys["row_no"] != first_row]
+    if dup.empty:
+        return set(), concat_errors([])
+    errors = pd.DataFrame({"Sheet": "Pasien", "Baris": dup["row_no"].to_numpy(), "Kolom": "NIK",
+                           "Pesan": ("NIK duplikat dengan baris " + first_row[dup.index].astype(str) + ".").to_numpy()})
+    return set(dup["row_no"]), errors
+
+
+# ------------------------------------------------------------------------------
+# Staging (COPY) & INSERT ... SELECT
+# ------------------------------------------------------------------------------
+def _column_types(conn, table: str) -> dict[str, str]:
+    rows = conn.execute(text("""
+        SELECT attname, format_type(atttypid, NULL) FROM pg_attribute
+        WHERE attrelid = CAST(:t AS regclass) AND attnum > 0 AND NOT attisdropped
+    """), {"t": table})
+    return dict(rows.all())
+
+
+def column_limits(conn) -> dict[tuple[str, str], int]:
+    """{(bagian, kolom): panjang maksimum} kolom character varying(n)/character(n) tabel tujuan import."""
+    rows = conn.execute(text("""
+        SELECT table_schema || '.' || table_name, column_name, character_maximum_length
+        FROM information_schema.columns
+        WHERE table_schema = 'pwh' AND character_maximum_length IS NOT NULL
+    """)).all()
+    by_table = {(table, column): int(n) for table, column, n in rows}
+    return {(part, c): by_table[(table, c)] for part, table in IMPORT_TABLES.items()
+            for c in IMPORT_SHEETS[part][1] if (table, c) in by_table}
+
+
+def _casts(conn, table: str, columns: list[str]) -> str:
+    """
+    Kolom staging (text) di-cast ke tipe dasar kolom tujuan (termasuk enum),
+    tanpa typmod: CAST eksplisit ke varchar(n) memotong diam-diam, sedangkan
+    assignment ke kolom varchar(n) menolak nilai yang terlalu panjang.
+    """
+    types = _column_types(conn, table)
+    return ", ".join(f"CAST(s.{c} AS {types.get(c, 'text')})" for c in columns)
+
+
+def _stage(conn, name: str, chunks: list[pd.DataFrame], columns: list[str], extra: str = ""):
+    """Tabel staging sementara (kolom text) yang diisi dengan satu COPY per chunk."""
+    defs = ", ".join(["row_no int"] + [f"{c} text" for c in columns] + ([extra] if extra else []))
+    conn.execute(text(f"CREATE TEMP TABLE {name} ({defs}) ON COMMIT DROP"))
+    copy_sql = f"COPY {name} (row_no, {', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+    cur = conn.connection.cursor()
+    try:
+        for chunk in chunks:
+            data = chunk[["row_no"] + columns].copy()
+            for c in columns:
+                if pd.api.types.is_datetime64_any_dtype(data[c]):
+                    data[c] = data[c].dt.strftime("%Y-%m-%d")
+            buf = io.StringIO()
+            data.to_csv(buf, index=False, header=False)
+            buf.seek(0)
+            cur.copy_expert(copy_sql, buf)
+    finally:
+        cur.close()
+
+
+RESOLVE_SQL = """
+    UPDATE {stg} s SET pid = COALESCE(pi.id, fk.id, pn.id)
+    FROM {stg} s2
+    LEFT JOIN pwh.patients pi
+           ON pi.id = CAST(s2.patient_id AS bigint)
+          AND (CAST(:branch AS text) IS NULL OR pi.cabang = :branch)
+    LEFT JOIN {keys} fk
+           ON s2.patient_id IS NULL AND fk.name_key = s2.name_key
+    LEFT JOIN (
+        SELECT lower(full_name) AS name_key, min(id) AS id
+        FROM pwh.patients
+        WHERE lower(full_name) IN (SELECT name_key FROM {stg})
+          AND (CAST(:branch AS text) IS NULL OR cabang = :branch)
+        GROUP BY 1
+    ) pn ON s2.patient_id IS NULL AND pn.name_key = s2.name_key
+    WHERE s2.row_no = s.row_no
+"""
+
+
+class _Batch(NamedTuple):
+    written: int
+    skipped: int
+    errors: pd.DataFrame | None
+
+
+def _row_hash_sql(part: str, columns: list[str]) -> str:
+    """Hash isi baris ter-normalisasi (untuk data terkait: termasuk pasien hasil resolve)."""
+    fields = ", ".join(f"s.{c}" for c in columns)
+    return f"md5('{part}' || ROW({fields})::text)"
+
+
+# Nama & NIK pasien di file ini: diisi dari staging tiap chunk Pasien, lalu
+# di-resolve sekali ke id (PATIENT_KEYS) sebelum chunk data terkait pertama.
+PATIENT_KEYS_SRC, PATIENT_KEYS = "stg_keys_src", "stg_keys"
+
+
+def _create_patient_keys(conn, on_commit: str):
+    conn.execute(text(f"DROP TABLE IF EXISTS {PATIENT_KEYS}, {PATIENT_KEYS_SRC}"))
+    conn.execute(text(f"CREATE TEMP TABLE {PATIENT_KEYS_SRC} (row_no int, full_name text, nik text) "
+                      f"ON COMMIT {on_commit}"))
+
+
+def _resolve_patient_keys(conn, dry_run: bool, on_commit: str):
+    """Nama pasien di file ini -> id (0 = pasien baru yang belum di-INSERT saat dry run)."""
+    conn.execute(text(f"""
+        CREATE TEMP TABLE {PATIENT_KEYS} ON COMMIT {on_commit} AS
+        SELECT DISTINCT ON (lower(s.full_name)) lower(s.full_name) AS name_key,
+               {'COALESCE(p.id, 0)' if dry_run else 'p.id'} AS id
+        FROM {PATIENT_KEYS_SRC} s LEFT JOIN pwh.patients p ON p.nik = s.nik
+        ORDER BY lower(s.full_name), s.row_no
+    """))
+
+
+def _load_batch(conn, n: int, part: str, chunk: pd.DataFrame,
+                branch: str | None, dry_run: bool, ledger: bool, file_hash: str | None) -> _Batch:
+    """
+    Satu chunk satu bagian: staging, resolve rujukan pasien, buang baris yang
+    sudah tercatat di ledger, lalu INSERT ... SELECT (dilewati saat dry run).
+    Nama tabel staging diberi akhiran n karena dry run memakai satu transaksi.
+    """
+    stg, errors = f"stg_{n}", None
+    if part == "Pasien":
+        cols = PATIENT_IMPORT_COLUMNS
+        _stage(conn, stg, [chunk], cols, extra="row_hash text")
+        hash_cols = cols
+        conn.execute(text(f"INSERT INTO {PATIENT_KEYS_SRC} SELECT row_no, full_name, nik FROM {stg}"))
+    else:
+        table, key_cols, conflict = IMPORT_TARGETS[part]
+        cols = [c for c in IMPORT_SHEETS[part][1] if c not in REF_COLUMNS]
+        _stage(conn, stg, [chunk], ["patient_id", "name_key"] + cols, extra="pid bigint, row_hash text")
+        hash_cols = ["pid"] + cols
+        conn.execute(text(RESOLVE_SQL.format(stg=stg, keys=PATIENT_KEYS)), {"branch": branch})
+
+        unresolved = pd.DataFrame(conn.execute(text(
+            f"SELECT row_no, patient_id, name_key FROM {stg} WHERE pid IS NULL")).all(),
+            columns=["row_no", "patient_id", "name_key"])
+        if not unresolved.empty:
+            by_id = unresolved["patient_id"].notna()
+            errors = pd.DataFrame({
+                "Sheet": part, "Baris": unresolved["row_no"],
+                "Kolom": by_id.map({True: "patient_id", False: "Nama Lengkap"}),
+                "Pesan": by_id.map({True: "patient_id tidak ditemukan", False: "Nama pasien tidak ditemukan"})
+                         + " (di cabang Anda).",
+            })
+            conn.execute(text(f"DELETE FROM {stg} WHERE pid IS NULL"))
+
+    skipped = 0
+    if ledger:
+        conn.execute(text(f"UPDATE {stg} s SET row_hash = {_row_hash_sql(part, hash_cols)}"))
+        skipped = conn.execute(text(f"""
+            DELETE FROM {stg} s USING pwh.import_rows r
+            WHERE r.file_hash = :file_hash AND r.row_hash = s.row_hash
+        """), {"file_hash": file_hash}).rowcount
+
+    if dry_run:
+        if part == "Pasien":
+            written = conn.execute(text(f"""
+                SELECT count(DISTINCT s.nik) FROM {stg} s
+                WHERE NOT EXISTS (SELECT 1 FROM pwh.patients p WHERE p.nik = s.nik)
+            """)).scalar()
+        else:
+            written = conn.execute(text(f"SELECT count(*) FROM {stg}")).scalar()
+        return _Batch(written, skipped, errors)
+
+    if part == "Pasien":
+        # NIK yang sudah ada dipakai ulang (DO NOTHING), sama seperti import sebelumnya
+        written = conn.execute(text(f"""
+            INSERT INTO pwh.patients ({', '.join(cols)})
+            SELECT DISTINCT ON (s.nik) {_casts(conn, 'pwh.patients', cols)}
+            FROM {stg} s ORDER BY s.nik, s.row_no
+            ON CONFLICT (nik) DO NOTHING
+        """)).rowcount
+    else:
+        distinct = order = ""
+        if key_cols is not None:
+            keys_sql = ", ".join(["s.pid"] + [f"s.{c}" for c in key_cols])
+            distinct, order = f"DISTINCT ON ({keys_sql})", f" ORDER BY {keys_sql}, s.row_no DESC"
+        written = conn.execute(text(f"""
+            INSERT INTO {table} AS t (patient_id, {', '.join(cols)})
+            SELECT {distinct} s.pid, {_casts(conn, table, cols)}
+            FROM {stg} s WHERE s.pid IS NOT NULL{order}
+            {conflict}
+        """)).rowcount
+
+    if ledger:
+        # Dicatat di transaksi yang sama dengan datanya: chunk ini tepat sekali diterapkan
+        conn.execute(text(f"""
+            INSERT INTO pwh.import_rows (row_hash, part, file_hash)
+            SELECT DISTINCT row_hash, :part, :file_hash FROM {stg}
+            ON CONFLICT (file_hash, row_hash) DO NOTHING
+        """), {"part": part, "file_hash": file_hash})
+    return _Batch(written, skipped, errors)
+
+
+# ------------------------------------------------------------------------------
+# Ledger import (sql/003_import_ledger.sql)
+# ------------------------------------------------------------------------------
+def ledger_available(conn) -> bool:
+    return bool(conn.execute(text(
+        "SELECT to_regclass('pwh.import_files') IS NOT NULL AND to_regclass('pwh.import_rows') IS NOT NULL"
+    )).scalar())
+
+
+def _ledger_start(conn, file_hash: str, file_name: str | None, branch: str | None) -> str | None:
+    """Mencatat unggahan file; mengembalikan catatan bila file yang sama pernah diunggah."""
+    row = conn.execute(text("""
+        INSERT INTO pwh.import_files (file_hash, file_name, branch)
+        VALUES (:file_hash, :file_name, :branch)
+        ON CONFLICT (file_hash) DO UPDATE SET attempts = pwh.import_files.attempts + 1, started_at = now()
+        RETURNING attempts, finished_at
+    """), {"file_hash": file_hash, "file_name": file_name, "branch": branch}).first()
+    if row.attempts <= 1:
+        return None
+    if row.finished_at is not None:
+        return (f"File yang sama sudah pernah di-import lengkap ({row.finished_at:%Y-%m-%d %H:%M}); "
+                "baris yang sudah tersimpan dilewati.")
+    return "Melanjutkan import file yang sebelumnya terhenti; chunk yang sudah tersimpan dilewati."
+
+
+def _ledger_finish(conn, file_hash: str, counts: dict):
+    conn.execute(text("""
+        UPDATE pwh.import_files SET finished_at = now(), counts = CAST(:counts AS jsonb)
+        WHERE file_hash = :file_hash
+    """), {"file_hash": file_hash, "counts": json.dumps(counts)})
+
+
+def load_import(engine, frames: dict[str, Iterable[pd.DataFrame]], branch: str | None = None,
+                progress: Callable[[str], None] | None = None, dry_run: bool = False,
+                file_hash: str | None = None, file_name: str | None = None) -> ImportReport:
+    """
+    Menulis chunk baris valid hasil parse_sheet (iterable per bagian, dibaca
+    satu chunk setiap kali, mis. SpooledChunks): pasien lebih dulu, lalu data
+    terkait. Data terkait merujuk patient_id (dicek di cabang user) atau Nama
+    Lengkap: pasien di file ini lebih dulu, lalu pasien di database.
+
+    Dengan ledger (sql/003_import_ledger.sql) dan file_hash, setiap chunk
+    di-commit sendiri (checkpoint) beserta hash barisnya, sehingga unggah ulang
+    setelah timeout hanya menulis baris yang belum tersimpan. Tanpa ledger
+    seluruh file ditulis dalam satu transaksi seperti sebelumnya.
+
+    dry_run: staging, resolve & cek ledger tetap dijalankan, INSERT dilewati;
+    counts berisi jumlah baris yang akan ditulis dan transaksinya di-rollback.
+    """
+    progress = progress or (lambda label: None)
+    batches = ((part, c) for part in ["Pasien", *IMPORT_TARGETS] for c in frames.get(part, ()))
+
+    counts, errors, skipped, note = {}, [], 0, None
+
+    with engine.connect() as conn:
+        ledger = file_hash is not None and ledger_available(conn)
+        # Dengan ledger tiap chunk di-commit sendiri di koneksi ini, jadi tabel
+        # nama pasien harus bertahan melewati commit (dan dihapus di akhir).
+        checkpoint = ledger and not dry_run
+        on_commit = "PRESERVE ROWS" if checkpoint else "DROP"
+        try:
+            if checkpoint:
+                note = _ledger_start(conn, file_hash, file_name, branch)
+                conn.commit()
+            _create_patient_keys(conn, on_commit)
+            keys_ready = False
+            for n, (part, chunk) in enumerate(batches):
+                if part not in counts:
+                    progress(part)
+                if part != "Pasien" and not keys_ready:
+                    _resolve_patient_keys(conn, dry_run, on_commit)
+                    keys_ready = True
+                res = _load_batch(conn, n, part, chunk, branch, dry_run, ledger, file_hash)
+                counts[part] = counts.get(part, 0) + res.written
+                skipped += res.skipped
+                errors.append(res.errors)
+                if checkpoint:
+                    conn.commit()
+            if dry_run:
+                conn.rollback()
+            else:
+                if checkpoint:
+                    _ledger_finish(conn, file_hash, counts)
+                conn.commit()
+        finally:
+            if checkpoint:
+                try:
+                    conn.rollback()
+                    conn.execute(text(f"DROP TABLE IF EXISTS {PATIENT_KEYS}, {PATIENT_KEYS_SRC}"))
+                    conn.commit()
+                except Exception:
+                    pass  # koneksi bermasalah: error asli yang dilaporkan; tabel dihapus di import berikutnya
+
+    return ImportReport(counts, concat_errors(errors), dry_run=dry_run, skipped=skipped, note=note)
+
+
+# ------------------------------------------------------------------------------
+# Workbook beranotasi (hasil dry run)
+# ------------------------------------------------------------------------------
+STATUS_HEADER = "Status Validasi"
+
+
+def build_annotated_workbook(path: str, out_path: str, errors: pd.DataFrame, counts: dict | None = None):
+    """
+    Salinan sheet template yang di-stream ulang dari path ke out_path, dengan
+    kolom 'Status Validasi' per baris serta cell bermasalah diwarnai dan diberi
+    komentar. Sheet pertama merangkum jumlah baris valid & seluruh error.
+    Nomor baris sama dengan file asli. Baris ditulis berurutan sehingga
+    workbook di-flush per baris (constant_memory), seperti export Excel.
+    """
+    by_row: dict[tuple[str, int], dict[str, list[str]]] = {}
+    for sheet, row, column, message in errors[ERROR_COLUMNS].itertuples(index=False):
+        by_row.setdefault((sheet, int(row)), {}).setdefault(column, []).append(message)
+
+    wb = xlsxwriter.Workbook(out_path, {"constant_memory": True})
+    fmt_header = wb.add_format({"bold": True, "bg_color": "#F2F2F2", "border": 1})
+    fmt_date = wb.add_format({"num_format": "yyyy-mm-dd"})
+    fmt_bad = wb.add_format({"bg_color": "#F8CBAD"})
+    fmt_bad_date = wb.add_format({"bg_color": "#F8CBAD", "num_format": "yyyy-mm-dd"})
+    fmt_ok = wb.add_format({"font_color": "#2E7D32"})
+    fmt_err = wb.add_format({"font_color": "#C00000", "text_wrap": True})
+
+    ws = wb.add_worksheet("Ringkasan Validasi")
+    ws.write_row(0, 0, ["Sheet", "Baris siap di-import", "Baris bermasalah"], fmt_header)
+    bad_rows = errors.groupby("Sheet")["Baris"].nunique() if not errors.empty else pd.Series(dtype=int)
+    for r, part in enumerate(IMPORT_SHEETS, start=1):
+        ws.write_row(r, 0, [part, (counts or {}).get(part, 0), int(bad_rows.get(part, 0))])
+    top = len(IMPORT_SHEETS) + 2
+    ws.write_row(top, 0, ERROR_COLUMNS, fmt_header)
+    for r, values in enumerate(errors[ERROR_COLUMNS].itertuples(index=False), start=top + 1):
+        ws.write_row(r, 0, [values[0], int(values[1]), values[2], values[3]])
+    ws.set_column(0, 0, 14)
+    ws.set_column(1, 2, 20)
+    ws.set_column(3, 3, 60)
+
+    for part in workbook_parts(path):
+        ws = wb.add_worksheet(part)
+        ws.freeze_panes(1, 0)
+        columns = None
+        for chunk in iter_sheet_chunks(path, part):
+            if columns is None:
+                columns = list(chunk.columns)
+                ws.write_row(0, 0, columns, fmt_header)
+                ws.write(0, len(columns), STATUS_HEADER, fmt_header)
+                ws.set_column(0, len(columns) - 1, 16)
+                ws.set_column(len(columns), len(columns), 60)
+            for row_no, values in zip(chunk.index, chunk.itertuples(index=False)):
+                issues = by_row.get((part, row_no), {})
+                r = row_no - 1
+                for c, (header, value) in enumerate(zip(columns, values)):
+                    bad = header in issues
+                    fmt = fmt_bad if bad else None
+                    if isinstance(value, (datetime, date)):
+                        ws.write_datetime(r, c, value, fmt_bad_date if bad else fmt_date)
+                    elif value is None:
+                        ws.write_blank(r, c, None, fmt)
+                    elif isinstance(value, bool):
+                        ws.write_boolean(r, c, value, fmt)
+                    elif isinstance(value, (int, float)):
+                        ws.write_number(r, c, value, fmt)
+                    else:
+                        ws.write_string(r, c, str(value), fmt)  # bukan write(): teks '=...' tidak jadi formula
+                    if bad:
+                        ws.write_comment(r, c, "\n".join(issues[header]))
+                if issues:
+                    ws.write(r, len(columns), "; ".join(f"{k}: {' '.join(v)}" for k, v in issues.items()), fmt_err)
+                else:
+                    ws.write(r, len(columns), "OK", fmt_ok)
+    wb.close()
@@ -0,0 +1,206 @@
+# pwh_jobs.py
+# Runner pekerjaan latar belakang untuk operasi panjang (export, import bulk,
+# cetak banyak PDF). Pekerjaan berjalan di thread pool milik proses, bukan di
+# thread script Streamlit, sehingga tidak memblokir sesi dan tidak hilang saat
+# rerun. Hasil ditulis ke disk (PWH_CACHE_DIR/jobs) dan diunduh dari panel
+# "Pekerjaan Saya" di sidebar main.py.
+#
+# Fungsi pekerjaan tidak boleh memanggil st.* (tidak ada konteks sesi di
+# thread pool): nilai sesi seperti cabang user diambil sebelum submit.
+#
+# Modul ini sengaja tidak mengimpor streamlit; satu runner per proses (lihat runner()).
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED = "antri", "berjalan", "selesai", "gagal"
+JOB_ACTIVE = (JOB_QUEUED, JOB_RUNNING)
+JOB_WORKERS = int(os.environ.get("PWH_JOB_WORKERS", "2"))
+JOB_KEEP_S = 24 * 3600          # pekerjaan & file hasil disimpan 24 jam
+JOB_META_FIELDS = ("id", "owner", "kind", "label", "file_name", "mime", "status", "progress",
+                   "message", "summary", "error", "created_at", "finished_at")
+
+
+def jobs_dir() -> str:
+    base = os.environ.get("PWH_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "pwh_cache")
+    path = os.path.join(base, "jobs")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class Job:
+    """Status satu pekerjaan. result: objek Python hasil fungsi (hanya di memori)."""
+
+    def __init__(self, owner: str, kind: str, label: str, file_name: str | None = None,
+                 mime: str = "application/octet-stream"):
+        self.id = uuid.uuid4().hex[:12]
+        self.owner, self.kind, self.label = owner, kind, label
+        self.file_name, self.mime = file_name, mime
+        self.status, self.progress, self.message = JOB_QUEUED, 0.0, ""
+        self.summary: str | None = None
+        self.error: str | None = None
+        self.result = None
+        self.created_at, self.finished_at = time.time(), None
+        self.path: str | None = None  # file hasil di disk (bila ada)
+
+    @property
+    def active(self) -> bool:
+        return self.status in JOB_ACTIVE
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in JOB_META_FIELDS}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Job":
+        job = cls.__new__(cls)
+        for k in JOB_META_FIELDS:
+            setattr(job, k, data.get(k))
+        job.result, job.path = None, None
+        return job
+
+
+class JobContext:
+    """Diteruskan ke fungsi pekerjaan: tempat menulis hasil & melaporkan progres."""
+
+    def __init__(self, job: Job, path: str):
+        self.job = job
+        self.path = path  # tulis file hasil ke sini (bila pekerjaan menghasilkan file)
+
+    def progress(self, fraction: float, message: str = ""):
+        self.job.progress = min(max(float(fraction), 0.0), 1.0)
+        if message:
+            self.job.message = message
+
+    def keep_file(self, src: str):
+        """Memakai file yang sudah ada (mis. file export di cache) sebagai hasil, tanpa menyalin isinya."""
+        try:
+            os.link(src, self.path)
+        except OSError:
+            shutil.copyfile(src, self.path)
+
+
+class JobRunner:
+    """Antrean pekerjaan per proses; status di memori + metadata JSON di disk."""
+
+    def __init__(self, folder: str, workers: int = JOB_WORKERS):
+        self.folder = folder
+        self._lock = threading.Lock()
+        self._jobs: dict[str, Job] = {}
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="pwh-job")
+        self._load()
+
+    def _meta_path(self, job_id: str) -> str:
+        return os.path.join(self.folder, f"{job_id}.json")
+
+    def _result_path(self, job: Job) -> str:
+        ext = os.path.splitext(job.file_name or "")[1]
+        return os.path.join(self.folder, f"{job.id}{ext}")
+
+    def _save(self, job: Job):
+        tmp = f"{self._meta_path(job.id)}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(job.to_dict(), f)
+        os.replace(tmp, self._meta_path(job.id))
+
+    def _load(self):
+        """Pekerjaan dari proses sebelumnya: yang selesai tetap bisa diunduh, yang terputus ditandai gagal."""
+        for name in os.listdir(self.folder):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.folder, name), encoding="utf-8") as f:
+                    job = Job.from_dict(json.load(f))
+            except (OSError, ValueError):
+                continue
+            if job.status in JOB_ACTIVE:
+                job.status, job.error = JOB_FAILED, "Terputus karena server dimulai ulang."
+                self._save(job)
+            if job.file_name and os.path.exists(self._result_path(job)):
+                job.path = self._result_path(job)
+            self._jobs[job.id] = job
+
+    def submit(self, owner: str, kind: str, label: str, fn: Callable[[JobContext], str | None],
+               file_name: str | None = None, mime: str = "application/octet-stream") -> Job:
+        """
+        Menjadwalkan fn(ctx) di thread pool. fn menulis hasil ke ctx.path (bila
+        file_name diberikan), boleh mengisi ctx.job.result, dan mengembalikan
+        ringkasan singkat untuk panel.
+        """
+        job = Job(owner, kind, label, file_name, mime)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._save(job)
+        self._pool.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job: Job, fn):
+        job.status = JOB_RUNNING
+        self._save(job)
+        path = self._result_path(job)
+        try:
+            job.summary = fn(JobContext(job, path))
+            if job.file_name and os.path.exists(path):
+                job.path = path
+            job.status, job.progress = JOB_DONE, 1.0
+        except Exception as e:
+            job.status, job.error = JOB_FAILED, f"{type(e).__name__}: {e}"
+            print(f"Pekerjaan {job.kind} {job.id} gagal:\n{traceback.format_exc()}")
+            if os.path.exists(path):
+                os.remove(path)
+        finally:
+            job.finished_at = time.time()
+            self._save(job)
+
+    def get(self, owner: str, job_id: str | None) -> Job | None:
+        job = self._jobs.get(job_id) if job_id else None
+        return job if job is not None and job.owner == owner else None
+
+    def jobs_for(self, owner: str) -> list[Job]:
+        """Pekerjaan milik owner, terbaru dulu; pekerjaan lama (> JOB_KEEP_S) dibersihkan."""
+        self._prune()
+        with self._lock:
+            jobs = [j for j in self._jobs.values() if j.owner == owner]
+        return sorted(jobs, key=lambda j: j.created_at, reverse=True)
+
+    def has_active(self, owner: str) -> bool:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return any(j.active for j in jobs if j.owner == owner)
+
+    def remove(self, owner: str, job_id: str):
+        job = self.get(owner, job_id)
+        if job is None or job.active:
+            return
+        with self._lock:
+            self._jobs.pop(job_id, None)
+        for path in (job.path, self._meta_path(job_id)):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    def _prune(self):
+        cutoff = time.time() - JOB_KEEP_S
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            if not job.active and (job.finished_at or job.created_at) < cutoff:
+                self.remove(job.owner, job.id)
+
+
+_runner: JobRunner | None = None
+_runner_lock = threading.Lock()
+
+
+def runner() -> JobRunner:
+    """Runner bersama untuk semua sesi & halaman (modul ini hanya diimpor sekali per proses)."""
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = JobRunner(jobs_dir())
+        return _runner
@@ -0,0 +1,114 @@
+# pwh_profiler.py
+# Profiler per-rerun untuk admin: timer per bagian (SQL, Styler, opsi selectbox,
+# xlsxwriter, ...) ditambah cProfile opsional. Diaktifkan dari sidebar main.py.
+#
+# Profil aktif disimpan per thread karena Streamlit menjalankan script setiap
+# sesi di thread-nya sendiri; di luar profil, section()/profiled() hampir gratis.
+import cProfile
+import functools
+import io
+import marshal
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+_local = threading.local()
+
+
+class RerunProfile:
+    """Akumulasi waktu per bagian untuk satu rerun halaman."""
+
+    def __init__(self, use_cprofile: bool = False):
+        self.sections: dict[str, list] = {}  # nama -> [jumlah panggilan, total detik]
+        self.total_s = 0.0
+        self._profiler = cProfile.Profile() if use_cprofile else None
+        self._t0 = None
+
+    def add(self, name: str, elapsed: float):
+        entry = self.sections.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+
+    def start(self):
+        self._t0 = time.perf_counter()
+        if self._profiler:
+            self._profiler.enable()
+
+    def stop(self):
+        if self._profiler:
+            self._profiler.disable()
+        self.total_s = time.perf_counter() - self._t0
+
+    def to_dataframe(self) -> pd.DataFrame:
+        rows = [
+            {"Bagian": name, "Panggilan": n, "Total (ms)": round(t * 1000, 1),
+             "% Rerun": round(100 * t / self.total_s, 1) if self.total_s else 0.0}
+            for name, (n, t) in self.sections.items()
+        ]
+        df = pd.DataFrame(rows, columns=["Bagian", "Panggilan", "Total (ms)", "% Rerun"])
+        return df.sort_values("Total (ms)", ascending=False).reset_index(drop=True)
+
+    def stats_text(self, limit: int = 60) -> str:
+        if not self._profiler:
+            return ""
+        out = io.StringIO()
+        pstats.Stats(self._profiler, stream=out).sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+    def stats_bytes(self) -> bytes:
+        """Stats mentah dalam format .prof (dapat dibuka dengan pstats/snakeviz)."""
+        if not self._profiler:
+            return b""
+        self._profiler.create_stats()
+        return marshal.dumps(self._profiler.stats)
+
+
+def active() -> RerunProfile | None:
+    return getattr(_local, "profile", None)
+
+
+@contextmanager
+def profiling(use_cprofile: bool = False):
+    """Mengaktifkan profil untuk thread ini selama blok berjalan."""
+    prof = RerunProfile(use_cprofile)
+    _local.profile = prof
+    prof.start()
+    try:
+        yield prof
+    finally:
+        prof.stop()
+        _local.profile = None
+
+
+@contextmanager
+def section(name: str):
+    """Timer satu bagian; tidak melakukan apa-apa jika profil tidak aktif."""
+    prof = getattr(_local, "profile", None)
+    if prof is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        prof.add(name, time.perf_counter() - t0)
+
+
+def profiled(name: str):
+    """Dekorator versi section() untuk fungsi."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            prof = getattr(_local, "profile", None)
+            if prof is None:
+                return fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                prof.add(name, time.perf_counter() - t0)
+        return wrapper
+    return deco
@@ -0,0 +1,35 @@
+-- 001_wilayah_dim.sql
+-- Dimensi wilayah datar (propinsi -> kab/kota -> kecamatan -> kelurahan/desa),
+-- satu baris per kelurahan/desa, dikunci oleh kode. Menggantikan tiga self-join
+-- LEFT(kode, n) atas public.wilayah yang tidak bisa memakai index.
+--
+-- Jalankan sekali:            psql "$DATABASE_URL" -f sql/001_wilayah_dim.sql
+-- Setelah public.wilayah berubah:
+--   REFRESH MATERIALIZED VIEW CONCURRENTLY pwh.wilayah_dim;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS pwh.wilayah_dim AS
+SELECT
+    kel.kode  AS village_kode,
+    kel.nama  AS village_name,
+    kec.kode  AS district_kode,
+    kec.nama  AS district_name,
+    kota.kode AS city_kode,
+    kota.nama AS city_name,
+    prov.kode AS province_kode,
+    prov.nama AS province_name,
+    CONCAT_WS(' - ', kel.nama, kec.nama, kota.nama, prov.nama) AS full_display
+FROM public.wilayah AS kel
+JOIN public.wilayah AS kec  ON kec.kode  = LEFT(kel.kode, 8)
+JOIN public.wilayah AS kota ON kota.kode = LEFT(kel.kode, 5)
+JOIN public.wilayah AS prov ON prov.kode = LEFT(kel.kode, 2)
+WHERE LENGTH(kel.kode) = 13;
+
+-- UNIQUE diperlukan untuk REFRESH ... CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS wilayah_dim_village_kode_uq ON pwh.wilayah_dim (village_kode);
+CREATE INDEX IF NOT EXISTS wilayah_dim_district_kode_idx ON pwh.wilayah_dim (district_kode);
+CREATE INDEX IF NOT EXISTS wilayah_dim_city_kode_idx     ON pwh.wilayah_dim (city_kode);
+CREATE INDEX IF NOT EXISTS wilayah_dim_province_kode_idx ON pwh.wilayah_dim (province_kode);
+
+-- Untuk memetakan kolom teks pwh.patients (province/city/district/village) ke kode
+CREATE INDEX IF NOT EXISTS wilayah_dim_names_idx
+    ON pwh.wilayah_dim (province_name, city_name, district_name, village_name);
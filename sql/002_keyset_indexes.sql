@@ -0,0 +1,17 @@
+-- 002_keyset_indexes.sql
+-- Index untuk tabel berhalaman (keyset pagination) di halaman input: daftar
+-- diurutkan & dipotong pada (p.full_name, id), dengan filter cabang untuk user
+-- non-admin, sehingga halaman berikutnya cukup membaca index dari kunci terakhir.
+--
+-- Jalankan sekali:            psql "$DATABASE_URL" -f sql/002_keyset_indexes.sql
+-- Setelah impor besar, perbarui statistik agar perkiraan jumlah baris akurat:
+--   ANALYZE pwh.patients;
+
+CREATE INDEX IF NOT EXISTS patients_full_name_id_idx        ON pwh.patients (full_name, id);
+CREATE INDEX IF NOT EXISTS patients_cabang_full_name_id_idx ON pwh.patients (cabang, full_name, id);
+
+CREATE INDEX IF NOT EXISTS hemo_diagnoses_patient_id_idx     ON pwh.hemo_diagnoses (patient_id, id);
+CREATE INDEX IF NOT EXISTS hemo_inhibitors_patient_id_idx    ON pwh.hemo_inhibitors (patient_id, id);
+CREATE INDEX IF NOT EXISTS virus_tests_patient_id_idx        ON pwh.virus_tests (patient_id, id);
+CREATE INDEX IF NOT EXISTS treatment_hospital_patient_id_idx ON pwh.treatment_hospital (patient_id, id);
+CREATE INDEX IF NOT EXISTS contacts_patient_id_idx           ON pwh.contacts (patient_id, id);
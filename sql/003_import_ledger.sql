@@ -0,0 +1,43 @@
+-- 003_import_ledger.sql
+-- Ledger import bulk: mencatat file yang pernah diunggah (hash SHA-256 isi file)
+-- dan hash setiap baris yang sudah ditulis, per file. Import di halaman input
+-- meng-commit per chunk bersama hash barisnya, sehingga unggah ulang file yang
+-- sama setelah timeout/gagal hanya menulis baris yang belum tersimpan. Baris
+-- yang sama di file lain tidak ikut dilewati (mis. kontak yang sudah dihapus
+-- lalu di-import ulang).
+--
+-- Jalankan sekali:            psql "$DATABASE_URL" -f sql/003_import_ledger.sql
+-- Tanpa tabel ini import tetap berjalan dalam satu transaksi (tanpa checkpoint).
+
+CREATE TABLE IF NOT EXISTS pwh.import_files (
+    file_hash   text PRIMARY KEY,
+    file_name   text,
+    branch      text,
+    attempts    int NOT NULL DEFAULT 1,
+    started_at  timestamptz NOT NULL DEFAULT now(),
+    finished_at timestamptz,
+    counts      jsonb
+);
+
+CREATE TABLE IF NOT EXISTS pwh.import_rows (
+    file_hash  text NOT NULL REFERENCES pwh.import_files (file_hash) ON DELETE CASCADE,
+    row_hash   text NOT NULL,
+    part       text NOT NULL,
+    applied_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (file_hash, row_hash)
+);
+
+-- Versi awal skrip ini memakai row_hash sebagai PRIMARY KEY global: ubah ke kunci per file.
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_index i
+        WHERE i.indrelid = 'pwh.import_rows'::regclass AND i.indisprimary AND i.indnatts = 1
+    ) THEN
+        DELETE FROM pwh.import_rows WHERE file_hash IS NULL;
+        ALTER TABLE pwh.import_rows DROP CONSTRAINT import_rows_pkey;
+        ALTER TABLE pwh.import_rows ALTER COLUMN file_hash SET NOT NULL;
+        ALTER TABLE pwh.import_rows ADD PRIMARY KEY (file_hash, row_hash);
+        DROP INDEX IF EXISTS pwh.import_rows_file_hash_idx;
+    END IF;
+END $$;
@@ -0,0 +1,52 @@
+-- 004_table_versions.sql
+-- Versi per tabel PWH untuk cache file export di halaman input. Setiap
+-- transaksi yang mengubah tabel (INSERT/UPDATE/DELETE/TRUNCATE, trigger
+-- statement-level) mencatat satu baris (tabel, txid) di pwh.table_changes;
+-- versi tabel = jumlah baris catatannya. Export dengan versi yang sama dipakai
+-- ulang dari disk tanpa query data.
+--
+-- Sengaja tanpa baris counter bersama: UPDATE satu baris per tabel mengunci
+-- baris itu sampai commit dan membuat semua penulis tabel yang sama (import per
+-- chunk, simpan grid, form) antre satu per satu. Di sini tiap transaksi hanya
+-- menyisipkan kuncinya sendiri (tidak saling menunggu), dan catatan baru
+-- terlihat setelah commit, jadi versi konsisten dengan snapshot pembaca --
+-- berbeda dengan sequence (nextval langsung terlihat sebelum data di-commit).
+-- Tabel catatan bertambah satu baris per transaksi penulis per tabel.
+--
+-- Jalankan sekali:            psql "$DATABASE_URL" -f sql/004_table_versions.sql
+-- Tanpa tabel ini export tetap streaming, tetapi selalu dibangun ulang.
+
+CREATE TABLE IF NOT EXISTS pwh.table_changes (
+    table_name text NOT NULL,
+    txid       bigint NOT NULL DEFAULT txid_current(),
+    changed_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (table_name, txid)
+);
+
+CREATE OR REPLACE FUNCTION pwh.record_table_change() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    -- Konflik hanya dengan baris transaksi ini sendiri (statement berikutnya): tidak menunggu
+    INSERT INTO pwh.table_changes (table_name) VALUES (TG_TABLE_NAME)
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END
+$$;
+
+DO $$
+DECLARE
+    t text;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['patients', 'hemo_diagnoses', 'hemo_inhibitors', 'virus_tests',
+                             'treatment_hospital', 'death', 'contacts']
+    LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON pwh.%I', t || '_version', t);
+        EXECUTE format('CREATE TRIGGER %I AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON pwh.%I '
+                       'FOR EACH STATEMENT EXECUTE FUNCTION pwh.record_table_change()', t || '_version', t);
+    END LOOP;
+END
+$$;
+
+-- Versi awal skrip ini memakai satu baris counter per tabel (pwh.table_versions)
+DROP FUNCTION IF EXISTS pwh.bump_table_version();
+DROP TABLE IF EXISTS pwh.table_versions;
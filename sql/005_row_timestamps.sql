@@ -0,0 +1,35 @@
+-- 005_row_timestamps.sql
+-- Kolom created_at / updated_at (ber-index) di setiap tabel PWH untuk export
+-- inkremental di halaman input ("hanya data baru/berubah sejak ..."). updated_at
+-- diisi trigger BEFORE UPDATE sehingga ikut berubah dari halaman mana pun.
+--
+-- Jalankan sekali:            psql "$DATABASE_URL" -f sql/005_row_timestamps.sql
+-- Baris yang sudah ada mendapat waktu saat skrip dijalankan (PostgreSQL 11+
+-- menambah kolom dengan default now() tanpa menulis ulang tabel).
+-- Catatan: baris yang dihapus tidak muncul di export inkremental.
+
+CREATE OR REPLACE FUNCTION pwh.touch_updated_at() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.updated_at := now();
+    RETURN NEW;
+END
+$$;
+
+DO $$
+DECLARE
+    t text;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['patients', 'hemo_diagnoses', 'hemo_inhibitors', 'virus_tests',
+                             'treatment_hospital', 'death', 'contacts']
+    LOOP
+        EXECUTE format('ALTER TABLE pwh.%I ADD COLUMN IF NOT EXISTS created_at timestamptz NOT NULL DEFAULT now()', t);
+        EXECUTE format('ALTER TABLE pwh.%I ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now()', t);
+        EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON pwh.%I (updated_at)', t || '_updated_at_idx', t);
+        EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON pwh.%I (created_at)', t || '_created_at_idx', t);
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON pwh.%I', t || '_touch_updated_at', t);
+        EXECUTE format('CREATE TRIGGER %I BEFORE UPDATE ON pwh.%I '
+                       'FOR EACH ROW EXECUTE FUNCTION pwh.touch_updated_at()', t || '_touch_updated_at', t);
+    END LOOP;
+END
+$$;
@@ -0,0 +1,73 @@
+# tools/calibrate_password_hash.py
+# Mengukur biaya hash password di mesin ini dan menyarankan nilai rounds
+# untuk PWD_PBKDF2_ROUNDS / PWD_BCRYPT_ROUNDS (lihat main.py).
+#
+# Jalankan di server produksi:
+#   python tools/calibrate_password_hash.py --target-ms 150
+import argparse
+import statistics
+import time
+
+from passlib.hash import bcrypt, pbkdf2_sha256
+
+SAMPLE_PASSWORD = "kalibrasi-Registry-Hemofilia-2024"
+
+
+def _median_verify_ms(handler, samples: int) -> float:
+    """Median waktu verify (ms) untuk satu konfigurasi handler."""
+    hashed = handler.hash(SAMPLE_PASSWORD)
+    timings = []
+    for _ in range(samples):
+        t0 = time.perf_counter()
+        handler.verify(SAMPLE_PASSWORD, hashed)
+        timings.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(timings)
+
+
+def calibrate_pbkdf2(target_ms: float, samples: int) -> tuple[int, float]:
+    """
+    pbkdf2 linear terhadap rounds: ukur sekali di titik referensi, ekstrapolasi,
+    lalu koreksi sekali lagi di titik hasil ekstrapolasi.
+    """
+    rounds = 29000
+    for _ in range(2):
+        ms = _median_verify_ms(pbkdf2_sha256.using(rounds=rounds), samples)
+        rounds = max(1000, int(rounds * target_ms / ms) // 1000 * 1000)
+    return rounds, _median_verify_ms(pbkdf2_sha256.using(rounds=rounds), samples)
+
+
+def calibrate_bcrypt(target_ms: float, samples: int) -> tuple[int, float]:
+    """bcrypt naik 2x per cost; pilih cost tertinggi yang masih <= target."""
+    best = (4, _median_verify_ms(bcrypt.using(rounds=4), samples))
+    for cost in range(5, 16):
+        ms = _median_verify_ms(bcrypt.using(rounds=cost), samples)
+        if ms > target_ms:
+            break
+        best = (cost, ms)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kalibrasi biaya hash password untuk login dashboard.")
+    parser.add_argument("--target-ms", type=float, default=150.0, help="Target waktu satu kali verify (ms).")
+    parser.add_argument("--samples", type=int, default=5, help="Jumlah pengukuran per konfigurasi.")
+    parser.add_argument("--skip-bcrypt", action="store_true", help="Hanya kalibrasi pbkdf2_sha256.")
+    args = parser.parse_args()
+
+    rounds, ms = calibrate_pbkdf2(args.target_ms, args.samples)
+    print(f"pbkdf2_sha256: rounds={rounds} (~{ms:.1f} ms/verify)")
+    lines = [f'PWD_PBKDF2_ROUNDS = "{rounds}"']
+
+    if not args.skip_bcrypt:
+        cost, ms = calibrate_bcrypt(args.target_ms, args.samples)
+        print(f"bcrypt:        rounds={cost} (~{ms:.1f} ms/verify)")
+        lines.append(f'PWD_BCRYPT_ROUNDS = "{cost}"')
+
+    print("\nTambahkan ke blok [secrets] di .streamlit/secrets.toml:")
+    print("[secrets]")
+    for line in lines:
+        print(line)
+
+
+if __name__ == "__main__":
+    main()